@@ -0,0 +1,67 @@
+"""Compares CPU latency of the image path in NCHW and in NHWC (channels_last).
+
+The image path is preprocessing, FiLM-EfficientNet and TokenLearner of one inference step.
+
+Run this command in the root directory of this repository.
+python -m benchmarks.channels_last_benchmark --batch_size 1 --threads 4
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from film_efficientnet import preprocessors
+from tokenizers.image_tokenizer import RT1ImageTokenizer
+
+
+def measure(tokenizer: RT1ImageTokenizer, image: torch.Tensor, context: torch.Tensor,
+            warmup: int, iterations: int) -> np.ndarray:
+    """Returns latencies of the image path in milliseconds."""
+    latencies = []
+    with torch.no_grad():
+        for i in range(warmup + iterations):
+            start = time.perf_counter()
+            preprocessed = preprocessors.convert_dtype_and_crop_images(image, training=False,
+                                                                       memory_format=tokenizer.memory_format)
+            tokenizer(preprocessed.unsqueeze(1), context.unsqueeze(1))
+            if i >= warmup:
+                latencies.append((time.perf_counter() - start) * 1000)
+    return np.array(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--height', type=int, default=256)
+    parser.add_argument('--width', type=int, default=320)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--no_token_learner', action='store_true')
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    # Camera frames are usually HWC uint8.
+    image = torch.randint(0, 256, (args.batch_size, args.height, args.width, 3), dtype=torch.uint8)
+    image = image.permute(0, 3, 1, 2)
+    context = torch.rand(args.batch_size, 512)
+
+    tokenizer = RT1ImageTokenizer(use_token_learner=not args.no_token_learner)
+    tokenizer.eval()
+    channels_last_tokenizer = RT1ImageTokenizer(use_token_learner=not args.no_token_learner, channels_last=True)
+    channels_last_tokenizer.load_state_dict(tokenizer.state_dict())
+    channels_last_tokenizer.eval()
+
+    results = {}
+    for name, model in (('NCHW', tokenizer), ('NHWC', channels_last_tokenizer)):
+        latencies = measure(model, image, context, args.warmup, args.iterations)
+        results[name] = latencies
+        print('{}: p50 {:.2f} ms, p90 {:.2f} ms'.format(name, np.percentile(latencies, 50),
+                                                         np.percentile(latencies, 90)))
+    print('speedup (p50): {:.2f}x'.format(np.percentile(results['NCHW'], 50) / np.percentile(results['NHWC'], 50)))
+
+
+if __name__ == '__main__':
+    main()
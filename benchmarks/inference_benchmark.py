@@ -0,0 +1,188 @@
+"""Stage-level latency benchmark of one TransformerNetwork inference step on CPU.
+
+TransformerNetwork is built from network_configs of config.json, and each of the following stages of an inference
+step is timed separately:
+    preprocess: preprocessors.convert_dtype_and_crop_images and the resize to crop_size
+    efficientnet: EfficientNetEncoder
+    token_learner: TokenLearnerModule (or the reshape of feature maps into tokens without it)
+    generate_masks: TransformerNetwork._generate_masks
+    state_update: writing image tokens into network_state and reading action tokens from it
+    transformer: Transformer decoding of the action tokens
+    detokenize: RT1ActionTokenizer.detokenize
+p50/p90/p99 latencies in milliseconds are written as JSON for every combination of the swept parameters.
+
+Run this command in the root directory of this repository.
+python -m benchmarks.inference_benchmark --batch_sizes 1 4 --time_sequence_lengths 6 --threads 1 4 \
+    --output inference_benchmark.json
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import time
+from collections import OrderedDict
+from typing import Dict, List
+
+import numpy as np
+import torch
+from gym import spaces
+
+from film_efficientnet import preprocessors
+from inference.utils import zero_network_state
+from transformer_network import TransformerNetwork
+
+STAGES = ['preprocess', 'efficientnet', 'token_learner', 'generate_masks', 'state_update', 'transformer',
+          'detokenize']
+PERCENTILES = [50, 90, 99]
+
+
+# The same action space as train.py.
+def action_space() -> spaces.Dict:
+    return spaces.Dict(
+        OrderedDict([
+            ('first_three', spaces.Box(low=-1, high=1, shape=(3,), dtype=np.float32)),
+            ('middle_three', spaces.Box(low=-np.pi, high=np.pi, shape=(3,), dtype=np.float32)),
+            ('final_one', spaces.Discrete(2)),
+        ])
+    )
+
+
+def input_space(height: int, width: int) -> spaces.Dict:
+    return spaces.Dict({
+        'image': spaces.Box(low=0.0, high=1.0, shape=(3, height, width), dtype=np.float32),
+        'natural_language_embedding': spaces.Box(low=-np.inf, high=np.inf, shape=[512], dtype=np.float32),
+    })
+
+
+def build_network(network_configs: Dict, time_sequence_length: int, use_token_learner: bool,
+                  height: int, width: int) -> TransformerNetwork:
+    """Builds TransformerNetwork like train.py does from network_configs of config.json."""
+    network_configs = dict(network_configs)
+    network_configs['time_sequence_length'] = time_sequence_length
+    network_configs['use_token_learner'] = use_token_learner
+    if 'token_embedding_size_per_image' in network_configs:
+        network_configs['token_embedding_size'] = network_configs.pop('token_embedding_size_per_image')
+    network_configs['input_tensor_space'] = input_space(height, width)
+    network_configs['output_tensor_space'] = action_space()
+    network = TransformerNetwork(**network_configs)
+    network.eval()
+    return network
+
+
+class _Timer:
+    def __init__(self):
+        self.latencies = {stage: [] for stage in STAGES}
+
+    def time(self, stage: str, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.latencies[stage].append((time.perf_counter() - start) * 1000)
+        return result
+
+
+@torch.no_grad()
+def benchmark_stages(network: TransformerNetwork, batch_size: int, warmup: int, iterations: int) \
+        -> Dict[str, List[float]]:
+    """Runs inference steps stage by stage and returns latencies of each stage in milliseconds."""
+    image_shape = network._input_tensor_space['image'].shape
+    image = torch.randint(0, 256, (batch_size,) + tuple(image_shape), dtype=torch.uint8)
+    context = torch.rand(batch_size, 512)
+    image_tokenizer = network._image_tokenizer
+    network_state = zero_network_state(network, batch_size=batch_size)
+
+    def preprocess(x):
+        x = preprocessors.convert_dtype_and_crop_images(x, training=False, memory_format=image_tokenizer.memory_format)
+        return image_tokenizer.resize_images(x)
+
+    timer = _Timer()
+    for i in range(warmup + iterations):
+        if i == warmup:
+            timer = _Timer()
+        preprocessed = timer.time('preprocess', preprocess, image)
+        features = timer.time('efficientnet', image_tokenizer._tokenizer, preprocessed, context)
+        if image_tokenizer._use_token_learner:
+            tokens = timer.time('token_learner', image_tokenizer._token_learner, features)
+        else:
+            tokens = timer.time('token_learner', lambda x: x.reshape(batch_size, x.shape[1], -1).transpose(1, 2),
+                                features)
+        timer.time('generate_masks', network._generate_masks)
+
+        def state_update(state):
+            context_image_tokens, state = network._write_image_tokens_to_state(tokens.unsqueeze(1), state)
+            return context_image_tokens, network._state_action_tokens(state), state
+
+        context_image_tokens, action_tokens, network_state = timer.time('state_update', state_update, network_state)
+        predicted_tokens, network_state = timer.time(
+            'transformer', network._infer_action_tokens, context_image_tokens, action_tokens,
+            network._default_attention_mask, network_state)
+        timer.time('detokenize', network.action_tokenizer.detokenize, predicted_tokens)
+    return timer.latencies
+
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    summary = {'p{}'.format(p): float(np.percentile(latencies, p)) for p in PERCENTILES}
+    summary['mean'] = float(np.mean(latencies))
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default='config.json', help='json file that has network_configs.')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1])
+    parser.add_argument('--time_sequence_lengths', type=int, nargs='+', default=None,
+                        help='Defaults to time_sequence_length of the config.')
+    parser.add_argument('--use_token_learner', type=int, nargs='+', default=[1], choices=[0, 1])
+    parser.add_argument('--threads', type=int, nargs='+', default=[torch.get_num_threads()])
+    parser.add_argument('--height', type=int, default=256)
+    parser.add_argument('--width', type=int, default=320)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--output', default=None, help='json file to write the results.')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    time_sequence_lengths = args.time_sequence_lengths or [config['time_sequence_length']]
+
+    results = []
+    for time_sequence_length, use_token_learner in itertools.product(time_sequence_lengths, args.use_token_learner):
+        network = build_network(config['network_configs'], time_sequence_length, bool(use_token_learner),
+                                args.height, args.width)
+        for batch_size, threads in itertools.product(args.batch_sizes, args.threads):
+            torch.set_num_threads(threads)
+            latencies = benchmark_stages(network, batch_size, args.warmup, args.iterations)
+            total = np.sum([latencies[stage] for stage in STAGES], axis=0)
+            result = {
+                'batch_size': batch_size,
+                'time_sequence_length': time_sequence_length,
+                'use_token_learner': bool(use_token_learner),
+                'threads': threads,
+                'stages': {stage: summarize(latencies[stage]) for stage in STAGES},
+                'total': summarize(total),
+            }
+            results.append(result)
+            print('batch_size={batch_size} time_sequence_length={time_sequence_length} '
+                  'use_token_learner={use_token_learner} threads={threads}'.format(**result))
+            for stage in STAGES + ['total']:
+                summary = result['total'] if stage == 'total' else result['stages'][stage]
+                print('  {:<15} p50 {:8.2f} ms  p90 {:8.2f} ms  p99 {:8.2f} ms'.format(
+                    stage, summary['p50'], summary['p90'], summary['p99']))
+
+    if args.output is not None:
+        report = {
+            'torch_version': torch.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'config': args.config,
+            'height': args.height,
+            'width': args.width,
+            'iterations': args.iterations,
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 import abc
 import dataclasses
+import functools
 import sys
 from typing import Any, Dict, Union, Optional
 
@@ -10,9 +11,7 @@ import tree
 from rlds import rlds_types, transformations
 import torch
 
-from data.step_map_fn import jaco_step_map_fn, berkeley_cable_routing_step_map_fn, bridge_step_map_fn, toto_step_map_fn
-
-DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+from data.step_map_fn import STEP_MAP_FNS
 
 
 def _features_to_tensor_spec(
@@ -368,56 +367,80 @@ def create_structured_writer_config(table_name: str, pattern: reverb.structured_
     return config
 
 
-def n_step_pattern_builder(n: int) -> Any:
-    """Creates trajectory of length `n` from all fields of a `ref_step`."""
+def n_step_pattern_builder(n: int, action_chunk_size: int = 1) -> Any:
+    """Creates trajectory of length `n` from all fields of a `ref_step`.
+
+    With action_chunk_size K > 1, the trajectory spans n * K steps. Every field is taken at every K-th step, except
+    actions, which are taken at every step so that each time step has its next K actions. Use action_chunk_map_fn to
+    reshape them into chunks.
+    """
+    window = n * action_chunk_size
 
     def transform_fn(ref_step):
         traj = {}
         for key in ref_step:
+            step = None if key == rlds_types.ACTION or action_chunk_size == 1 else action_chunk_size
             if isinstance(ref_step[key], dict):
-                transformed_entry = tree.map_structure(lambda ref_node: ref_node[-n:],
+                transformed_entry = tree.map_structure(lambda ref_node: ref_node[-window::step],
                                                        ref_step[key])
                 traj[key] = transformed_entry
             else:
-                traj[key] = ref_step[key][-n:]
+                traj[key] = ref_step[key][-window::step]
 
         return traj
 
     return transform_fn
 
 
+def action_chunk_map_fn(n: int, action_chunk_size: int) -> Any:
+    """Reshapes actions of n_step_pattern_builder(n, action_chunk_size) from (n * K, ...) into (n, K, ...)."""
+
+    def map_fn(traj):
+        traj[rlds_types.ACTION] = tree.map_structure(
+            lambda a: tf.reshape(a, tf.concat([[n, action_chunk_size], tf.shape(a)[1:]], axis=0)),
+            traj[rlds_types.ACTION])
+        return traj
+
+    return map_fn
+
+
+# Tensors stay on CPU. The trainer moves batches to the device, see data.prefetcher.
 def tf_to_torch(tf_tensor):
     numpy_array = tf_tensor.numpy()
-    # Convert NumPy array to PyTorch tensor
-    torch_tensor = torch.from_numpy(numpy_array).to(DEVICE)
+    # Convert NumPy array to PyTorch tensor. torch.from_numpy shares memory with the array.
+    torch_tensor = torch.from_numpy(numpy_array)
     return torch_tensor
 
 
-def build_dataset(dataset_name, builder_dir, trajectory_length):
+# image_size: (height, width) of the images. Defaults to TARGET_HEIGHT and TARGET_WIDTH of step_map_fn.
+# num_shards, shard_index: Only every num_shards-th episode from shard_index is used.
+def build_dataset(dataset_name, builder_dir, trajectory_length, action_chunk_size=1, image_size=None,
+                  num_shards=1, shard_index=0, shuffle_buffer_size=int(1e5)):
     dataset_builder = tfds.builder_from_directory(builder_dir=builder_dir)
     dataset_builder_episodic_dataset = dataset_builder.as_dataset(split='train')
+    if num_shards > 1:
+        dataset_builder_episodic_dataset = dataset_builder_episodic_dataset.shard(num_shards, shard_index)
 
     dataset_rlds_spec = RLDSSpec(
         observation_info=dataset_builder.info.features['steps']['observation'],
         action_info=dataset_builder.info.features['steps']['action'],
     )
 
-    dict_step_map_fn = {
-        'jaco_play': jaco_step_map_fn,
-        'berkeley_cable_routing': berkeley_cable_routing_step_map_fn,
-        'bridge': bridge_step_map_fn,
-        'toto': toto_step_map_fn
-    }
-    step_map_fn = dict_step_map_fn[dataset_name]
+    step_map_fn = STEP_MAP_FNS[dataset_name]
+    if image_size is not None:
+        step_map_fn = functools.partial(step_map_fn, target_height=image_size[0], target_width=image_size[1])
 
     dataset_trajectory_transform = TrajectoryTransformBuilder(
         dataset_rlds_spec, step_map_fn=step_map_fn,
-        pattern_fn=n_step_pattern_builder(trajectory_length)).build(validate_expected_tensor_spec=False)
+        pattern_fn=n_step_pattern_builder(trajectory_length, action_chunk_size)).build(
+        validate_expected_tensor_spec=False)
 
     # Create trajectory datasets for the two normalized representations:
     trajectory_dataset = dataset_trajectory_transform.transform_episodic_rlds_dataset(dataset_builder_episodic_dataset)
+    if action_chunk_size > 1:
+        trajectory_dataset = trajectory_dataset.map(action_chunk_map_fn(trajectory_length, action_chunk_size))
 
-    trajectory_dataset = trajectory_dataset.shuffle(int(1e5))  # set shuffle buffer size
+    trajectory_dataset = trajectory_dataset.shuffle(shuffle_buffer_size)  # set shuffle buffer size
     trajectory_dataset = trajectory_dataset.repeat()  # ensure that data never runs out
     return trajectory_dataset, dataset_trajectory_transform
 
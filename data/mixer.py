@@ -0,0 +1,217 @@
+"""Weighted mixing of examples of several sources, each prefetched by its own thread.
+
+tf.data.Dataset.sample_from_datasets picks the source of each example first and then waits for that source, so one
+slow source, e.g. on a remote mount, stalls every batch. WeightedMixer reads every source ahead into a bounded
+queue in a background thread and picks sources by stride scheduling: each source advances by 1 / weight per example,
+and the source that is furthest behind is picked. As long as every source keeps up, sources are used in proportion
+to their weights. If the picked source has no example ready within max_wait, it is marked lagging and the ready
+source that is furthest behind is used instead. A lagging source isn't waited for until its queue is half full
+again and doesn't build up credit, so a slow source is used at the rate it is read instead of stalling the others.
+stats() reports the read rates and queue depths of the sources to find it.
+
+Usage:
+    mixer = WeightedMixer({'toto': toto_iterator, 'bridge': bridge_iterator}, weights={'toto': 1., 'bridge': 2.},
+                          log_interval=60.)
+    for example in mixer:
+        ...
+"""
+
+import itertools
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Optional
+
+# Put in the queue of a source after its last example.
+_END = object()
+
+
+class _Source(object):
+
+    def __init__(self, name: str, iterable: Iterable, weight: float, queue_size: int):
+        self.name = name
+        self.iterable = iterable
+        self.weight = weight
+        self.queue = queue.Queue(queue_size)
+        self.num_read = 0
+        self.num_used = 0
+        # Iterator of the current epoch, which a restart continues. None before the epoch and once _END is queued.
+        self.iterator = None
+        # Example that was read but not queued when the mixer stopped. It is queued first when the mixer restarts.
+        self.pending = []
+        self.done = False
+        self.lagging = False
+        # Virtual time of the stride scheduling.
+        self.pass_ = 0.
+
+
+class WeightedMixer(object):
+    """Iterates over examples of sources picked by weight among the sources that have examples ready."""
+
+    def __init__(self, sources: Dict[str, Iterable], weights: Optional[Dict[str, float]] = None,
+                 queue_size: int = 16, max_wait: float = 0.01, seed: Optional[int] = None,
+                 log_interval: Optional[float] = None, log_fn: Callable[[str], Any] = print):
+        """Creates a mixer.
+
+        Args:
+            sources: Iterables of examples by name.
+            weights: Relative weight of each source. Defaults to the same weight for every source.
+            queue_size: Number of examples that are read ahead from each source.
+            max_wait: Seconds to wait for the picked source before another source is used instead.
+            seed: Seed of the order of sources with the same weight.
+            log_interval: If given, a summary of stats() is passed to log_fn every log_interval seconds while
+                iterating.
+            log_fn: Function that logs the summary.
+        """
+        weights = weights or {name: 1. for name in sources}
+        if set(weights) != set(sources):
+            raise ValueError('weights must have the sources {}, got {}.'.format(list(sources), list(weights)))
+        if any(w < 0 for w in weights.values()) or not any(w > 0 for w in weights.values()):
+            raise ValueError('weights must be non-negative and not all zero, got {}.'.format(weights))
+        self._sources = OrderedDict((name, _Source(name, iterable, weights[name], queue_size))
+                                    for name, iterable in sources.items() if weights[name] > 0)
+        self._queue_size = queue_size
+        self._max_wait = max_wait
+        self._random = random.Random(seed)
+        self._log_interval = log_interval
+        self._log_fn = log_fn
+        # Notified when a source queues an example.
+        self._ready = threading.Condition()
+        self._stop = threading.Event()
+        self._threads = []
+        self._in_epoch = False
+        self._last_stats = (time.monotonic(), {name: (0, 0) for name in self._sources})
+
+    # Runs in the thread of a source.
+    def _produce(self, source: _Source):
+        pending, source.pending = source.pending, []
+        try:
+            for example in itertools.chain(pending, source.iterator, [_END]):
+                if not self._put(source, example):
+                    # Examples that are queued stay in the queue. This one is kept for the next iteration as well,
+                    # so that stopping and resuming the mixer loses no example.
+                    source.pending = [example]
+                    return
+                if example is _END:
+                    source.iterator = None
+                    return
+                source.num_read += 1
+        except Exception as e:  # raised by __iter__
+            self._put(source, e)
+
+    # Returns False if the mixer is stopped before the example is queued.
+    def _put(self, source: _Source, example: Any) -> bool:
+        while not self._stop.is_set():
+            try:
+                source.queue.put(example, timeout=0.1)
+            except queue.Full:
+                continue
+            with self._ready:
+                self._ready.notify()
+            return True
+        return False
+
+    # An iteration that is stopped early, e.g. by islice, is resumed by the next one. Otherwise, the next iteration
+    # starts a new epoch that iterates over every source again.
+    def _start(self):
+        self._stop.clear()
+        if not self._in_epoch:
+            for source in self._sources.values():
+                source.iterator = iter(source.iterable)
+                source.pending = []
+                source.done = False
+            self._in_epoch = True
+        for source in self._sources.values():
+            source.lagging = False
+            source.pass_ = self._random.random() / source.weight
+        # Sources whose _END is queued have nothing left to read.
+        self._threads = [threading.Thread(target=self._produce, args=(source,), daemon=True)
+                         for source in self._sources.values() if source.iterator is not None or source.pending]
+        for thread in self._threads:
+            thread.start()
+
+    # Returns the source of the next example, or None if every source is done.
+    def _next_source(self) -> Optional[_Source]:
+        with self._ready:
+            live = [s for s in self._sources.values() if not s.done]
+            if not live:
+                return None
+            source = min(live, key=lambda s: s.pass_)
+            if source.lagging and source.queue.qsize() >= self._queue_size // 2:
+                source.lagging = False
+            if not source.lagging:
+                deadline = time.monotonic() + self._max_wait
+                while source.queue.empty() and time.monotonic() < deadline:
+                    self._ready.wait(deadline - time.monotonic())
+                if not source.queue.empty():
+                    return source
+                source.lagging = True
+            ready = [s for s in live if not s.queue.empty()]
+            while not ready:
+                self._ready.wait(0.1)
+                ready = [s for s in live if not s.queue.empty()]
+            return min(ready, key=lambda s: s.pass_)
+
+    def __iter__(self):
+        self._start()
+        last_log = time.monotonic()
+        try:
+            while True:
+                source = self._next_source()
+                if source is None:
+                    self._in_epoch = False
+                    return
+                example = source.queue.get_nowait()
+                if example is _END:
+                    source.done = True
+                    continue
+                if isinstance(example, Exception):
+                    raise example
+                # Sources that are behind but were not picked catch up instead of being picked later in a row.
+                for other in self._sources.values():
+                    other.pass_ = max(other.pass_, source.pass_)
+                source.pass_ += 1. / source.weight
+                source.num_used += 1
+                yield example
+
+                if self._log_interval is not None and time.monotonic() - last_log >= self._log_interval:
+                    last_log = time.monotonic()
+                    self._log_fn(self.summary())
+        finally:
+            self._stop.set()
+            for thread in self._threads:
+                thread.join()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Returns stats of each source since the previous call.
+
+        read_rate: examples per second read from the source.
+        use_rate: examples per second yielded from the source.
+        queue_depth: examples read ahead from the source. A source that is always empty is slower than its share.
+        weight: weight of the source.
+        """
+        now = time.monotonic()
+        last_time, last_counts = self._last_stats
+        elapsed = max(now - last_time, 1e-9)
+        stats = OrderedDict()
+        counts = {}
+        for name, source in self._sources.items():
+            num_read, num_used = source.num_read, source.num_used
+            last_read, last_used = last_counts[name]
+            stats[name] = {
+                'read_rate': (num_read - last_read) / elapsed,
+                'use_rate': (num_used - last_used) / elapsed,
+                'queue_depth': source.queue.qsize(),
+                'weight': source.weight,
+            }
+            counts[name] = (num_read, num_used)
+        self._last_stats = (now, counts)
+        return stats
+
+    def summary(self) -> str:
+        """Returns stats() as one line."""
+        return ' | '.join('{}: read {:.1f}/s, used {:.1f}/s, queue {}/{}'.format(
+            name, s['read_rate'], s['use_rate'], s['queue_depth'], self._queue_size)
+            for name, s in self.stats().items())
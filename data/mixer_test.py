@@ -0,0 +1,96 @@
+"""Tests for mixer."""
+
+import itertools
+import time
+import unittest
+
+from absl.testing import parameterized
+
+from data.mixer import WeightedMixer
+
+
+def slow(iterable, delay):
+    for example in iterable:
+        time.sleep(delay)
+        yield example
+
+
+class WeightedMixerTest(parameterized.TestCase, unittest.TestCase):
+
+    def testYieldsEveryExampleOfFiniteSources(self):
+        mixer = WeightedMixer({'a': range(0, 50), 'b': range(100, 130)}, seed=0)
+        self.assertEqual(sorted(mixer), list(range(0, 50)) + list(range(100, 130)))
+
+    @parameterized.named_parameters(
+        ('uniform', {'a': 1., 'b': 1.}),
+        ('weighted', {'a': 3., 'b': 1.}))
+    def testWeights(self, weights):
+        mixer = WeightedMixer({'a': itertools.repeat('a'), 'b': itertools.repeat('b')}, weights=weights, seed=0)
+        examples = list(itertools.islice(mixer, 2000))
+        share = examples.count('a') / len(examples)
+        self.assertAlmostEqual(share, weights['a'] / sum(weights.values()), delta=0.05)
+
+    def testZeroWeightSourceIsNotRead(self):
+        mixer = WeightedMixer({'a': range(10), 'b': range(100, 110)}, weights={'a': 1., 'b': 0.}, seed=0)
+        self.assertEqual(sorted(mixer), list(range(10)))
+
+    def testSlowSourceDoesNotStall(self):
+        mixer = WeightedMixer({'fast': itertools.repeat('fast'), 'slow': slow(itertools.repeat('slow'), 0.05)},
+                              seed=0)
+        start = time.monotonic()
+        examples = list(itertools.islice(mixer, 500))
+        # The slow source alone would take 0.05 * 250 seconds for its share.
+        self.assertLess(time.monotonic() - start, 5.)
+        self.assertGreater(examples.count('fast'), examples.count('slow'))
+
+        stats = mixer.stats()
+        self.assertEqual(list(stats), ['fast', 'slow'])
+        self.assertGreater(stats['fast']['read_rate'], stats['slow']['read_rate'])
+        self.assertLessEqual(stats['fast']['queue_depth'], 16)
+
+    @parameterized.named_parameters(
+        ('iterators', iter),
+        ('lists', list))
+    def testRestartLosesNoExample(self, make_source):
+        # Small queues make sure that the threads of the sources are blocked on full queues when the mixer stops.
+        # Each iteration that is stopped early is continued by the next one.
+        mixer = WeightedMixer({'a': make_source(range(0, 50)), 'b': make_source(range(100, 130))}, queue_size=1,
+                              seed=0)
+        examples = []
+        for _ in range(3):
+            iterator = iter(mixer)
+            examples.extend(itertools.islice(iterator, 10))
+            time.sleep(0.1)
+            iterator.close()
+        examples.extend(mixer)
+        self.assertEqual(sorted(examples), list(range(0, 50)) + list(range(100, 130)))
+
+    def testNewEpochRereadsSources(self):
+        mixer = WeightedMixer({'a': range(0, 50), 'b': range(100, 130)}, queue_size=1, seed=0)
+        for _ in range(2):
+            self.assertEqual(sorted(mixer), list(range(0, 50)) + list(range(100, 130)))
+
+    def testLog(self):
+        lines = []
+        mixer = WeightedMixer({'a': slow(range(5), 0.01)}, log_interval=0., log_fn=lines.append)
+        self.assertEqual(list(mixer), list(range(5)))
+        self.assertLen(lines, 5)
+        self.assertIn('a: read', lines[0])
+
+    def testRaisesErrorOfSource(self):
+        def source():
+            yield 0
+            raise RuntimeError('source failed')
+
+        with self.assertRaisesRegex(RuntimeError, 'source failed'):
+            list(WeightedMixer({'a': source()}))
+
+    def testInvalidWeights(self):
+        with self.assertRaises(ValueError):
+            WeightedMixer({'a': range(3)}, weights={'b': 1.})
+        with self.assertRaises(ValueError):
+            WeightedMixer({'a': range(3)}, weights={'a': 0.})
+
+
+if __name__ == '__main__':
+    unittest.main()
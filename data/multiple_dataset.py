@@ -1,20 +1,57 @@
-import tensorflow as tf
-from torch.utils.data import Dataset
+from collections import OrderedDict
 
-from data.data_loader import build_dataset, tf_to_torch
+import torch
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+
+from data.mixer import WeightedMixer
+
+# tensorflow and the modules of data.data_loader, which import it, are only imported where a pipeline is built, so
+# that importing this module stays cheap and doesn't initialize tensorflow in the training process.
+
+# TFDS directory of each dataset of data.step_map_fn.STEP_MAP_FNS.
+DATASETS = OrderedDict([
+    ('jaco_play', 'gs://gresearch/robotics/jaco_play/0.1.0'),
+    ('berkeley_cable_routing', 'gs://gresearch/robotics/berkeley_cable_routing/0.1.0'),
+    ('bridge', 'gs://gresearch/robotics/bridge/0.1.0'),
+    ('toto', 'gs://gresearch/robotics/toto/0.1.0'),
+])
+
+# Relative weight of each dataset in the mix. Datasets that are not listed are not used.
+DEFAULT_DATASET_WEIGHTS = OrderedDict([('toto', 1.), ('bridge', 1.)])
+
+
+def _example_to_torch(example):
+    from data.data_loader import tf_to_torch
+
+    return {key: ({subk: tf_to_torch(subv) for subk, subv in value.items()}
+                  if isinstance(value, dict) else tf_to_torch(value))
+            for key, value in example.items()}
+
+
+# worker_init_fn of DataLoader for CombinedIterableDataset.
+# The trainer owns the GPUs. tensorflow only runs the input pipeline on CPU in DataLoader workers. Without workers,
+# the pipeline runs in the training process, whose devices are left as they are.
+def worker_init_fn(worker_id):
+    import tensorflow as tf
+
+    tf.config.set_visible_devices([], 'GPU')
 
 
 class CombinedDataset(Dataset):
-    def __init__(self, time_sequence_length=6):
+    def __init__(self, time_sequence_length=6, action_chunk_size=1, image_size=None, dataset_weights=None):
+        import tensorflow as tf
+        from data.data_loader import build_dataset
+
+        dataset_weights = dataset_weights or DEFAULT_DATASET_WEIGHTS
         trajectory_dataset_list = []
         dataset_trajectory_transform_list = []
-        builder_dir_list = ['gs://gresearch/robotics/toto/0.1.0', 'gs://gresearch/robotics/bridge/0.1.0']
-        dataset_name_list = ['toto', 'bridge']
 
-        for idx, builder_dir in enumerate(builder_dir_list):
+        for dataset_name in dataset_weights:
+            builder_dir = DATASETS[dataset_name]
             print('start loading', builder_dir)
             trajectory_dataset, dataset_trajectory_transform = build_dataset(
-                dataset_name=dataset_name_list[idx], builder_dir=builder_dir, trajectory_length=time_sequence_length)
+                dataset_name=dataset_name, builder_dir=builder_dir, trajectory_length=time_sequence_length,
+                action_chunk_size=action_chunk_size, image_size=image_size)
             trajectory_dataset_list.append(trajectory_dataset)
             dataset_trajectory_transform_list.append(dataset_trajectory_transform)
 
@@ -22,7 +59,9 @@ class CombinedDataset(Dataset):
         for dataset_trajectory_transform in dataset_trajectory_transform_list:
             assert dataset_trajectory_transform.expected_tensor_spec == template_dataset_trajectory_transform.expected_tensor_spec
 
-        combined_dataset = tf.data.Dataset.sample_from_datasets(trajectory_dataset_list)
+        total_weight = sum(dataset_weights.values())
+        combined_dataset = tf.data.Dataset.sample_from_datasets(
+            trajectory_dataset_list, weights=[w / total_weight for w in dataset_weights.values()])
         # combined_dataset = combined_dataset.batch(2)
         self.combined_dataset_it = iter(combined_dataset)
 
@@ -30,6 +69,8 @@ class CombinedDataset(Dataset):
         return int(1e6)
 
     def __getitem__(self, idx):
+        from data.data_loader import tf_to_torch
+
         example = next(self.combined_dataset_it)
         for key, value in example.items():
             if isinstance(value, dict):
@@ -39,3 +80,95 @@ class CombinedDataset(Dataset):
                 example[key] = tf_to_torch(value)
 
         return example
+
+
+# CombinedDataset for DataLoader with multiple workers and for distributed training.
+# Unlike CombinedDataset, the tensorflow pipeline is built lazily in each DataLoader worker, and each worker of each
+# rank reads its own shard of the episodes. Examples are CPU tensors that share memory with the tensorflow outputs.
+# Use DataLoader(..., persistent_workers=True) so that the pipelines are built once rather than every epoch, and
+# DataLoader(..., worker_init_fn=worker_init_fn) so that tensorflow in the workers doesn't take the GPUs.
+# Each dataset is read ahead by its own thread and mixed by data.mixer.WeightedMixer, so a slow dataset doesn't
+# stall the others.
+class CombinedIterableDataset(IterableDataset):
+    def __init__(self,
+                 time_sequence_length=6,
+                 action_chunk_size=1,
+                 image_size=None,
+                 # Relative weight of each dataset of DATASETS. Defaults to DEFAULT_DATASET_WEIGHTS.
+                 dataset_weights=None,
+                 # Number of examples that this rank reads in an epoch, summed over its workers.
+                 samples_per_epoch=int(1e6),
+                 # Shuffle buffer size summed over all workers of all ranks.
+                 shuffle_buffer_size=int(1e5),
+                 # Defaults to the rank and the world size of torch.distributed if it is initialized.
+                 rank=None,
+                 world_size=None,
+                 # Number of examples that are read ahead from each dataset.
+                 queue_size=16,
+                 # If given, each worker prints the read rates and queue depths of the datasets every log_interval
+                 # seconds.
+                 log_interval=None):
+        dataset_weights = OrderedDict(dataset_weights or DEFAULT_DATASET_WEIGHTS)
+        unknown_datasets = [name for name in dataset_weights if name not in DATASETS]
+        if unknown_datasets:
+            raise ValueError('Unknown datasets {}. Datasets are {}.'.format(unknown_datasets, list(DATASETS)))
+        self._time_sequence_length = time_sequence_length
+        self._action_chunk_size = action_chunk_size
+        self._image_size = image_size
+        self._dataset_weights = dataset_weights
+        self._queue_size = queue_size
+        self._log_interval = log_interval
+        self._samples_per_epoch = samples_per_epoch
+        self._shuffle_buffer_size = shuffle_buffer_size
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        if rank is None:
+            rank = torch.distributed.get_rank() if distributed else 0
+        if world_size is None:
+            world_size = torch.distributed.get_world_size() if distributed else 1
+        self._rank = rank
+        self._world_size = world_size
+        self._mixer = None
+
+    def __len__(self):
+        return self._samples_per_epoch
+
+    # Returns (number of shards, index of the shard of this worker).
+    def _shard(self):
+        worker_info = get_worker_info()
+        num_workers = 1 if worker_info is None else worker_info.num_workers
+        worker_id = 0 if worker_info is None else worker_info.id
+        return self._world_size * num_workers, self._rank * num_workers + worker_id
+
+    def _build_mixer(self, num_shards, shard_index):
+        import tensorflow as tf
+        from data.data_loader import build_dataset
+
+        sources = OrderedDict()
+        for dataset_name in self._dataset_weights:
+            trajectory_dataset, _ = build_dataset(
+                dataset_name=dataset_name, builder_dir=DATASETS[dataset_name],
+                trajectory_length=self._time_sequence_length, action_chunk_size=self._action_chunk_size,
+                image_size=self._image_size, num_shards=num_shards, shard_index=shard_index,
+                shuffle_buffer_size=max(1, self._shuffle_buffer_size // num_shards))
+            # Examples are converted in the thread of the dataset.
+            sources[dataset_name] = map(_example_to_torch, iter(trajectory_dataset.prefetch(tf.data.AUTOTUNE)))
+        return WeightedMixer(sources, weights=self._dataset_weights, queue_size=self._queue_size,
+                             log_interval=self._log_interval,
+                             log_fn=lambda line: print('[data shard {}] {}'.format(shard_index, line)))
+
+    def __iter__(self):
+        num_shards, shard_index = self._shard()
+        if self._mixer is None:
+            self._mixer = self._build_mixer(num_shards, shard_index)
+
+        # Split the examples of an epoch of this rank among its workers.
+        num_workers = num_shards // self._world_size
+        worker_id = shard_index % num_workers
+        num_samples = self._samples_per_epoch // num_workers + (worker_id < self._samples_per_epoch % num_workers)
+        examples = iter(self._mixer)
+        try:
+            for _, example in zip(range(num_samples), examples):
+                yield example
+        finally:
+            # Stops the threads of the datasets until the next epoch.
+            examples.close()
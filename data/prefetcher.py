@@ -0,0 +1,126 @@
+"""Background host-to-device prefetching of batches.
+
+A background thread copies each batch of a DataLoader into pinned, preallocated host buffers. The main thread then
+copies the pinned buffers to the device with non_blocking copies on a side CUDA stream, one batch ahead of the
+training step. Loading, host copies and host-to-device copies of the next batch overlap with the forward and
+backward passes of the current batch.
+
+Usage:
+    for batch in BatchPrefetcher(data_loader, device):
+        ...  # every tensor of batch is on device
+"""
+
+import queue
+import threading
+from typing import Any, Callable, Iterable, Optional
+
+import torch
+
+# Put in the queue of ready buffers after the last batch of the loader.
+_END = object()
+
+
+def _map_tensors(fn: Callable[..., torch.Tensor], batch: Any, *others: Any) -> Any:
+    if isinstance(batch, dict):
+        return type(batch)((k, _map_tensors(fn, v, *(o[k] if o is not None else None for o in others)))
+                           for k, v in batch.items())
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_map_tensors(fn, v, *(o[i] if o is not None else None for o in others))
+                           for i, v in enumerate(batch))
+    if isinstance(batch, torch.Tensor):
+        return fn(batch, *others)
+    return batch
+
+
+class BatchPrefetcher(object):
+    """Iterates over a DataLoader and yields its batches on device."""
+
+    def __init__(self, loader: Iterable, device: torch.device, num_buffers: int = 2):
+        """Creates a prefetcher.
+
+        Args:
+            loader: Yields (nested dicts, lists or tuples of) CPU tensors, e.g. a DataLoader.
+            device: Device of the yielded batches.
+            num_buffers: Number of host buffers. The background thread fills up to num_buffers batches ahead.
+        """
+        if num_buffers < 2:
+            raise ValueError('num_buffers must be at least 2, got {}.'.format(num_buffers))
+        self._loader = loader
+        self._device = torch.device(device)
+        self._num_buffers = num_buffers
+        self._cuda = self._device.type == 'cuda'
+        self._stream = torch.cuda.Stream(self._device) if self._cuda else None
+        # Host buffers of each slot. They are allocated from the first batch and reused as long as shapes match.
+        self._buffers = [None] * num_buffers
+
+    def __len__(self):
+        return len(self._loader)
+
+    def _fill(self, slot: int, batch: Any):
+        def copy(src, dst):
+            if dst is None or dst.shape != src.shape or dst.dtype != src.dtype:
+                dst = torch.empty(src.shape, dtype=src.dtype, pin_memory=self._cuda)
+            return dst.copy_(src)
+
+        self._buffers[slot] = _map_tensors(copy, batch, self._buffers[slot])
+
+    # Runs in the background thread.
+    def _produce(self, free: queue.Queue, ready: queue.Queue, stop: threading.Event):
+        try:
+            for batch in self._loader:
+                slot, event = free.get()
+                if stop.is_set():
+                    return
+                # The buffers of the slot are free once their previous host-to-device copy is done.
+                if event is not None:
+                    event.synchronize()
+                self._fill(slot, batch)
+                ready.put(slot)
+            ready.put(_END)
+        except Exception as e:  # raised in the main thread
+            ready.put(e)
+
+    # Copies the buffers of a slot to the device and returns the batch and an event that marks the end of the copy.
+    def _transfer(self, slot: int, free: queue.Queue):
+        if not self._cuda:
+            batch = _map_tensors(lambda t: t.to(self._device, copy=True), self._buffers[slot])
+            free.put((slot, None))
+            return batch, None
+        with torch.cuda.stream(self._stream):
+            batch = _map_tensors(lambda t: t.to(self._device, non_blocking=True), self._buffers[slot])
+            event = torch.cuda.Event()
+            event.record(self._stream)
+        free.put((slot, event))
+        return batch, event
+
+    def _next(self, ready: queue.Queue, free: queue.Queue):
+        slot = ready.get()
+        if slot is _END:
+            return None, None
+        if isinstance(slot, Exception):
+            raise slot
+        return self._transfer(slot, free)
+
+    def __iter__(self):
+        free, ready, stop = queue.Queue(), queue.Queue(), threading.Event()
+        for slot in range(self._num_buffers):
+            free.put((slot, None))
+        thread = threading.Thread(target=self._produce, args=(free, ready, stop), daemon=True)
+        thread.start()
+        try:
+            batch, event = self._next(ready, free)
+            while batch is not None:
+                # The copy of the next batch is issued before the current batch is used.
+                next_batch, next_event = self._next(ready, free)
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self._device)
+                    current_stream.wait_event(event)
+                    # Tensors allocated on the side stream must not be reused before the current stream is done.
+                    _map_tensors(lambda t: t.record_stream(current_stream), batch)
+                yield batch
+                batch, event = next_batch, next_event
+        finally:
+            stop.set()
+            # Unblocks the background thread if it waits for a free slot.
+            free.put((None, None))
+            thread.join()
@@ -0,0 +1,52 @@
+"""Tests for prefetcher."""
+
+import unittest
+
+import torch
+from absl.testing import parameterized
+
+from data.prefetcher import BatchPrefetcher
+
+
+def make_batches(num_batches):
+    return [{'observation': {'image': torch.full((2, 3, 4, 5), i, dtype=torch.uint8)},
+             'action': {'first_three': torch.rand(2, 3)}}
+            for i in range(num_batches)]
+
+
+class BatchPrefetcherTest(parameterized.TestCase, unittest.TestCase):
+
+    @parameterized.named_parameters(
+        ('two_buffers', 2),
+        ('three_buffers', 3))
+    def testYieldsBatchesOfLoader(self, num_buffers):
+        batches = make_batches(5)
+        prefetcher = BatchPrefetcher(batches, torch.device('cpu'), num_buffers=num_buffers)
+        self.assertLen(prefetcher, 5)
+        # Batches are kept until the end, so the reuse of host buffers must not change them.
+        prefetched_batches = list(prefetcher)
+        self.assertLen(prefetched_batches, 5)
+        for batch, prefetched_batch in zip(batches, prefetched_batches):
+            torch.testing.assert_close(prefetched_batch['observation']['image'], batch['observation']['image'])
+            torch.testing.assert_close(prefetched_batch['action']['first_three'], batch['action']['first_three'])
+        # Every epoch iterates over the loader again.
+        self.assertLen(list(prefetcher), 5)
+
+    def testStopEarly(self):
+        prefetcher = BatchPrefetcher(make_batches(10), torch.device('cpu'))
+        for i, _ in enumerate(prefetcher):
+            if i == 1:
+                break
+        self.assertLen(list(prefetcher), 10)
+
+    def testRaisesErrorOfLoader(self):
+        def loader():
+            yield make_batches(1)[0]
+            raise RuntimeError('loader failed')
+
+        with self.assertRaisesRegex(RuntimeError, 'loader failed'):
+            list(BatchPrefetcher(loader(), torch.device('cpu')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,17 +1,19 @@
 import tensorflow as tf
 
+# Default image size of the datasets. Pass target_height and target_width to match crop_size of TransformerNetwork,
+# so that the network doesn't need to resize images.
 TARGET_WIDTH = 160
 TARGET_HEIGHT = 128
 
 
-def jaco_step_map_fn(step):
+def jaco_step_map_fn(step, target_height=TARGET_HEIGHT, target_width=TARGET_WIDTH):
     # Resize to be compatible with robo_net trajectory
     transformed_step = {}
     # Observations
     transformed_step['observation'] = {}
 
     transformed_step['observation']['image'] = tf.cast(tf.image.resize_with_pad(
-        step['observation']['image'], target_width=TARGET_WIDTH, target_height=TARGET_HEIGHT), tf.uint8)
+        step['observation']['image'], target_width=target_width, target_height=target_height), tf.uint8)
     transformed_step['observation']['image'] = tf.transpose(transformed_step['observation']['image'], [2, 0, 1])
 
     transformed_step['observation']['natural_language_embedding'] = step['observation']['natural_language_embedding']
@@ -29,13 +31,13 @@ def jaco_step_map_fn(step):
     return transformed_step
 
 
-def berkeley_cable_routing_step_map_fn(step):
+def berkeley_cable_routing_step_map_fn(step, target_height=TARGET_HEIGHT, target_width=TARGET_WIDTH):
     # Resize to be compatible with robo_net trajectory
     transformed_step = {}
     # Observations
     transformed_step['observation'] = {}
     transformed_step['observation']['image'] = tf.cast(tf.image.resize_with_pad(
-        step['observation']['image'], target_width=TARGET_WIDTH, target_height=TARGET_HEIGHT), tf.uint8)
+        step['observation']['image'], target_width=target_width, target_height=target_height), tf.uint8)
     transformed_step['observation']['image'] = tf.transpose(transformed_step['observation']['image'], [2, 0, 1])
     transformed_step['observation']['natural_language_embedding'] = step['observation']['natural_language_embedding']
     # Actions
@@ -50,14 +52,14 @@ def berkeley_cable_routing_step_map_fn(step):
     return transformed_step
 
 
-def bridge_step_map_fn(step):
+def bridge_step_map_fn(step, target_height=TARGET_HEIGHT, target_width=TARGET_WIDTH):
     # Resize to be compatible with robo_net trajectory
     transformed_step = {}
     # Observations
     transformed_step['observation'] = {}
 
     transformed_step['observation']['image'] = tf.cast(tf.image.resize_with_pad(
-        step['observation']['image'], target_width=TARGET_WIDTH, target_height=TARGET_HEIGHT), tf.uint8)
+        step['observation']['image'], target_width=target_width, target_height=target_height), tf.uint8)
     transformed_step['observation']['image'] = tf.transpose(transformed_step['observation']['image'], [2, 0, 1])
 
     transformed_step['observation']['natural_language_embedding'] = step['observation']['natural_language_embedding']
@@ -75,14 +77,14 @@ def bridge_step_map_fn(step):
     return transformed_step
 
 
-def toto_step_map_fn(step):
+def toto_step_map_fn(step, target_height=TARGET_HEIGHT, target_width=TARGET_WIDTH):
     # Resize to be compatible with robo_net trajectory
     transformed_step = {}
     # Observations
     transformed_step['observation'] = {}
 
     transformed_step['observation']['image'] = tf.cast(tf.image.resize_with_pad(
-        step['observation']['image'], target_width=TARGET_WIDTH, target_height=TARGET_HEIGHT), tf.uint8)
+        step['observation']['image'], target_width=target_width, target_height=target_height), tf.uint8)
     transformed_step['observation']['image'] = tf.transpose(transformed_step['observation']['image'], [2, 0, 1])
 
     transformed_step['observation']['natural_language_embedding'] = step['observation']['natural_language_embedding']
@@ -98,3 +100,12 @@ def toto_step_map_fn(step):
     transformed_step['is_terminal'] = step['is_terminal']
 
     return transformed_step
+
+
+# step_map_fn of each dataset by name.
+STEP_MAP_FNS = {
+    'jaco_play': jaco_step_map_fn,
+    'berkeley_cable_routing': berkeley_cable_routing_step_map_fn,
+    'bridge': bridge_step_map_fn,
+    'toto': toto_step_map_fn
+}
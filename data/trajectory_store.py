@@ -0,0 +1,569 @@
+"""Local, memory-mapped store of the steps of a dataset.
+
+build_dataset reads episodes from TFDS, resizes every image in step_map_fn and cuts trajectories with reverb on every
+pass over the data. convert_dataset does that work once: a pool of processes each reads a shard of the episodes,
+applies the step_map_fn of the dataset and writes the steps to local disk. Afterwards TrajectoryDataset reads
+trajectories with the layout of build_dataset from memory-mapped files, without tensorflow, resizing or reverb.
+
+Layout of a store:
+    meta.json                 fields, image size and shards of the store
+    shard-00000/
+        meta.json             fields, number of steps and number of episodes of the shard
+        episode_offsets.npy   int64 (num_episodes + 1,). Steps of episode i are [offsets[i], offsets[i + 1]).
+        observation.image.bin raw C-ordered array of a field, (num_steps,) + shape of the field
+        ...
+A field is a leaf of the output of step_map_fn, e.g. 'observation/image' (uint8 (3, H, W)), 'action/first_three'
+(float32) or 'is_first' (bool).
+
+Images can be stored JPEG or PNG compressed with image_format. Then observation.image.bin is the concatenation of
+the encoded frames, and observation.image.offsets.npy (int64 (num_steps + 1,)) holds the byte offsets of the frames.
+The reader decodes the frames of a trajectory in a thread pool into one preallocated array.
+
+Usage:
+    python -m data.trajectory_store --dataset_name bridge --builder_dir gs://gresearch/robotics/bridge/0.1.0 \
+        --output_dir /data/rt1/bridge --image_size 128 160 --image_format jpeg
+    dataset = TrajectoryDataset('/data/rt1/bridge', time_sequence_length=6)
+    sampler = WindowSampler(len(dataset), seed=0)
+    loader = DataLoader(dataset, batch_size=32, sampler=sampler, num_workers=4)
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+from torchvision.io import decode_jpeg, decode_png, encode_jpeg, encode_png
+
+_FORMAT_VERSION = 1
+_META = 'meta.json'
+_EPISODE_OFFSETS = 'episode_offsets.npy'
+# Fields that can be stored compressed with image_format.
+IMAGE_FIELDS = ('observation/image',)
+_IMAGE_FORMATS = ('jpeg', 'png')
+
+
+def _flatten(nested: Dict[str, Any], prefix: str = '') -> Dict[str, Any]:
+    flat = OrderedDict()
+    for k, v in nested.items():
+        if isinstance(v, dict):
+            flat.update(_flatten(v, prefix + k + '/'))
+        else:
+            flat[prefix + k] = v
+    return flat
+
+
+def _unflatten(flat: Dict[str, Any]) -> Dict[str, Any]:
+    nested = OrderedDict()
+    for k, v in flat.items():
+        node = nested
+        *parents, name = k.split('/')
+        for parent in parents:
+            node = node.setdefault(parent, OrderedDict())
+        node[name] = v
+    return nested
+
+
+def _field_file(key: str) -> str:
+    return key.replace('/', '.') + '.bin'
+
+
+def _frame_offsets_file(key: str) -> str:
+    return key.replace('/', '.') + '.offsets.npy'
+
+
+def _encode_frame(frame: np.ndarray, image_format: str, jpeg_quality: int) -> np.ndarray:
+    frame = torch.from_numpy(np.ascontiguousarray(frame))
+    if image_format == 'jpeg':
+        return encode_jpeg(frame, quality=jpeg_quality).numpy()
+    return encode_png(frame).numpy()
+
+
+class ShardWriter(object):
+    """Appends episodes to a shard of a store."""
+
+    def __init__(self, path: str, image_format: Optional[str] = None, jpeg_quality: int = 90):
+        """Creates a writer.
+
+        Args:
+            path: Directory of the shard.
+            image_format: None, 'jpeg' or 'png'. If given, IMAGE_FIELDS are stored compressed in this format.
+                They must be uint8 (C, H, W) frames with 1 or 3 channels.
+            jpeg_quality: Quality of JPEG compression between 1 and 100.
+        """
+        if image_format is not None and image_format not in _IMAGE_FORMATS:
+            raise ValueError('image_format must be one of {}, got {}.'.format(_IMAGE_FORMATS, image_format))
+        os.makedirs(path, exist_ok=True)
+        self._path = path
+        self._image_format = image_format
+        self._jpeg_quality = jpeg_quality
+        self._fields = None
+        self._files = {}
+        self._episode_offsets = [0]
+        # Byte offsets of the frames of each compressed field.
+        self._frame_offsets = {}
+
+    def append_episode(self, steps: Dict[str, Any]):
+        """Appends an episode.
+
+        Args:
+            steps: Nested dict of arrays of every step of the episode, e.g. {'observation': {'image': (T, 3, H, W)}}.
+        """
+        steps = OrderedDict((k, np.asarray(v)) for k, v in _flatten(steps).items())
+        fields = OrderedDict((k, {'dtype': v.dtype.name, 'shape': list(v.shape[1:])}) for k, v in steps.items())
+        for k in fields:
+            if self._image_format is not None and k in IMAGE_FIELDS:
+                if fields[k]['dtype'] != 'uint8' or len(fields[k]['shape']) != 3 or fields[k]['shape'][0] not in (1, 3):
+                    raise ValueError('{} must be uint8 (C, H, W) frames to be compressed, got {}.'.format(
+                        k, fields[k]))
+                fields[k]['format'] = self._image_format
+        if self._fields is None:
+            self._fields = fields
+            self._files = {k: open(os.path.join(self._path, _field_file(k)), 'wb') for k in fields}
+            self._frame_offsets = {k: [0] for k, v in fields.items() if 'format' in v}
+        elif fields != self._fields:
+            raise ValueError('Fields of the episode {} do not match the fields of the shard {}.'.format(
+                fields, self._fields))
+        num_steps = {len(v) for v in steps.values()}
+        if len(num_steps) != 1:
+            raise ValueError('Every field of an episode must have the same number of steps, got {}.'.format(
+                {k: len(v) for k, v in steps.items()}))
+
+        for k, v in steps.items():
+            if k in self._frame_offsets:
+                for frame in v:
+                    encoded = _encode_frame(frame, self._image_format, self._jpeg_quality)
+                    encoded.tofile(self._files[k])
+                    self._frame_offsets[k].append(self._frame_offsets[k][-1] + encoded.size)
+            else:
+                np.ascontiguousarray(v).tofile(self._files[k])
+        self._episode_offsets.append(self._episode_offsets[-1] + num_steps.pop())
+
+    def close(self) -> Dict[str, Any]:
+        """Closes the files of the shard and returns its meta data."""
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+        np.save(os.path.join(self._path, _EPISODE_OFFSETS), np.array(self._episode_offsets, dtype=np.int64))
+        for k, offsets in self._frame_offsets.items():
+            np.save(os.path.join(self._path, _frame_offsets_file(k)), np.array(offsets, dtype=np.int64))
+        meta = {
+            'fields': self._fields,
+            'num_steps': self._episode_offsets[-1],
+            'num_episodes': len(self._episode_offsets) - 1,
+        }
+        with open(os.path.join(self._path, _META), 'w') as f:
+            json.dump(meta, f)
+        return meta
+
+
+def _convert_shard(dataset_name: str, builder_dir: str, output_dir: str, image_size: Optional[Tuple[int, int]],
+                   image_format: Optional[str], num_shards: int, shard_index: int) -> Dict[str, Any]:
+    # Runs in a worker process. tensorflow is imported here so that reading a store doesn't need it.
+    import functools
+
+    import tensorflow as tf
+    import tensorflow_datasets as tfds
+    from rlds import rlds_types
+
+    from data.step_map_fn import STEP_MAP_FNS
+
+    tf.config.set_visible_devices([], 'GPU')
+    step_map_fn = STEP_MAP_FNS[dataset_name]
+    if image_size is not None:
+        step_map_fn = functools.partial(step_map_fn, target_height=image_size[0], target_width=image_size[1])
+
+    episodes = tfds.builder_from_directory(builder_dir=builder_dir).as_dataset(split='train')
+    episodes = episodes.shard(num_shards, shard_index)
+    name = 'shard-{:05d}'.format(shard_index)
+    writer = ShardWriter(os.path.join(output_dir, name), image_format=image_format)
+    for episode in episodes:
+        steps = [_flatten(tf.nest.map_structure(lambda x: x.numpy(), step))
+                 for step in episode[rlds_types.STEPS].map(step_map_fn, num_parallel_calls=tf.data.AUTOTUNE)]
+        if not steps:
+            continue
+        writer.append_episode(OrderedDict((k, np.stack([step[k] for step in steps])) for k in steps[0]))
+    meta = writer.close()
+    meta['name'] = name
+    return meta
+
+
+def convert_dataset(dataset_name: str, builder_dir: str, output_dir: str,
+                    image_size: Optional[Tuple[int, int]] = None, image_format: Optional[str] = None,
+                    num_shards: int = 16, num_workers: int = 8):
+    """Writes the steps of a TFDS dataset to a store.
+
+    Args:
+        dataset_name: Name of the dataset in data.step_map_fn.STEP_MAP_FNS.
+        builder_dir: Directory of the TFDS dataset.
+        output_dir: Directory of the store.
+        image_size: (height, width) of the images. Defaults to TARGET_HEIGHT and TARGET_WIDTH of step_map_fn.
+        image_format: None, 'jpeg' or 'png'. If given, images are stored compressed in this format.
+        num_shards: Number of shards. Each shard is written by one worker process.
+        num_workers: Number of worker processes.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # tensorflow is not fork-safe, so workers are spawned.
+    with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(_convert_shard, dataset_name, builder_dir, output_dir, image_size, image_format,
+                                   num_shards, i)
+                   for i in range(num_shards)]
+        shards = [future.result() for future in futures]
+
+    write_meta(output_dir, shards, dataset_name=dataset_name, image_size=image_size)
+
+
+def write_meta(output_dir: str, shards: list, dataset_name: Optional[str] = None,
+               image_size: Optional[Tuple[int, int]] = None):
+    """Writes meta.json of a store from the meta data of its shards.
+
+    meta.json is written last, so a store is only readable once every shard is complete.
+
+    Args:
+        output_dir: Directory of the store.
+        shards: Meta data returned by ShardWriter.close with the directory name of the shard as 'name'.
+    """
+    fields = next((shard['fields'] for shard in shards if shard['fields'] is not None), None)
+    for shard in shards:
+        if shard['fields'] is not None and shard['fields'] != fields:
+            raise ValueError('Fields of {} do not match the other shards.'.format(shard['name']))
+    meta = {
+        'format_version': _FORMAT_VERSION,
+        'dataset_name': dataset_name,
+        'image_size': list(image_size) if image_size is not None else None,
+        'fields': fields,
+        'shards': [{k: shard[k] for k in ('name', 'num_steps', 'num_episodes')} for shard in shards],
+    }
+    with open(os.path.join(output_dir, _META), 'w') as f:
+        json.dump(meta, f)
+
+
+class TrajectoryStore(object):
+    """Reads steps of a store from memory-mapped files."""
+
+    # decode_threads: Number of threads that decode compressed frames. 0 or 1 decodes them in the calling thread.
+    def __init__(self, root: str, decode_threads: int = 4):
+        with open(os.path.join(root, _META)) as f:
+            meta = json.load(f)
+        if meta['format_version'] != _FORMAT_VERSION:
+            raise ValueError('Unsupported store format version: {}'.format(meta['format_version']))
+        self._root = root
+        self._meta = meta
+        self._fields = OrderedDict((k, (np.dtype(v['dtype']), tuple(v['shape'])))
+                                   for k, v in (meta['fields'] or {}).items())
+        self._formats = {k: v.get('format') for k, v in (meta['fields'] or {}).items()}
+        self._shard_names = [shard['name'] for shard in meta['shards']]
+
+        # Shard and first step in the shard of each episode.
+        episode_shard, episode_begin, episode_lengths = [], [], []
+        for i, name in enumerate(self._shard_names):
+            offsets = np.load(os.path.join(root, name, _EPISODE_OFFSETS))
+            episode_shard.append(np.full(len(offsets) - 1, i, dtype=np.int64))
+            episode_begin.append(offsets[:-1])
+            episode_lengths.append(np.diff(offsets))
+        self._episode_shard = np.concatenate(episode_shard) if episode_shard else np.zeros(0, dtype=np.int64)
+        self._episode_begin = np.concatenate(episode_begin) if episode_begin else np.zeros(0, dtype=np.int64)
+        self._episode_lengths = np.concatenate(episode_lengths) if episode_lengths else np.zeros(0, dtype=np.int64)
+        # Memory maps and the decode threads are created on first use in each process.
+        self._arrays = {}
+        self._decode_threads = decode_threads
+        self._decode_pool = None
+        # Process that created _decode_pool. The threads of the pool don't exist in a forked process.
+        self._decode_pool_pid = None
+
+    # Memory maps and threads are not pickled, e.g. into DataLoader workers. Each worker creates its own.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = {}
+        state['_decode_pool'] = None
+        return state
+
+    def close(self):
+        """Shuts down the decode threads and drops the memory maps. Reading the store again recreates them."""
+        # A forked process doesn't own the pool of its parent.
+        if self._decode_pool is not None and self._decode_pool_pid == os.getpid():
+            self._decode_pool.shutdown(wait=False)
+        self._decode_pool = None
+        self._arrays = {}
+
+    def __enter__(self) -> 'TrajectoryStore':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        # __init__ may have failed before the pool was set.
+        if hasattr(self, '_decode_pool'):
+            self.close()
+
+    @property
+    def meta(self) -> Dict[str, Any]:
+        return self._meta
+
+    @property
+    def fields(self) -> Dict[str, Tuple[np.dtype, Tuple[int, ...]]]:
+        return self._fields
+
+    @property
+    def num_episodes(self) -> int:
+        return len(self._episode_lengths)
+
+    @property
+    def episode_lengths(self) -> np.ndarray:
+        return self._episode_lengths
+
+    def _array(self, shard: int, key: str) -> np.ndarray:
+        array = self._arrays.get((shard, key))
+        if array is None:
+            dtype, shape = self._fields[key]
+            name = self._shard_names[shard]
+            num_steps = self._meta['shards'][shard]['num_steps']
+            if self._formats[key] is None:
+                array = np.memmap(os.path.join(self._root, name, _field_file(key)), dtype=dtype, mode='r',
+                                  shape=(num_steps,) + shape)
+            else:
+                # Bytes of the encoded frames.
+                array = np.memmap(os.path.join(self._root, name, _field_file(key)), dtype=np.uint8, mode='r')
+            self._arrays[(shard, key)] = array
+        return array
+
+    def _frame_offsets(self, shard: int, key: str) -> np.ndarray:
+        offsets = self._arrays.get((shard, key, 'offsets'))
+        if offsets is None:
+            offsets = np.load(os.path.join(self._root, self._shard_names[shard], _frame_offsets_file(key)))
+            self._arrays[(shard, key, 'offsets')] = offsets
+        return offsets
+
+    # Decodes frames of steps of a shard into one array.
+    def _decode(self, shard: int, key: str, steps: np.ndarray) -> np.ndarray:
+        dtype, shape = self._fields[key]
+        data = self._array(shard, key)
+        offsets = self._frame_offsets(shard, key)
+        decode = decode_jpeg if self._formats[key] == 'jpeg' else decode_png
+        frames = np.empty((len(steps),) + shape, dtype=dtype)
+
+        def decode_frame(i):
+            step = steps[i]
+            # The encoded frame is copied out of the read-only memory map.
+            frame = decode(torch.from_numpy(np.array(data[offsets[step]:offsets[step + 1]])))
+            torch.from_numpy(frames[i]).copy_(frame.view(shape))
+
+        if self._decode_threads > 1 and len(steps) > 1:
+            if self._decode_pool is None or self._decode_pool_pid != os.getpid():
+                self._decode_pool = ThreadPoolExecutor(self._decode_threads)
+                self._decode_pool_pid = os.getpid()
+            list(self._decode_pool.map(decode_frame, range(len(steps))))
+        else:
+            for i in range(len(steps)):
+                decode_frame(i)
+        return frames
+
+    def read(self, episode: int, start: int, stop: int, step: int = 1, keys=None) -> Dict[str, np.ndarray]:
+        """Returns a flat dict of steps [start, stop) with a stride of step of an episode.
+
+        The arrays are copies, so they are writable and don't keep the files mapped.
+        """
+        shard = self._episode_shard[episode]
+        begin = self._episode_begin[episode]
+        if not 0 <= start <= stop <= self._episode_lengths[episode]:
+            raise IndexError('Steps [{}, {}) are out of episode {} of length {}.'.format(
+                start, stop, episode, self._episode_lengths[episode]))
+        steps = OrderedDict()
+        for k in (self._fields if keys is None else keys):
+            if self._formats[k] is None:
+                steps[k] = np.array(self._array(shard, k)[begin + start:begin + stop:step])
+            else:
+                steps[k] = self._decode(shard, k, np.arange(begin + start, begin + stop, step))
+        return steps
+
+    def read_window(self, episode: int, start: int, time_sequence_length: int,
+                    action_chunk_size: int = 1) -> Dict[str, Any]:
+        """Returns a trajectory in the layout of build_dataset as a nested dict of torch tensors.
+
+        Like n_step_pattern_builder, the trajectory spans time_sequence_length * action_chunk_size steps from start.
+        Every field is taken at every action_chunk_size-th step, except actions, which are taken at every step and
+        reshaped into (time_sequence_length, action_chunk_size, ...) if action_chunk_size > 1.
+        """
+        stop = start + time_sequence_length * action_chunk_size
+        action_keys = [k for k in self._fields if k.startswith('action/')]
+        other_keys = [k for k in self._fields if not k.startswith('action/')]
+        trajectory = self.read(episode, start, stop, action_chunk_size, other_keys)
+        actions = self.read(episode, start, stop, 1, action_keys)
+        if action_chunk_size > 1:
+            actions = OrderedDict((k, v.reshape((time_sequence_length, action_chunk_size) + v.shape[1:]))
+                                  for k, v in actions.items())
+        trajectory.update(actions)
+        return _unflatten(OrderedDict((k, torch.from_numpy(trajectory[k])) for k in self._fields))
+
+
+class WindowIndex(object):
+    """(episode, start) of every trajectory of a store.
+
+    A trajectory spans time_sequence_length * action_chunk_size steps and never crosses an episode boundary, like
+    the trajectories of build_dataset. The index only depends on the episode lengths, so trajectories of another
+    length need a new index but not a new store.
+    """
+
+    def __init__(self, episode_lengths: np.ndarray, time_sequence_length: int, action_chunk_size: int = 1):
+        episode_lengths = np.asarray(episode_lengths, dtype=np.int64)
+        window = time_sequence_length * action_chunk_size
+        num_windows = np.maximum(episode_lengths - window + 1, 0)
+        first_windows = np.cumsum(num_windows) - num_windows
+        self._episodes = np.repeat(np.arange(len(episode_lengths), dtype=np.int32), num_windows)
+        self._starts = (np.arange(self._episodes.size, dtype=np.int64) - np.repeat(first_windows, num_windows)
+                        ).astype(np.int32)
+
+    def __len__(self):
+        return self._episodes.size
+
+    def __getitem__(self, idx) -> Tuple[int, int]:
+        return int(self._episodes[idx]), int(self._starts[idx])
+
+    @property
+    def episodes(self) -> np.ndarray:
+        return self._episodes
+
+    @property
+    def starts(self) -> np.ndarray:
+        return self._starts
+
+
+class TrajectoryDataset(Dataset):
+    """Trajectories of every step of every episode of a store, like build_dataset without shuffling.
+
+    Frames are only read when a trajectory is indexed. Use WindowSampler to shuffle the trajectories.
+    """
+
+    def __init__(self, root: str, time_sequence_length: int = 6, action_chunk_size: int = 1,
+                 decode_threads: int = 4):
+        self._store = TrajectoryStore(root, decode_threads=decode_threads)
+        self._time_sequence_length = time_sequence_length
+        self._action_chunk_size = action_chunk_size
+        self._window_index = WindowIndex(self._store.episode_lengths, time_sequence_length, action_chunk_size)
+
+    @property
+    def store(self) -> TrajectoryStore:
+        return self._store
+
+    def close(self):
+        """Closes the store. See TrajectoryStore.close."""
+        self._store.close()
+
+    def __enter__(self) -> 'TrajectoryDataset':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def window_index(self) -> WindowIndex:
+        return self._window_index
+
+    def __len__(self):
+        return len(self._window_index)
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < len(self):
+            raise IndexError('Index {} is out of range of {} trajectories.'.format(idx, len(self)))
+        episode, start = self._window_index[idx]
+        return self._store.read_window(episode, start, self._time_sequence_length, self._action_chunk_size)
+
+
+class WindowSampler(Sampler):
+    """Samples trajectories of a dataset uniformly without replacement, like DistributedSampler.
+
+    Each epoch is a permutation of all trajectories seeded by (seed, epoch), so every rank draws the same permutation
+    and reads every world_size-th trajectory of it. Unlike the shuffle buffer of build_dataset, which holds whole
+    trajectories, the permutation is an array of len(dataset) integers. Call set_epoch before each epoch.
+
+    With weights, the dataset is a ConcatDataset of groups, e.g. stores, of group_sizes trajectories. Each sample
+    picks a group by weight and then the next trajectory of a permutation of the group, so groups are mixed by
+    weight rather than by size. A group is permuted again once all of its trajectories were drawn.
+    """
+
+    def __init__(self, num_samples: int, seed: int = 0, rank: Optional[int] = None,
+                 world_size: Optional[int] = None, group_sizes: Optional[Sequence[int]] = None,
+                 weights: Optional[Sequence[float]] = None):
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        if rank is None:
+            rank = torch.distributed.get_rank() if distributed else 0
+        if world_size is None:
+            world_size = torch.distributed.get_world_size() if distributed else 1
+        if not 0 <= rank < world_size:
+            raise ValueError('Invalid rank {} of world size {}.'.format(rank, world_size))
+        if (group_sizes is None) != (weights is None):
+            raise ValueError('group_sizes and weights must be given together.')
+        if weights is not None:
+            if len(group_sizes) != len(weights) or sum(group_sizes) != num_samples:
+                raise ValueError('group_sizes {} and weights {} do not match {} samples.'.format(
+                    list(group_sizes), list(weights), num_samples))
+            weights = np.array(weights, dtype=np.float64) * (np.array(group_sizes) > 0)
+            if np.any(weights < 0) or not np.any(weights > 0):
+                raise ValueError('weights of non-empty groups must be non-negative and not all zero, got {}.'.format(
+                    list(weights)))
+            self._group_sizes = np.array(group_sizes, dtype=np.int64)
+            self._weights = weights / weights.sum()
+        else:
+            self._group_sizes = None
+            self._weights = None
+        self._num_samples = num_samples
+        self._seed = seed
+        self._rank = rank
+        self._world_size = world_size
+        self._epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self._epoch = epoch
+
+    # Samples of this rank. The last num_samples % world_size samples of the permutation are dropped, so that every
+    # rank has the same number of steps.
+    def __len__(self):
+        return self._num_samples // self._world_size
+
+    # Indices of an epoch, which are the same on every rank.
+    def _epoch_indices(self) -> np.ndarray:
+        rng = np.random.default_rng((self._seed, self._epoch))
+        if self._weights is None:
+            return rng.permutation(self._num_samples)
+        groups = rng.choice(len(self._weights), size=self._num_samples, p=self._weights)
+        offsets = np.concatenate([[0], np.cumsum(self._group_sizes)[:-1]])
+        indices = np.empty(self._num_samples, dtype=np.int64)
+        for group in np.flatnonzero(self._weights):
+            positions = np.flatnonzero(groups == group)
+            if not positions.size:
+                continue
+            size = self._group_sizes[group]
+            num_permutations = -(-len(positions) // size)
+            group_indices = np.concatenate([rng.permutation(size) for _ in range(num_permutations)])
+            indices[positions] = offsets[group] + group_indices[:len(positions)]
+        return indices
+
+    def __iter__(self):
+        indices = self._epoch_indices()
+        for idx in indices[self._rank:len(self) * self._world_size:self._world_size]:
+            yield int(idx)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dataset_name', required=True, help='One of data.step_map_fn.STEP_MAP_FNS.')
+    parser.add_argument('--builder_dir', required=True, help='Directory of the TFDS dataset.')
+    parser.add_argument('--output_dir', required=True, help='Directory of the store.')
+    parser.add_argument('--image_size', type=int, nargs=2, default=None, help='Height and width of the images.')
+    parser.add_argument('--image_format', choices=_IMAGE_FORMATS, default=None,
+                        help='Store images compressed in this format.')
+    parser.add_argument('--num_shards', type=int, default=16)
+    parser.add_argument('--num_workers', type=int, default=8)
+    args = parser.parse_args()
+    convert_dataset(args.dataset_name, args.builder_dir, args.output_dir, image_size=args.image_size,
+                    image_format=args.image_format, num_shards=args.num_shards, num_workers=args.num_workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""Tests for trajectory_store."""
+
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+from absl.testing import parameterized
+
+from data.trajectory_store import ShardWriter
+from data.trajectory_store import TrajectoryDataset
+from data.trajectory_store import WindowIndex
+from data.trajectory_store import WindowSampler
+from data.trajectory_store import write_meta
+
+
+# Steps of an episode with step index i in every field, so that a read step can be checked by its value.
+def make_episode(episode_id, length):
+    steps = np.arange(length)
+    return {
+        'observation': {
+            'image': np.broadcast_to(steps[:, None, None, None], (length, 3, 4, 5)).astype(np.uint8),
+            'natural_language_embedding': np.full((length, 8), episode_id, dtype=np.float32),
+        },
+        'action': {
+            'first_three': np.stack([steps] * 3, axis=1).astype(np.float32),
+            'final_one': steps[:, None].astype(np.float32),
+        },
+        'is_first': steps == 0,
+        'is_last': steps == length - 1,
+    }
+
+
+class TrajectoryStoreTest(parameterized.TestCase, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self._directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self._directory.cleanup)
+        self._root = self._directory.name
+        # Episode lengths of each shard. The last shard has no episode.
+        self._episode_lengths = [[5, 2, 7], [6], []]
+        shards = []
+        episode_id = 0
+        for i, lengths in enumerate(self._episode_lengths):
+            name = 'shard-{:05d}'.format(i)
+            writer = ShardWriter(os.path.join(self._root, name))
+            for length in lengths:
+                writer.append_episode(make_episode(episode_id, length))
+                episode_id += 1
+            meta = writer.close()
+            meta['name'] = name
+            shards.append(meta)
+        write_meta(self._root, shards, dataset_name='test', image_size=(4, 5))
+
+    @parameterized.named_parameters(
+        ('single_action', 3, 1),
+        ('action_chunk', 2, 2))
+    def testWindows(self, time_sequence_length, action_chunk_size):
+        dataset = TrajectoryDataset(self._root, time_sequence_length=time_sequence_length,
+                                    action_chunk_size=action_chunk_size)
+        window = time_sequence_length * action_chunk_size
+        lengths = [length for lengths in self._episode_lengths for length in lengths]
+        self.assertLen(dataset, sum(max(length - window + 1, 0) for length in lengths))
+        self.assertEqual(dataset.store.num_episodes, len(lengths))
+
+        expected = [(episode, start) for episode, length in enumerate(lengths)
+                    for start in range(length - window + 1)]
+        for idx, (episode, start) in enumerate(expected):
+            trajectory = dataset[idx]
+            steps = start + np.arange(time_sequence_length) * action_chunk_size
+            self.assertEqual(list(trajectory['observation']['image'].shape), [time_sequence_length, 3, 4, 5])
+            self.assertEqual(trajectory['observation']['image'].dtype, torch.uint8)
+            np.testing.assert_array_equal(trajectory['observation']['image'][:, 0, 0, 0].numpy(), steps)
+            np.testing.assert_array_equal(trajectory['observation']['natural_language_embedding'][:, 0].numpy(),
+                                          np.full(time_sequence_length, episode))
+            np.testing.assert_array_equal(trajectory['is_first'].numpy(), steps == 0)
+
+            first_three = trajectory['action']['first_three']
+            if action_chunk_size > 1:
+                self.assertEqual(list(first_three.shape), [time_sequence_length, action_chunk_size, 3])
+            else:
+                self.assertEqual(list(first_three.shape), [time_sequence_length, 3])
+            np.testing.assert_array_equal(first_three[..., 0].numpy().reshape(-1), start + np.arange(window))
+
+        with self.assertRaises(IndexError):
+            dataset[len(dataset)]
+
+    def testPickle(self):
+        dataset = TrajectoryDataset(self._root, time_sequence_length=2)
+        trajectory = dataset[3]
+        unpickled_dataset = pickle.loads(pickle.dumps(dataset))
+        unpickled_trajectory = unpickled_dataset[3]
+        torch.testing.assert_close(unpickled_trajectory['observation']['image'], trajectory['observation']['image'])
+
+    @parameterized.named_parameters(
+        ('png', 'png', 0),
+        ('jpeg', 'jpeg', 2),
+        ('jpeg_without_threads', 'jpeg', 0))
+    def testCompressedFrames(self, image_format, decode_threads):
+        root, episodes = self._write_compressed_store(image_format)
+        dataset = TrajectoryDataset(root, time_sequence_length=3, decode_threads=decode_threads)
+        self.assertEqual(dataset.store.meta['fields']['observation/image']['format'], image_format)
+        self.assertLen(dataset, 2 + 4)
+        for idx, (episode, start) in enumerate([(0, 0), (0, 1), (1, 0), (1, 1), (1, 2), (1, 3)]):
+            image = dataset[idx]['observation']['image']
+            expected = episodes[episode]['observation']['image'][start:start + 3]
+            self.assertEqual(image.dtype, torch.uint8)
+            if image_format == 'png':
+                np.testing.assert_array_equal(image.numpy(), expected)
+            else:
+                np.testing.assert_allclose(image.numpy(), expected, atol=2)
+
+    def testDecodeThreadsInForkedWorkers(self):
+        root, _ = self._write_compressed_store('jpeg')
+        dataset = TrajectoryDataset(root, time_sequence_length=3, decode_threads=2)
+        # The decode threads of this process are started before the workers are forked.
+        expected = [dataset[idx]['observation']['image'] for idx in range(len(dataset))]
+        loader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=2,
+                                             multiprocessing_context='fork', timeout=60)
+        images = [trajectory['observation']['image'] for trajectory in loader]
+        self.assertLen(images, len(expected))
+        for image, expected_image in zip(images, expected):
+            torch.testing.assert_close(image, expected_image)
+
+    def testClose(self):
+        root, _ = self._write_compressed_store('jpeg')
+        with TrajectoryDataset(root, time_sequence_length=3, decode_threads=2) as dataset:
+            expected = dataset[0]['observation']['image']
+            decode_pool = dataset.store._decode_pool
+        self.assertIsNone(dataset.store._decode_pool)
+        with self.assertRaises(RuntimeError):
+            decode_pool.submit(int)
+        # The store can be read after it is closed.
+        torch.testing.assert_close(dataset[0]['observation']['image'], expected)
+        dataset.close()
+
+    def _write_compressed_store(self, image_format):
+        root = os.path.join(self._root, image_format)
+        name = 'shard-00000'
+        writer = ShardWriter(os.path.join(root, name), image_format=image_format)
+        episodes = [make_episode(0, 4), make_episode(1, 6)]
+        if image_format == 'png':
+            # PNG is lossless, so random frames are read back exactly.
+            rng = np.random.default_rng(0)
+            for episode in episodes:
+                episode['observation']['image'] = rng.integers(0, 256, size=(len(episode['is_first']), 3, 16, 16),
+                                                               dtype=np.uint8)
+        for episode in episodes:
+            writer.append_episode(episode)
+        meta = writer.close()
+        meta['name'] = name
+        write_meta(root, [meta])
+        return root, episodes
+
+    def testMismatchedFields(self):
+        writer = ShardWriter(os.path.join(self._root, 'mismatched'))
+        writer.append_episode(make_episode(0, 3))
+        episode = make_episode(1, 3)
+        del episode['is_last']
+        with self.assertRaises(ValueError):
+            writer.append_episode(episode)
+        writer.close()
+
+
+class WindowSamplerTest(parameterized.TestCase, unittest.TestCase):
+
+    def testWindowIndex(self):
+        window_index = WindowIndex(np.array([5, 2, 0, 7]), time_sequence_length=3)
+        self.assertEqual([window_index[i] for i in range(len(window_index))],
+                         [(0, 0), (0, 1), (0, 2), (3, 0), (3, 1), (3, 2), (3, 3), (3, 4)])
+        # A longer trajectory only needs a new index.
+        self.assertLen(WindowIndex(np.array([5, 2, 0, 7]), time_sequence_length=3, action_chunk_size=2), 2)
+
+    @parameterized.named_parameters(
+        ('single_rank', 1),
+        ('distributed', 3))
+    def testSamplesEveryWindowOnce(self, world_size):
+        num_samples = 20
+        samplers = [WindowSampler(num_samples, seed=1, rank=rank, world_size=world_size)
+                    for rank in range(world_size)]
+        indices = [list(sampler) for sampler in samplers]
+        for sampler, rank_indices in zip(samplers, indices):
+            self.assertLen(rank_indices, len(sampler))
+            self.assertLen(rank_indices, num_samples // world_size)
+        flat_indices = sum(indices, [])
+        self.assertLen(set(flat_indices), len(flat_indices))
+        self.assertTrue(all(0 <= idx < num_samples for idx in flat_indices))
+
+    def testSeedAndEpoch(self):
+        sampler = WindowSampler(100, seed=1)
+        first_epoch = list(sampler)
+        self.assertEqual(list(WindowSampler(100, seed=1)), first_epoch)
+        self.assertNotEqual(list(WindowSampler(100, seed=2)), first_epoch)
+        sampler.set_epoch(1)
+        self.assertNotEqual(list(sampler), first_epoch)
+        self.assertEqual(sorted(sampler), list(range(100)))
+
+    def testWeights(self):
+        # The second group is 4 times larger but has the same weight.
+        group_sizes = [20, 80]
+        sampler = WindowSampler(sum(group_sizes), seed=1, group_sizes=group_sizes, weights=[1., 1.])
+        indices = []
+        for epoch in range(20):
+            sampler.set_epoch(epoch)
+            indices.extend(sampler)
+        self.assertTrue(all(0 <= idx < 100 for idx in indices))
+        self.assertAlmostEqual(sum(idx < 20 for idx in indices) / len(indices), 0.5, delta=0.05)
+        # Every trajectory of the smaller group is drawn before any is drawn again.
+        sampler.set_epoch(0)
+        self.assertCountEqual([idx for idx in sampler if idx < 20][:20], range(20))
+        # Ranks read disjoint parts of the same indices.
+        ranks = [WindowSampler(100, seed=1, rank=rank, world_size=2, group_sizes=group_sizes, weights=[1., 1.])
+                 for rank in range(2)]
+        self.assertEqual(sorted(list(ranks[0]) + list(ranks[1])), sorted(sampler))
+
+        with self.assertRaises(ValueError):
+            WindowSampler(100, group_sizes=group_sizes, weights=[1.])
+        with self.assertRaises(ValueError):
+            WindowSampler(100, group_sizes=group_sizes, weights=[0., 0.])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,6 +17,9 @@
 
 # You can find the original code from here[https://github.com/google-research/robotics_transformer].
 
+from collections import OrderedDict
+from typing import Any, List, Optional, Tuple
+
 import torch
 import torch.nn as nn
 
@@ -34,10 +37,8 @@ class FilmConditioning(nn.Module):
         nn.init.constant_(self._projection_mult.weight, 0)
         nn.init.constant_(self._projection_mult.bias, 0)
 
-    # conv_filter: feature maps which corresponds to F in FiLM  paper. (B, C, H, W)
-    # conditioning: text which corresponds to x in FiLM paper. this is one vector that is created from a text, 
-    # note that this is not embedding vectors from a text. Please refer to Universal Sentence Encoder. (B, D). D = 512.
-    def forward(self, conv_filters: torch.Tensor, conditioning: torch.Tensor):
+    # conditioning: (B, D). Returns (1 + gamma, beta), both of which have size of (B, C, 1, 1).
+    def get_film_parameters(self, conditioning: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
         projected_cond_add = self._projection_add(conditioning)  # (B, D) -> (B, C)
         projected_cond_mult = self._projection_mult(conditioning)
 
@@ -47,6 +48,75 @@ class FilmConditioning(nn.Module):
         # Original FiLM paper argues that 1 + gamma centers the initialization at
         # identity transform.
         # see 7.2 section in FiLM paper
-        result = (1 + projected_cond_mult) * conv_filters + projected_cond_add
+        return 1 + projected_cond_mult, projected_cond_add
+
+    # conv_filter: feature maps which corresponds to F in FiLM  paper. (B, C, H, W)
+    # conditioning: text which corresponds to x in FiLM paper. this is one vector that is created from a text, 
+    # note that this is not embedding vectors from a text. Please refer to Universal Sentence Encoder. (B, D). D = 512.
+    # film_parameters: (1 + gamma, beta) computed in advance by get_film_parameters. If this is given, conditioning
+    # is not used.
+    def forward(self, conv_filters: torch.Tensor, conditioning: torch.Tensor,
+                film_parameters: Optional[Tuple[torch.Tensor, torch.Tensor]] = None):
+        if film_parameters is None:
+            film_parameters = self.get_film_parameters(conditioning)
+        scale, shift = film_parameters
+
+        result = scale * conv_filters + shift
 
         return result
+
+
+# FiLM whose (1 + gamma, beta) are fixed for one conditioning vector. conditioning given to forward is ignored.
+# If scale and shift are None, FiLM has been folded into the preceding convolution and this is the identity.
+class FixedFilmConditioning(nn.Module):
+    def __init__(self, scale: Optional[torch.Tensor] = None, shift: Optional[torch.Tensor] = None):
+        super().__init__()
+        # scale and shift: (C, 1, 1)
+        self.register_buffer('scale', scale)
+        self.register_buffer('shift', shift)
+
+    def forward(self, conv_filters: torch.Tensor, conditioning: Optional[torch.Tensor] = None,
+                film_parameters: Optional[Tuple[torch.Tensor, torch.Tensor]] = None):
+        if self.scale is None:
+            return conv_filters
+        return self.scale * conv_filters + self.shift
+
+
+# LRU cache keyed on a conditioning vector.
+# The natural language embedding is constant for an episode, so the projections of all FiLM layers give the same
+# (1 + gamma, beta) at every step. Each entry holds those parameters of all FiLM layers for one conditioning vector,
+# or anything else that only depends on it like a specialized encoder.
+class FilmParameterCache:
+    def __init__(self, max_size: int):
+        assert max_size > 0, "max_size should be positive."
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def keys_of(conditioning: torch.Tensor) -> List[bytes]:
+        """Returns a key for each row of conditioning (B, D)."""
+        rows = conditioning.detach().to('cpu', torch.float32).numpy()
+        return [row.tobytes() for row in rows]
+
+    def get(self, key: bytes) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: bytes, entry: Any):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)  # Discard the least recently used entry.
+
+    def clear(self):
+        self._entries.clear()
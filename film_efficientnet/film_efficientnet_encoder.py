@@ -18,12 +18,14 @@
 # You can find the original code from here[https://github.com/google-research/robotics_transformer].
 
 import copy
+import hashlib
 import json
 import math
 import os
 
 import torch
 import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from torchvision.ops import StochasticDepth
 from torchvision.ops.misc import Conv2dNormActivation
 
@@ -177,6 +179,7 @@ class MBConvBlock(nn.Module):
         self.se_ratio = se_ratio
         self.id_skip = id_skip
         self.drop_rate = drop_rate
+        self.has_skip_connection = id_skip and strides == 1 and in_size == out_size
 
         expand_size = in_size * expand_ratio
 
@@ -239,7 +242,7 @@ class MBConvBlock(nn.Module):
         x = self.block(inputs)
 
         # Dropout and skip connection
-        if self.id_skip and self.strides == 1 and self.in_size == self.out_size:
+        if self.has_skip_connection:
             if self.drop_rate > 0:
                 x = self.dropout(x)
             x = inputs + x
@@ -351,15 +354,17 @@ class EfficientNet(nn.Module):
 
     # inputs: image (bs, c, h, w)
     # context: text (bs, embedding_dim). Each vector that is created from a text, not a word.
-    def forward(self, inputs, context=None):
+    # film_parameters: optional list of (1 + gamma, beta) for each FiLM layer, which are computed in advance.
+    def forward(self, inputs, context=None, film_parameters=None):
         # stem
         outputs = self.convNormAct0(inputs)
 
         # Blocks
         if self.include_film:
-            for block, film in zip(self.blocks, self.films):
+            for i, (block, film) in enumerate(zip(self.blocks, self.films)):
                 outputs = block(outputs)  # MBConv
-                outputs = film(outputs, context)  # FiLM
+                outputs = film(outputs, context,
+                               film_parameters[i] if film_parameters is not None else None)  # FiLM
 
         else:
             for block in self.blocks:
@@ -379,11 +384,27 @@ class EfficientNet(nn.Module):
             return outputs
 
 
+    # Fold BatchNorm into the preceding convolution of every Conv2dNormActivation for inference.
+    # BatchNorm in eval mode is an affine transform per channel, so it becomes the weight and bias of the convolution.
+    # SiLU has no fused kernel in eager mode. It is fused by the backend when the model is frozen with
+    # torch.jit.freeze (see inference/export.py).
+    # The model can't be trained after this, and its state_dict has no BatchNorm anymore.
+    # So load weights before calling this.
+    @torch.no_grad()
+    def fuse_for_inference(self):
+        assert not self.training, "Call eval() before fusing BatchNorm."
+        for module in self.modules():
+            if isinstance(module, Conv2dNormActivation) and isinstance(module[1], nn.BatchNorm2d):
+                module[0] = fuse_conv_bn_eval(module[0], module[1])
+                module[1] = nn.Identity()
+        return self
+
+
 # If you use FiLM, this function allow us to load pretrained weight from naive efficientnet.
+# Only the final model is built, and FiLM layers keep their initial weights.
 def maybe_restore_with_film(*args, weights='imagenet', include_top=True, include_film=False, **kwargs):
     assert weights == None or weights == 'imagenet', "Set weights to either None or 'imagenet'."
-    # Create model without FiLM
-    n1 = EfficientNet(*args, include_top=include_top, include_film=False, **kwargs)
+    model = EfficientNet(*args, include_top=include_top, include_film=include_film, **kwargs)
 
     # Load weights.
     if weights == 'imagenet':
@@ -393,43 +414,111 @@ def maybe_restore_with_film(*args, weights='imagenet', include_top=True, include
             weights_path = os.path.join(os.path.dirname(__file__), 'efficientnet_checkpoints/efficientnetb3_notop.pth')
         # This EfficientNet differs from the official pytorch implementation only in parameter names.
         # So we load the pytorch weights in using this function.
-        n1 = load_official_pytorch_param(n1, weights_path)
-
-    # If you don't use FiLM, that's all.
-    if not include_film:
-        return n1
-
-    # Create model with FiLM if you use FiLM. And we load pretrained weights from n1.
-    n2 = EfficientNet(*args, include_top=include_top, include_film=True, **kwargs)
-    if weights == None:
-        return n2
-
-    n1_state_dict = n1.state_dict().copy()
-    n2_state_dict = n2.state_dict().copy()
+        model = load_official_pytorch_param(model, weights_path)
+    return model
 
-    for name, param in n2_state_dict.items():
-        if name in n1_state_dict:
-            n2_state_dict[name] = n1_state_dict[name]
 
-    n2.load_state_dict(n2_state_dict)
-    return n2
+# Converts a state dict of the official pytorch (torchvision) EfficientNet into parameter names of EfficientNet here.
+#   features.0.*                      -> convNormAct0.*
+#   features.{stage}.{index}.block.*  -> blocks.{n}.block.*, where n counts blocks over all stages in order
+#   features.{last stage}.*           -> convNormAct1.*
+#   classifier.1.*                    -> fc.*
+# Raises ValueError if a parameter has no counterpart in model or the shapes differ.
+def convert_official_state_dict(official_state_dict, model: nn.Module):
+    model_state_dict = model.state_dict()
+    feature_stages = [int(name.split('.')[1]) for name in official_state_dict if name.startswith('features.')]
+    last_stage = max(feature_stages)
+    block_ids = sorted({(int(name.split('.')[1]), int(name.split('.')[2])) for name in official_state_dict
+                        if name.startswith('features.') and 0 < int(name.split('.')[1]) < last_stage})
+    block_index = {block_id: n for n, block_id in enumerate(block_ids)}
+
+    converted = {}
+    errors = []
+    for name, value in official_state_dict.items():
+        parts = name.split('.')
+        if parts[0] == 'features' and int(parts[1]) == 0:
+            new_name = '.'.join(['convNormAct0'] + parts[2:])
+        elif parts[0] == 'features' and int(parts[1]) == last_stage:
+            new_name = '.'.join(['convNormAct1'] + parts[2:])
+        elif parts[0] == 'features':
+            n = block_index[(int(parts[1]), int(parts[2]))]
+            new_name = '.'.join(['blocks', str(n)] + parts[3:])
+        elif parts[0] == 'classifier' and parts[1] == '1':
+            new_name = '.'.join(['fc'] + parts[2:])
+        else:
+            errors.append('{} is not a parameter of EfficientNet.'.format(name))
+            continue
+
+        if new_name not in model_state_dict:
+            errors.append('{} (from {}) is not in the model.'.format(new_name, name))
+        elif model_state_dict[new_name].shape != value.shape:
+            errors.append('{} has shape {} in the model, but {} has shape {}.'.format(
+                new_name, tuple(model_state_dict[new_name].shape), name, tuple(value.shape)))
+        converted[new_name] = value
+
+    # Every parameter except FiLM has to be loaded.
+    for name in model_state_dict:
+        if name not in converted and not name.startswith('films.'):
+            errors.append('{} is not in the official weights.'.format(name))
+    if errors:
+        raise ValueError('Official weights do not match EfficientNet:\n' + '\n'.join(errors))
+    return converted
+
+
+# Converted weights are cached in this directory. Set RT1_CACHE_DIR to change it.
+def cache_dir():
+    return os.environ.get('RT1_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'rt1_pytorch'))
+
+
+# The cache is valid as long as the official weights file is the same.
+def _weights_file_id(weights_path):
+    stat = os.stat(weights_path)
+    return {'path': os.path.abspath(weights_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+# Names and shapes of the parameters of model that are loaded from the official weights. Models of other variants,
+# e.g. other width or depth coefficients or number of classes, have other shapes.
+def _model_signature(model: nn.Module):
+    return sorted((name, list(value.shape)) for name, value in model.state_dict().items()
+                  if not name.startswith('films.'))
+
+
+def _load_converted_state_dict(weights_path, model: nn.Module):
+    signature = _model_signature(model)
+    # Each variant has its own cache file, so that variants converted from the same file don't replace each other.
+    variant = hashlib.sha1(json.dumps(signature).encode('utf-8')).hexdigest()[:12]
+    cache_path = os.path.join(cache_dir(), '{}_{}_converted.pth'.format(
+        os.path.splitext(os.path.basename(weights_path))[0], variant))
+    file_id = _weights_file_id(weights_path)
+    if os.path.exists(cache_path):
+        cached = torch.load(cache_path, map_location='cpu', mmap=True, weights_only=True)
+        if cached['source'] == file_id and cached.get('model') == signature:
+            return cached['state_dict']
+
+    converted = convert_official_state_dict(torch.load(weights_path, map_location='cpu'), model)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Write to a temporary file first so that other processes never read a partial cache.
+        temporary_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        torch.save({'source': file_id, 'model': signature, 'state_dict': converted}, temporary_path)
+        os.replace(temporary_path, cache_path)
+    except OSError:
+        # Caching is an optimization. Read-only file systems just convert every time.
+        pass
+    return converted
 
 
 # This function helps load official pytorch efficientnet's weights.
+# The weights are converted once and the converted weights are memory-mapped from the cache afterwards.
+# Raises ValueError if the weights don't match model. Only FiLM layers may be missing.
 def load_official_pytorch_param(model: nn.Module, weights_path):
-    # load weights
-    official_state_dict = torch.load(weights_path)
-
-    film_eff_state_dict = model.state_dict().copy()
-    keys_official_list = list(official_state_dict)
-    keys_film_eff_list = list(film_eff_state_dict)
-
-    for key_official, key_film_eff in zip(keys_official_list, keys_film_eff_list):
-        film_eff_state_dict[key_film_eff] = official_state_dict[key_official]
-        # print(str(key_official) + "->" + str(key_film_eff))
-
-    # load new weights
-    model.load_state_dict(film_eff_state_dict)
+    state_dict = _load_converted_state_dict(weights_path, model)
+    missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False)
+    missing_keys = [key for key in missing_keys if not key.startswith('films.')]
+    if missing_keys or unexpected_keys:
+        raise ValueError('Official weights {} do not match EfficientNet:\n'.format(weights_path) + '\n'.join(
+            ['{} is not in the model.'.format(key) for key in unexpected_keys] +
+            ['{} is not in the official weights.'.format(key) for key in missing_keys]))
     return model
 
 
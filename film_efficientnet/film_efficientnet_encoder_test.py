@@ -18,13 +18,18 @@
 # You can find the original code from here[https://github.com/google-research/robotics_transformer].
 
 
+import os
+import tempfile
 import unittest
+from unittest import mock
 
 import torch
+import torchvision
 from absl.testing import parameterized
 from skimage import data
 from torchvision import transforms
 
+from film_efficientnet import film_efficientnet_encoder
 from film_efficientnet.film_efficientnet_encoder import EfficientNetB3, ILSVRCPredictor
 
 # If you want to run this test, move to the directory above pytorch_robotics_transformer directory, type below command
@@ -78,6 +83,80 @@ class FilmEfficientnetTest(parameterized.TestCase, unittest.TestCase):
         # print(film_preds)
         self.assertIn('tabby', film_preds)
 
+    @parameterized.parameters([True, False])
+    def test_fuse_for_inference(self, include_film):
+        fe = EfficientNetB3(include_top=True, weights=None, include_film=include_film)
+        # Randomize BatchNorm statistics so that folding them is not trivial.
+        for module in fe.modules():
+            if isinstance(module, torch.nn.BatchNorm2d):
+                module.running_mean.uniform_(-0.1, 0.1)
+                module.running_var.uniform_(0.5, 1.5)
+                torch.nn.init.uniform_(module.weight, 0.5, 1.5)
+                torch.nn.init.uniform_(module.bias, -0.1, 0.1)
+        fe.eval()
+
+        image = torch.rand(2, 3, 64, 64)
+        context = torch.rand(2, 512) if include_film else None
+        with torch.no_grad():
+            expected = fe(image, context)
+            fe.fuse_for_inference()
+            fused = fe(image, context)
+
+        self.assertFalse(any(isinstance(m, torch.nn.BatchNorm2d) for m in fe.modules()))
+        torch.testing.assert_close(fused, expected, rtol=1e-4, atol=1e-4)
+
+    @parameterized.parameters([True, False])
+    def test_load_official_pytorch_param(self, include_film):
+        official = torchvision.models.efficientnet_b3()
+        official.eval()
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.dict(os.environ, {'RT1_CACHE_DIR': os.path.join(directory, 'cache')}):
+            weights_path = os.path.join(directory, 'efficientnetb3.pth')
+            torch.save(official.state_dict(), weights_path)
+
+            fe = EfficientNetB3(include_top=True, weights=None, include_film=include_film)
+            film_efficientnet_encoder.load_official_pytorch_param(fe, weights_path)
+            cache_files = os.listdir(os.path.join(directory, 'cache'))
+            self.assertLen(cache_files, 1)
+            self.assertRegex(cache_files[0], r'^efficientnetb3_\w+_converted\.pth$')
+            # The second load reads the cache.
+            cached_fe = EfficientNetB3(include_top=True, weights=None, include_film=include_film)
+            film_efficientnet_encoder.load_official_pytorch_param(cached_fe, weights_path)
+
+        fe.eval()
+        cached_fe.eval()
+        image = torch.rand(1, 3, 64, 64)
+        with torch.no_grad():
+            expected = official(image)
+            if include_film:
+                # FiLM is the identity until it is trained.
+                self.assertTrue(all(torch.count_nonzero(p) == 0 for p in fe.films.parameters()))
+                context = torch.rand(1, 512)
+                torch.testing.assert_close(fe(image, context), expected, rtol=1e-4, atol=1e-4)
+                torch.testing.assert_close(cached_fe(image, context), expected, rtol=1e-4, atol=1e-4)
+            else:
+                torch.testing.assert_close(fe(image), expected, rtol=1e-4, atol=1e-4)
+                torch.testing.assert_close(cached_fe(image), expected, rtol=1e-4, atol=1e-4)
+
+    def test_load_official_pytorch_param_cache_of_another_variant(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.dict(os.environ, {'RT1_CACHE_DIR': os.path.join(directory, 'cache')}):
+            weights_path = os.path.join(directory, 'efficientnetb3.pth')
+            torch.save(torchvision.models.efficientnet_b3().state_dict(), weights_path)
+            film_efficientnet_encoder.load_official_pytorch_param(
+                EfficientNetB3(include_top=True, weights=None), weights_path)
+
+            # A model of another variant converts the weights again rather than loading the cache of the first one.
+            with self.assertRaises(ValueError):
+                film_efficientnet_encoder.load_official_pytorch_param(
+                    EfficientNetB3(include_top=True, weights=None, classes=10), weights_path)
+
+    def test_convert_official_state_dict_validates_shapes(self):
+        official_state_dict = torchvision.models.efficientnet_b0().state_dict()
+        fe = EfficientNetB3(include_top=True, weights=None)
+        with self.assertRaises(ValueError):
+            film_efficientnet_encoder.convert_official_state_dict(official_state_dict, fe)
+
 
 if __name__ == '__main__':
     unittest.main()
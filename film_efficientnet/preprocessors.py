@@ -21,24 +21,29 @@
 # This preprocessor is a simplified version of original code.
 # This will pad the image and crop it at a random location
 # The cropped image maintain original image size and almost full field of view.
+# Like the original code, the random crop is only applied in training. Otherwise, the image is cropped at the center,
+# which gives back the image itself.
 # Omitted preprocessor_test.py. But you can do simple test by running this code.
 
 import torch
 import torch.nn.functional as F
-from skimage import data
 import numpy as np
-import matplotlib.pyplot as plt
 
 
 # images: [B, 3 ,H, W]
 # receive images whose values is in the range [0,255]
 # -> change images values range into [0.0 ,1.0]
 # -> padding and crop image
-def convert_dtype_and_crop_images(images: torch.Tensor, ratio: float = 0.07):
+# memory_format: memory format of the returned images. torch.channels_last keeps them in NHWC order.
+def convert_dtype_and_crop_images(images: torch.Tensor, ratio: float = 0.07, training: bool = True,
+                                  memory_format: torch.memory_format = torch.contiguous_format):
     if images.dtype == torch.uint8:
         images = images / 255.
     images = images.to(torch.float32)
 
+    if not training:
+        return images.contiguous(memory_format=memory_format)
+
     _, _, height, width = images.shape
     ud_pad = int(height * ratio)
     lr_pad = int(width * ratio)
@@ -48,15 +53,17 @@ def convert_dtype_and_crop_images(images: torch.Tensor, ratio: float = 0.07):
     shif_h = torch.randint(0, 2 * ud_pad + 1, size=[])
     shif_w = torch.randint(0, 2 * lr_pad + 1, size=[])
 
-    grid_h, grid_w = torch.meshgrid(torch.arange(shif_h, shif_h + height),
-                                    torch.arange(shif_w, shif_w + width),
-                                    indexing='ij')
-    images = images[..., grid_h, grid_w]  # fancy index
+    # Slicing is a view, so the crop is copied only once when the memory format is applied.
+    images = images[..., shif_h:shif_h + height, shif_w:shif_w + width]
 
-    return images
+    return images.contiguous(memory_format=memory_format)
 
 
 if __name__ == '__main__':
+    # Only the demo needs skimage and matplotlib. Importing them at module level would slow down inference workers.
+    from skimage import data
+    import matplotlib.pyplot as plt
+
     images = data.coffee()  # ndarray
     images = np.tile(np.expand_dims(images, 0), (10, 1, 1, 1))  # batch size: 10
     images = torch.from_numpy(images).permute(0, 3, 1, 2)  # (b, h, w, c) -> (b, c, h, w)
@@ -24,12 +24,14 @@
 # Here we use 1x1 conv. [bs, 1536, 10, 10] -> [bs, 512, 10, 10]
 # then apply FiLM.
 
+import copy
+
 import torch
 import torch.nn as nn
-from typing import Optional
+from typing import List, Optional, Tuple
 
 from film_efficientnet.film_efficientnet_encoder import EfficientNetB3
-from film_efficientnet.film_conditioning_layer import FilmConditioning
+from film_efficientnet.film_conditioning_layer import FilmConditioning, FilmParameterCache, FixedFilmConditioning
 
 
 class EfficientNetEncoder(nn.Module):
@@ -38,7 +40,12 @@ class EfficientNetEncoder(nn.Module):
                  weights: Optional[str] = 'imagenet',
                  early_film: bool = True,
                  include_top: bool = False,
-                 pooling: bool = True):
+                 pooling: bool = True,
+                 # Maximum number of instructions whose FiLM parameters are cached at inference. 0 disables the cache.
+                 film_cache_size: int = 0,
+                 # Maximum number of instructions whose specialized encoders are kept. See specialize. Each one is
+                 # a copy of the encoder. 0 disables the cache.
+                 specialization_cache_size: int = 0):
         super().__init__()
 
         self.conv1x1 = nn.Conv2d(in_channels=1536,
@@ -54,17 +61,145 @@ class EfficientNetEncoder(nn.Module):
 
         self.early_film = early_film
         self._pooling = pooling
+        self._film_cache = FilmParameterCache(film_cache_size) if film_cache_size > 0 else None
+        self._specializations = (FilmParameterCache(specialization_cache_size)
+                                 if specialization_cache_size > 0 else None)
+
+    @property
+    def film_cache(self) -> Optional[FilmParameterCache]:
+        return self._film_cache
+
+    def _film_layers(self) -> List[FilmConditioning]:
+        """All FiLM layers in the order they are applied."""
+        film_layers = list(self.net.films) if self.early_film else []
+        return film_layers + [self.film_layer]
+
+    # Returns (1 + gamma, beta) of every FiLM layer for context (B, D).
+    # Parameters are looked up per row of context, and the projections only run for rows that are not cached.
+    @torch.no_grad()
+    def _cached_film_parameters(self, context: torch.Tensor) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        keys = FilmParameterCache.keys_of(context)
+        entries = {}
+        missed_rows = []
+        for row, key in enumerate(keys):
+            if key in entries:
+                continue
+            entries[key] = self._film_cache.get(key)
+            if entries[key] is None:
+                missed_rows.append(row)
+
+        if missed_rows:
+            missed_parameters = [film.get_film_parameters(context[missed_rows]) for film in self._film_layers()]
+            for i, row in enumerate(missed_rows):
+                # Each parameter of the entry has size of (C, 1, 1).
+                entry = [(scale[i], shift[i]) for scale, shift in missed_parameters]
+                self._film_cache.put(keys[row], entry)
+                entries[keys[row]] = entry
+
+        batch_size = context.shape[0]
+        if len(entries) == 1:
+            # Usually, all rows have the same instruction. Broadcast it without copying.
+            entry = entries[keys[0]]
+            return [(scale.unsqueeze(0).expand(batch_size, -1, -1, -1),
+                     shift.unsqueeze(0).expand(batch_size, -1, -1, -1)) for scale, shift in entry]
+        row_entries = [entries[key] for key in keys]
+        return [(torch.stack([entry[i][0] for entry in row_entries]),
+                 torch.stack([entry[i][1] for entry in row_entries])) for i in range(len(row_entries[0]))]
+
+    # Returns a copy of this encoder whose FiLM layers are folded for one instruction.
+    # context: (D,) or (1, D).
+    # The specialized encoder ignores context given to forward. Its weights are detached from this encoder, and
+    # it is cached per instruction until weights of this encoder change if specialization_cache_size > 0.
+    @torch.no_grad()
+    def specialize(self, context: torch.Tensor) -> 'EfficientNetEncoder':
+        assert not self.training, "Call eval() before specializing."
+        context = context.reshape(1, -1)
+        if self._specializations is None:
+            return self._fold_film(context)
+        key = FilmParameterCache.keys_of(context)[0]
+        specialized = self._specializations.get(key)
+        if specialized is None:
+            specialized = self._fold_film(context)
+            self._specializations.put(key, specialized)
+        return specialized
+
+    # With a fixed instruction, each FiLM is an affine transform per channel.
+    # - If an MBConvBlock has no skip connection, FiLM after the block is folded into the last convolution of the
+    #   block, whose BatchNorm is folded beforehand.
+    # - If an MBConvBlock has a skip connection, FiLM also scales the skip connection. It can't be folded into the
+    #   convolution, so it is kept as a constant affine transform.
+    # - The last FiLM is folded into conv1x1.
+    # Only the first block of each stage has no skip connection. In EfficientNetB3, 7 of the 26 block FiLMs and the
+    # last FiLM are folded, and the other 19 remain as FixedFilmConditioning, which still multiply-add over the
+    # feature maps. They skip the projections of the instruction like the FiLM parameter cache, though.
+    def _fold_film(self, context: torch.Tensor) -> 'EfficientNetEncoder':
+        # Caches are not copied.
+        memo = {id(self._film_cache): None, id(self._specializations): None}
+        specialized = copy.deepcopy(self, memo)
+        specialized._specializations = None
+        film_parameters = [film.get_film_parameters(context) for film in self._film_layers()]
 
-    def _encode(self, image: torch.Tensor, context: torch.Tensor) -> torch.Tensor:
+        if self.early_film:
+            specialized.net.fuse_for_inference()
+            films = []
+            for block, (scale, shift) in zip(specialized.net.blocks, film_parameters[:-1]):
+                scale, shift = scale[0], shift[0]  # (C, 1, 1)
+                if block.has_skip_connection:
+                    films.append(FixedFilmConditioning(scale, shift))
+                    continue
+                conv = block.block[-1][0]
+                conv.weight.mul_(scale.reshape(-1, 1, 1, 1))
+                conv.bias.copy_(conv.bias * scale.flatten() + shift.flatten())
+                films.append(FixedFilmConditioning())
+            specialized.net.films = nn.ModuleList(films)
+
+        scale, shift = film_parameters[-1]
+        conv1x1 = nn.Conv2d(self.conv1x1.in_channels, self.conv1x1.out_channels, kernel_size=1, stride=1, padding=0,
+                            bias=True).to(self.conv1x1.weight)
+        conv1x1.weight.copy_(self.conv1x1.weight * scale[0].reshape(-1, 1, 1, 1))
+        conv1x1.bias.copy_(shift.flatten())
+        specialized.conv1x1 = conv1x1
+        specialized.film_layer = FixedFilmConditioning()
+        return specialized
+
+    def clear_film_cache(self):
+        """Drops cached FiLM parameters and specialized encoders. Call this if weights are modified in place."""
+        if self._film_cache is not None:
+            self._film_cache.clear()
+        if self._specializations is not None:
+            self._specializations.clear()
+
+    # Cached FiLM parameters and specialized encoders are stale once weights are loaded, updated by training or
+    # moved to another device.
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.clear_film_cache()
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def train(self, mode: bool = True):
+        if mode:
+            self.clear_film_cache()
+        return super().train(mode)
+
+    def _apply(self, *args, **kwargs):
+        self.clear_film_cache()
+        return super()._apply(*args, **kwargs)
+
+    def _encode(self, image: torch.Tensor, context: torch.Tensor,
+                film_parameters: Optional[List[Tuple[torch.Tensor, torch.Tensor]]] = None) -> torch.Tensor:
         """Run the image through the efficientnet encoder."""
         if self.early_film:
-            return self.net(image, context)
+            return self.net(image, context, film_parameters=film_parameters)
         return self.net(image)
 
     def forward(self, image: torch.Tensor, context: torch.Tensor) -> torch.Tensor:
-        features = self._encode(image, context)
+        film_parameters = None
+        # The cache is only used at inference because weights change while training.
+        if self._film_cache is not None and not self.training and context is not None:
+            film_parameters = self._cached_film_parameters(context)
+
+        features = self._encode(image, context, film_parameters[:-1] if film_parameters is not None else None)
         features = self.conv1x1(features)
-        features = self.film_layer(features, context)
+        features = self.film_layer(features, context, film_parameters[-1] if film_parameters is not None else None)
 
         if not self._pooling:
             return features
@@ -24,6 +24,7 @@ import unittest
 import numpy as np
 from skimage import data
 import torch
+import torch.nn as nn
 from torchvision import transforms
 
 resize = 300
@@ -82,6 +83,64 @@ class PretrainedEfficientnetEncoderTest(unittest.TestCase):
 
         self.assertIn('tabby', predicted_names)
 
+    def test_film_cache(self):
+        """Test that cached FiLM parameters give the same tokens as the projections."""
+        torch.manual_seed(0)
+        model = eff.EfficientNetEncoder(weights=None, pooling=False, film_cache_size=2)
+        # FiLM projections are initialized with zeros. Randomize them so that the context matters.
+        for film in model._film_layers():
+            nn.init.normal_(film._projection_add.weight, std=0.01)
+            nn.init.normal_(film._projection_mult.weight, std=0.01)
+        uncached_model = eff.EfficientNetEncoder(weights=None, pooling=False)
+        uncached_model.load_state_dict(model.state_dict())
+        model.eval()
+        uncached_model.eval()
+
+        image = torch.rand(4, 3, 64, 64)
+        context = torch.rand(2, 512)
+        context = torch.cat([context[0:1], context[0:1], context[1:2], context[0:1]])  # two instructions
+
+        with torch.no_grad():
+            expected = uncached_model(image, context)
+            preds_miss = model(image, context)
+            preds_hit = model(image, context)
+            preds_single = model(image[:1], context[:1])
+
+        self.assertEqual(len(model.film_cache), 2)
+        self.assertEqual(model.film_cache.misses, 2)
+        self.assertEqual(model.film_cache.hits, 3)
+        torch.testing.assert_close(preds_miss, expected)
+        torch.testing.assert_close(preds_hit, expected)
+        torch.testing.assert_close(preds_single, expected[:1])
+
+        # Loading weights invalidates the cache.
+        model.load_state_dict(uncached_model.state_dict())
+        self.assertEqual(len(model.film_cache), 0)
+
+    def test_specialize(self):
+        """Test that the specialized encoder gives the same tokens as the FiLM layers."""
+        torch.manual_seed(0)
+        model = eff.EfficientNetEncoder(weights=None, pooling=False, specialization_cache_size=1)
+        for film in model._film_layers():
+            nn.init.normal_(film._projection_add.weight, std=0.01)
+            nn.init.normal_(film._projection_mult.weight, std=0.01)
+        model.eval()
+
+        image = torch.rand(2, 3, 64, 64)
+        context = torch.rand(512)
+        with torch.no_grad():
+            expected = model(image, torch.tile(context.unsqueeze(0), (2, 1)))
+            specialized = model.specialize(context)
+            preds = specialized(image, None)
+
+        torch.testing.assert_close(preds, expected, rtol=1e-4, atol=1e-4)
+        self.assertIs(model.specialize(context), specialized)
+        self.assertIsNot(model.specialize(torch.rand(512)), specialized)
+        self.assertIsNot(model.specialize(context), specialized)
+        self.assertFalse(any(isinstance(m, nn.BatchNorm2d) for m in specialized.modules()))
+        # Weights of the original encoder are untouched.
+        self.assertTrue(any(isinstance(m, nn.BatchNorm2d) for m in model.modules()))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,117 @@
+"""Weights-only policy artifact of TransformerNetwork.
+
+A training checkpoint has optimizer and scheduler states, and the network has to be rebuilt from config.json and
+an action space written in code, which first initializes every weight and loads ImageNet weights into EfficientNet.
+An artifact has only what inference needs in one file:
+    - the arguments of TransformerNetwork (TransformerNetwork.get_config)
+    - the observation and action spaces
+    - the state dict, optionally in float16 or bfloat16
+load_artifact builds the network on the meta device, so no weight is initialized, and memory-maps the tensors of the
+file into it.
+
+Usage:
+    save_artifact(network, 'policy.pt', dtype=torch.bfloat16)
+    network = load_artifact('policy.pt')
+"""
+
+import json
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import numpy as np
+import torch
+from gym import spaces
+
+from transformer_network import TransformerNetwork
+
+_FORMAT_VERSION = 1
+
+
+def space_to_dict(space: spaces.Space) -> Dict[str, Any]:
+    """Converts a gym space into a json serializable dict."""
+    if isinstance(space, spaces.Dict):
+        # A list of pairs keeps the order of the spaces.
+        return {'type': 'Dict', 'spaces': [[k, space_to_dict(v)] for k, v in space.spaces.items()]}
+    if isinstance(space, spaces.Box):
+        return {'type': 'Box', 'low': space.low.tolist(), 'high': space.high.tolist(), 'shape': list(space.shape),
+                'dtype': str(space.dtype)}
+    if isinstance(space, spaces.Discrete):
+        return {'type': 'Discrete', 'n': int(space.n)}
+    if isinstance(space, spaces.MultiDiscrete):
+        return {'type': 'MultiDiscrete', 'nvec': space.nvec.tolist()}
+    raise ValueError('Unsupported space: {}'.format(space))
+
+
+def space_from_dict(space: Dict[str, Any]) -> spaces.Space:
+    """Inverse of space_to_dict."""
+    if space['type'] == 'Dict':
+        return spaces.Dict(OrderedDict([(k, space_from_dict(v)) for k, v in space['spaces']]))
+    if space['type'] == 'Box':
+        dtype = np.dtype(space['dtype'])
+        return spaces.Box(low=np.array(space['low'], dtype=dtype), high=np.array(space['high'], dtype=dtype),
+                          shape=tuple(space['shape']), dtype=dtype)
+    if space['type'] == 'Discrete':
+        return spaces.Discrete(space['n'])
+    if space['type'] == 'MultiDiscrete':
+        return spaces.MultiDiscrete(np.array(space['nvec']))
+    raise ValueError('Unsupported space type: {}'.format(space['type']))
+
+
+def save_artifact(network: TransformerNetwork, path: str, dtype: Optional[torch.dtype] = None):
+    """Saves network as an artifact.
+
+    Args:
+        network: TransformerNetwork to save.
+        path: File to save the artifact.
+        dtype: If given, floating point tensors are stored in this dtype, e.g. torch.float16 or torch.bfloat16.
+    """
+    state_dict = OrderedDict()
+    for k, v in network.state_dict().items():
+        v = v.detach().cpu()
+        if dtype is not None and v.is_floating_point():
+            v = v.to(dtype)
+        state_dict[k] = v
+    # Everything except tensors is json, so that the artifact can be loaded with weights_only=True.
+    torch.save({
+        'format_version': _FORMAT_VERSION,
+        'config': json.dumps(network.get_config()),
+        'input_tensor_space': json.dumps(space_to_dict(network._input_tensor_space)),
+        'output_tensor_space': json.dumps(space_to_dict(network._output_tensor_space)),
+        'state_dict': state_dict,
+    }, path)
+
+
+def load_artifact(path: str, device: str = 'cpu', dtype: Optional[torch.dtype] = torch.float32,
+                  mmap: bool = True) -> TransformerNetwork:
+    """Loads a network in eval mode from an artifact.
+
+    Args:
+        path: File of the artifact.
+        device: Device of the network.
+        dtype: Floating point tensors are cast to this dtype. None keeps the dtype of the artifact.
+            Tensors stay memory-mapped on CPU only if they are not cast.
+        mmap: If True, tensors are memory-mapped from the file instead of being read into memory.
+    """
+    artifact = torch.load(path, map_location='cpu', mmap=mmap, weights_only=True)
+    if artifact['format_version'] != _FORMAT_VERSION:
+        raise ValueError('Unsupported artifact format version: {}'.format(artifact['format_version']))
+
+    # Parameters on the meta device have no storage, so building the network initializes nothing.
+    with torch.device('meta'):
+        network = TransformerNetwork(
+            input_tensor_space=space_from_dict(json.loads(artifact['input_tensor_space'])),
+            output_tensor_space=space_from_dict(json.loads(artifact['output_tensor_space'])),
+            efficientnet_weights=None,
+            **json.loads(artifact['config']))
+    # The attention mask is not in the artifact. It is made on CPU by the network itself.
+    network.load_state_dict(artifact['state_dict'], assign=True)
+
+    if dtype is not None:
+        network.to(dtype)
+    network.to(device)
+    if network.get_config()['channels_last']:
+        # load_state_dict(assign=True) replaces the channels_last weights of the image tokenizer by the tensors of
+        # the artifact, whose layout may differ.
+        network._image_tokenizer.to(memory_format=torch.channels_last)
+    network.eval()
+    return network
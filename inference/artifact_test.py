@@ -0,0 +1,95 @@
+"""Tests for artifact."""
+
+import os
+import tempfile
+import unittest
+
+from absl.testing import parameterized
+import torch
+
+import transformer_network
+from inference.artifact import load_artifact
+from inference.artifact import save_artifact
+from inference.utils import zero_network_state
+from transformer_network_test_set_up import HEIGHT
+from transformer_network_test_set_up import TIME_SEQUENCE_LENGTH
+from transformer_network_test_set_up import TransformerNetworkTestUtils
+from transformer_network_test_set_up import WIDTH
+
+
+class ArtifactTest(TransformerNetworkTestUtils):
+    def testLoadedNetworkMatchesNetwork(self):
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH,
+            crop_size=(128, 160),
+            action_chunk_size=2)
+        network.eval()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'policy.pt')
+            save_artifact(network, path)
+            loaded_network = load_artifact(path)
+
+            self.assertEqual(network.get_config(), loaded_network.get_config())
+            self.assertEqual(list(self._action_space.keys()), list(loaded_network._output_tensor_space.keys()))
+            self.assertFalse(loaded_network.training)
+
+            network_state = zero_network_state(network)
+            loaded_network_state = zero_network_state(loaded_network)
+            with torch.no_grad():
+                for _ in range(TIME_SEQUENCE_LENGTH + 1):
+                    observation = {
+                        'image': torch.rand(1, 3, HEIGHT, WIDTH),
+                        'natural_language_embedding': torch.rand(1, self.token_embedding_size),
+                    }
+                    _, network_state = network(observation, network_state)
+                    _, loaded_network_state = loaded_network(observation, loaded_network_state)
+                    torch.testing.assert_close(loaded_network.get_aux_info()['action_predictions_logits'],
+                                               network.get_aux_info()['action_predictions_logits'],
+                                               rtol=1e-5, atol=1e-5)
+
+    @parameterized.named_parameters(('float16', torch.float16), ('bfloat16', torch.bfloat16))
+    def testReducedPrecision(self, dtype):
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'policy.pt')
+            save_artifact(network, path, dtype=dtype)
+            loaded_network = load_artifact(path, dtype=None)
+            upcast_network = load_artifact(path)
+
+            state_dict = network.state_dict()
+            for k, v in loaded_network.state_dict().items():
+                if v.is_floating_point():
+                    self.assertEqual(v.dtype, dtype)
+                    torch.testing.assert_close(v, state_dict[k].to(dtype))
+                    self.assertEqual(upcast_network.state_dict()[k].dtype, torch.float32)
+                else:
+                    torch.testing.assert_close(v, state_dict[k])
+
+    def testChannelsLast(self):
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH,
+            channels_last=True)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'policy.pt')
+            save_artifact(network, path)
+            loaded_network = load_artifact(path)
+
+        conv_weights = [m.weight for m in loaded_network._image_tokenizer.modules()
+                        if isinstance(m, torch.nn.Conv2d)]
+        self.assertNotEmpty(conv_weights)
+        for weight in conv_weights:
+            self.assertTrue(weight.is_contiguous(memory_format=torch.channels_last))
+
+
+if __name__ == '__main__':
+    unittest.main()
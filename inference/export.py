@@ -0,0 +1,209 @@
+"""Exports TransformerNetwork as a frozen inference-only module.
+
+TransformerNetwork.forward looks up gym spaces, branches on outer_rank and on the values of seq_idx and passes
+network_state around as a dict. The exported module takes and returns plain tensors instead, and every step runs
+the same branch-free graph, so it can be traced and frozen. Freezing inlines the weights and the attention mask as
+constants.
+
+Inputs and outputs of the exported module:
+    forward(image, natural_language_embedding, context_image_tokens, action_tokens, seq_idx)
+        -> (predicted action tokens, action logits, context_image_tokens, action_tokens, seq_idx)
+    image: (b, 3, h, w) in the range [0, 1].
+    natural_language_embedding: (b, embedding_dim).
+    context_image_tokens, action_tokens and seq_idx are the state of the episode. They are zeros at the beginning of
+    an episode (see zero_export_state) and the outputs of the previous step afterwards.
+Predicted action tokens (b, tokens_per_action) are converted into actions with RT1ActionTokenizer.detokenize.
+
+All action tokens of a step are decoded in a single transformer pass like parallel_decoding.
+The exported state always uses the shifting window of TransformerNetwork, regardless of use_kv_cache and
+ring_buffer_state.
+
+Usage:
+    module = export_network(network, path='rt1.pt')
+    verify_export(network, module)
+    module, metadata = load_exported('rt1.pt')
+"""
+
+import json
+from typing import Any, Dict, Optional, Tuple
+
+import torch
+import torch.nn as nn
+
+from film_efficientnet import preprocessors
+from film_efficientnet.pretrained_efficientnet_encoder import EfficientNetEncoder
+from inference.utils import zero_network_state
+from transformer_network import TransformerNetwork
+
+_METADATA_FILE = 'metadata.json'
+
+
+class _InferenceModule(nn.Module):
+    """One inference step of TransformerNetwork with tensors in and out."""
+
+    def __init__(self, network: TransformerNetwork):
+        super().__init__()
+        self._image_tokenizer = network._image_tokenizer
+        self._transformer = network._transformer
+        self.register_buffer('_attention_mask', network._default_attention_mask.clone())
+        self._time_sequence_length = network._time_sequence_length
+        self._tokens_per_action = network._tokens_per_action
+        self._tokens_per_context_image = network._tokens_per_context_image
+        self._single_time_step_num_tokens = network._single_time_step_num_tokens
+        self._token_embedding_size = network._token_embedding_size
+
+    def forward(self,
+                image: torch.Tensor,  # (b, c, h, w)
+                natural_language_embedding: torch.Tensor,  # (b, embedding_dim)
+                context_image_tokens: torch.Tensor,  # (b, t, num_tokens, embedding_dim)
+                action_tokens: torch.Tensor,  # (b, t, tokens_per_action)
+                seq_idx: torch.Tensor,  # (b,)
+                ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        b, t = context_image_tokens.shape[0], context_image_tokens.shape[1]
+
+        image = preprocessors.convert_dtype_and_crop_images(image, training=False)
+        image_tokens = self._image_tokenizer(image.unsqueeze(1), context=natural_language_embedding.unsqueeze(1))
+
+        # Shift the window of the episodes that are full. Unlike TransformerNetwork, shift unconditionally so that
+        # every step runs the same graph.
+        shift = seq_idx == self._time_sequence_length  # (b,)
+        context_image_tokens = torch.where(shift[:, None, None, None],
+                                           torch.roll(context_image_tokens, -1, 1), context_image_tokens)
+        action_tokens = torch.where(shift[:, None, None], torch.roll(action_tokens, -1, 1), action_tokens)
+
+        time_step = torch.clamp(seq_idx, max=self._time_sequence_length - 1)  # (b,)
+        index = time_step[:, None, None, None].expand(-1, 1, image_tokens.shape[2], image_tokens.shape[3])
+        context_image_tokens = context_image_tokens.scatter(1, index, image_tokens.to(context_image_tokens.dtype))
+
+        # Action tokens are always zeros in the input of the transformer.
+        input_action_tokens = torch.zeros((b, t, self._tokens_per_action, self._token_embedding_size),
+                                          dtype=context_image_tokens.dtype, device=context_image_tokens.device)
+        input_token_sequence = torch.concat((context_image_tokens, input_action_tokens), dim=2)
+        input_token_sequence = input_token_sequence.reshape(b, -1, self._token_embedding_size)
+        output_tokens, _ = self._transformer(input_token_sequence, self._attention_mask)
+
+        # Outputs of the last image token and the action tokens except the last one at time_step.
+        start_index = -1 + self._tokens_per_context_image + time_step * self._single_time_step_num_tokens  # (b,)
+        index = start_index.unsqueeze(1) + torch.arange(self._tokens_per_action, device=start_index.device)
+        index = index.unsqueeze(-1).expand(-1, -1, output_tokens.shape[-1])
+        action_logits = torch.gather(output_tokens, 1, index)  # (b, tokens_per_action, vocab_size)
+        predicted_tokens = torch.argmax(action_logits, dim=-1)  # (b, tokens_per_action)
+
+        index = time_step[:, None, None].expand(-1, 1, self._tokens_per_action)
+        action_tokens = action_tokens.scatter(1, index, predicted_tokens.unsqueeze(1).to(action_tokens.dtype))
+        seq_idx = torch.clamp(seq_idx + 1, max=self._time_sequence_length)
+
+        return predicted_tokens, action_logits, context_image_tokens, action_tokens, seq_idx
+
+
+def zero_export_state(network: TransformerNetwork, batch_size: int = 1, device='cpu') \
+        -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Returns (context_image_tokens, action_tokens, seq_idx) of the exported module at the beginning of an episode."""
+    network_state = zero_network_state(network, batch_size=batch_size, device=device)
+    return network_state['context_image_tokens'], network_state['action_tokens'], network_state['seq_idx']
+
+
+def _example_inputs(network: TransformerNetwork, batch_size: int, device) -> Tuple[torch.Tensor, ...]:
+    image_shape = network._input_tensor_space['image'].shape
+    embedding_shape = network._input_tensor_space['natural_language_embedding'].shape
+    image = torch.rand((batch_size,) + tuple(image_shape), device=device)
+    natural_language_embedding = torch.rand((batch_size,) + tuple(embedding_shape), device=device)
+    return (image, natural_language_embedding) + zero_export_state(network, batch_size, device)
+
+
+def _metadata(network: TransformerNetwork, batch_size: int) -> Dict[str, Any]:
+    state = zero_export_state(network, batch_size)
+    return {
+        'batch_size': batch_size,
+        'time_sequence_length': network._time_sequence_length,
+        'tokens_per_action': network._tokens_per_action,
+        'vocab_size': network._vocab_size,
+        'context_image_tokens_shape': list(state[0].shape[1:]),
+        'action_tokens_shape': list(state[1].shape[1:]),
+    }
+
+
+def export_network(network: TransformerNetwork,
+                   path: Optional[str] = None,
+                   batch_size: int = 1,
+                   device: str = 'cpu',
+                   method: str = 'torchscript'):
+    """Exports network as a frozen inference module.
+
+    Args:
+        network: TransformerNetwork to export. Its weights are shared until the module is frozen.
+        path: If given, the exported module is saved here.
+        batch_size: Batch size of the exported module. Tracing specializes shapes on it.
+        device: Device of the exported module.
+        method: 'torchscript' traces and freezes the module with TorchScript.
+            'torch_export' captures it with torch.export, which folds the weights into the program as well.
+    Returns:
+        The exported module. A torch.jit.ScriptModule or a torch.export.ExportedProgram.
+    """
+    network = network.to(device)
+    network.eval()
+    module = _InferenceModule(network).eval()
+    example_inputs = _example_inputs(network, batch_size, device)
+    metadata = _metadata(network, batch_size)
+
+    # Cached FiLM parameters would be recorded as constants of the example instruction.
+    encoders = [m for m in network.modules() if isinstance(m, EfficientNetEncoder)]
+    film_caches = [encoder._film_cache for encoder in encoders]
+    for encoder in encoders:
+        encoder._film_cache = None
+    try:
+        with torch.no_grad():
+            if method == 'torchscript':
+                exported = torch.jit.freeze(torch.jit.trace(module, example_inputs))
+                if path is not None:
+                    torch.jit.save(exported, path, _extra_files={_METADATA_FILE: json.dumps(metadata)})
+            elif method == 'torch_export':
+                exported = torch.export.export(module, example_inputs)
+                if path is not None:
+                    torch.export.save(exported, path, extra_files={_METADATA_FILE: json.dumps(metadata)})
+            else:
+                raise ValueError('method should be either torchscript or torch_export, got {}'.format(method))
+    finally:
+        for encoder, film_cache in zip(encoders, film_caches):
+            encoder._film_cache = film_cache
+    return exported
+
+
+def load_exported(path: str, method: str = 'torchscript', map_location=None):
+    """Loads an exported module. Returns the module and its metadata."""
+    extra_files = {_METADATA_FILE: ''}
+    if method == 'torchscript':
+        module = torch.jit.load(path, map_location=map_location, _extra_files=extra_files)
+    elif method == 'torch_export':
+        module = torch.export.load(path, extra_files=extra_files).module()
+    else:
+        raise ValueError('method should be either torchscript or torch_export, got {}'.format(method))
+    return module, json.loads(extra_files[_METADATA_FILE])
+
+
+@torch.no_grad()
+def verify_export(network: TransformerNetwork, module, num_steps: Optional[int] = None, batch_size: int = 1,
+                  device: str = 'cpu', rtol: float = 1e-4, atol: float = 1e-4):
+    """Runs the eager network and the exported module on the same observations and compares action logits.
+
+    num_steps defaults to twice time_sequence_length so that the shifted window is verified as well.
+    Raises AssertionError if they differ.
+    """
+    if not isinstance(module, nn.Module):
+        module = module.module()  # torch.export.ExportedProgram
+    network = network.to(device)
+    network.eval()
+    if num_steps is None:
+        num_steps = 2 * network._time_sequence_length
+
+    network_state = zero_network_state(network, batch_size=batch_size, device=device)
+    state = zero_export_state(network, batch_size, device)
+    for _ in range(num_steps):
+        image, natural_language_embedding = _example_inputs(network, batch_size, device)[:2]
+        observations = {'image': image, 'natural_language_embedding': natural_language_embedding}
+        _, network_state = network(observations, network_state)
+        expected_logits = network.get_aux_info()['action_predictions_logits']
+
+        predicted_tokens, action_logits, *state = module(image, natural_language_embedding, *state)
+        torch.testing.assert_close(action_logits, expected_logits, rtol=rtol, atol=atol)
+        torch.testing.assert_close(state[2], network_state['seq_idx'].to(state[2].dtype))
@@ -0,0 +1,38 @@
+"""Tests for export."""
+
+import os
+import tempfile
+import unittest
+
+from absl.testing import parameterized
+import torch
+
+import transformer_network
+from inference.export import export_network
+from inference.export import load_exported
+from inference.export import verify_export
+from transformer_network_test_set_up import TIME_SEQUENCE_LENGTH
+from transformer_network_test_set_up import TransformerNetworkTestUtils
+
+
+class ExportTest(TransformerNetworkTestUtils):
+    @parameterized.named_parameters(('torchscript', 'torchscript'), ('torch_export', 'torch_export'))
+    def testExportedModuleMatchesNetwork(self, method):
+        if method == 'torch_export' and not hasattr(torch, 'export'):
+            self.skipTest('torch.export is not available.')
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'rt1.pt')
+            export_network(network, path=path, method=method)
+            module, metadata = load_exported(path, method=method)
+
+        self.assertEqual(metadata['time_sequence_length'], TIME_SEQUENCE_LENGTH)
+        verify_export(network, module)
+
+
+if __name__ == '__main__':
+    unittest.main()
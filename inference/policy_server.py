@@ -0,0 +1,368 @@
+"""Local policy server that serves TransformerNetwork inference to many clients.
+
+Each client (a robot or a simulator) connects to the server through a Unix socket or TCP localhost and
+sends one observation per step. Requests from all clients are coalesced into micro-batches so that one
+copy of the network runs batched forwards instead of every client running its own batch-1 forwards.
+network_state of each client is kept on the server side.
+
+Messages are dicts of strings, numbers and numeric ndarrays, prefixed by their length (4 bytes, big endian).
+A message is a JSON header prefixed by its length, followed by the raw bytes of the arrays. The header is the
+message with each array replaced by its dtype and shape, so decoding never runs code of the sender.
+
+request: {'type': 'act', 'observation': {'image': (3, h, w), 'natural_language_embedding': (512,)}}
+         {'type': 'reset'} clears network_state of this client, i.e. starts a new episode.
+response: {'action': {key: ndarray}} or {'error': message}
+
+Usage:
+    server = PolicyServer(network, max_batch_size=8, max_wait=0.002)
+    server.run(path='/tmp/rt1.sock')
+
+    client = PolicyClient(path='/tmp/rt1.sock')
+    action = client.act(observation)
+"""
+
+import asyncio
+import heapq
+import json
+import math
+import socket
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+from inference.utils import zero_network_state
+from transformer_network import TransformerNetwork
+
+_HEADER = struct.Struct('>I')
+# Messages are small: an observation is one image and one embedding.
+_MAX_MESSAGE_SIZE = 64 << 20
+# Key of the header of an array in the JSON header of a message.
+_ARRAY_KEY = '__ndarray__'
+
+
+def _encode_message(message: dict) -> bytes:
+    buffers = []
+
+    def to_json(value):
+        if isinstance(value, dict):
+            return {k: to_json(v) for k, v in value.items()}
+        if isinstance(value, (np.ndarray, np.generic)):
+            array = np.ascontiguousarray(value)
+            buffers.append(array.tobytes())
+            return {_ARRAY_KEY: {'dtype': array.dtype.str, 'shape': list(array.shape)}}
+        return value
+
+    header = json.dumps(to_json(message)).encode('utf-8')
+    payload = _HEADER.pack(len(header)) + header + b''.join(buffers)
+    return _HEADER.pack(len(payload)) + payload
+
+
+def _decode_message(payload: bytes) -> dict:
+    """Decodes a message of _encode_message. Raises ValueError if payload is not a valid message."""
+    if len(payload) < _HEADER.size:
+        raise ValueError('message is truncated.')
+    (header_length,) = _HEADER.unpack_from(payload)
+    offset = _HEADER.size + header_length
+    if offset > len(payload):
+        raise ValueError('message is truncated.')
+    try:
+        header = json.loads(payload[_HEADER.size:offset].decode('utf-8'))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError('invalid message header: {}'.format(e)) from e
+    if not isinstance(header, dict):
+        raise ValueError('message should be a dict, got {}.'.format(type(header).__name__))
+    # np.frombuffer of a bytearray gives writable arrays.
+    data = bytearray(payload[offset:])
+    position = 0
+
+    def from_json(value):
+        nonlocal position
+        if not isinstance(value, dict):
+            return value
+        if _ARRAY_KEY not in value:
+            return {k: from_json(v) for k, v in value.items()}
+        try:
+            dtype = np.dtype(value[_ARRAY_KEY]['dtype'])
+            shape = tuple(int(d) for d in value[_ARRAY_KEY]['shape'])
+        except (TypeError, KeyError, ValueError) as e:
+            raise ValueError('invalid array header {}.'.format(value[_ARRAY_KEY])) from e
+        if dtype.kind not in 'biuf' or any(d < 0 for d in shape):
+            raise ValueError('only numeric arrays are supported, got {} of shape {}.'.format(dtype, shape))
+        count = math.prod(shape)
+        if position + dtype.itemsize * count > len(data):
+            raise ValueError('message is truncated.')
+        if count == 0:
+            return np.empty(shape, dtype=dtype)
+        array = np.frombuffer(data, dtype=dtype, count=count, offset=position).reshape(shape)
+        position += dtype.itemsize * count
+        return array
+
+    message = from_json(header)
+    if position != len(data):
+        raise ValueError('message has {} trailing bytes.'.format(len(data) - position))
+    return message
+
+
+async def _read_message(reader: asyncio.StreamReader) -> dict:
+    header = await reader.readexactly(_HEADER.size)
+    (length,) = _HEADER.unpack(header)
+    if length > _MAX_MESSAGE_SIZE:
+        # The rest of the stream can't be framed without reading the message.
+        raise ConnectionError('message of {} bytes is larger than {} bytes.'.format(length, _MAX_MESSAGE_SIZE))
+    return _decode_message(await reader.readexactly(length))
+
+
+class _Request:
+    """A pending observation of one client."""
+
+    def __init__(self, client: '_ClientState', observation: Dict[str, np.ndarray], future: asyncio.Future):
+        self.client = client
+        self.observation = observation
+        self.future = future
+
+
+class _ClientState:
+    """Server side state of one connected client."""
+
+    def __init__(self, slot: int):
+        # Index of network_state of this client in _StatePool.
+        self.slot = slot
+
+
+class _StatePool:
+    """network_state of all clients, stacked along the batch dimension with one slot per client.
+
+    A batch gathers the slots of its clients with one index_select per key and writes them back with one
+    index_copy_, so a step doesn't depend on the number of connected clients. Slots of disconnected clients are
+    reused, and the pool doubles when it is full. Only used from the thread of the executor.
+    """
+
+    def __init__(self, initial_state: Dict[str, torch.Tensor]):
+        self._initial_state = initial_state
+        self._state = {k: v.clone() for k, v in initial_state.items()}
+        self._free_slots = [0]
+
+    def acquire(self) -> int:
+        if not self._free_slots:
+            capacity = next(iter(self._state.values())).shape[0]
+            self._state = {k: torch.cat([v, self._initial_state[k].expand(capacity, *v.shape[1:])])
+                           for k, v in self._state.items()}
+            self._free_slots = list(range(capacity, 2 * capacity))
+        slot = heapq.heappop(self._free_slots)
+        self.reset(slot)
+        return slot
+
+    def release(self, slot: int):
+        heapq.heappush(self._free_slots, slot)
+
+    def reset(self, slot: int):
+        for k, v in self._state.items():
+            v[slot] = self._initial_state[k][0]
+
+    def gather(self, slots: torch.Tensor) -> Dict[str, torch.Tensor]:
+        return {k: v.index_select(0, slots) for k, v in self._state.items()}
+
+    def scatter(self, slots: torch.Tensor, network_state: Dict[str, torch.Tensor]):
+        for k, v in self._state.items():
+            v.index_copy_(0, slots, network_state[k].to(v.dtype))
+
+
+class PolicyServer:
+    def __init__(self,
+                 network: TransformerNetwork,
+                 max_batch_size: int = 8,
+                 # Maximum time in seconds to wait for more requests after the first request of a batch arrived.
+                 max_wait: float = 0.002,
+                 device: str = 'cpu'):
+        assert max_batch_size > 0, "max_batch_size should be positive."
+        self._network = network.to(device)
+        self._network.eval()
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        self._device = torch.device(device)
+        self._queue: Optional[asyncio.Queue] = None
+        # The network and the state pool are not thread safe, so all forwards and state updates run on a single
+        # worker thread. Created by serve() and shut down when serving stops.
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._states = _StatePool(zero_network_state(self._network, batch_size=1, device=self._device))
+        self.batch_sizes: List[int] = []
+        self.sockets = None
+
+    def _validate_observation(self, observation) -> Dict[str, np.ndarray]:
+        """Raises ValueError if observation doesn't match the observation space of the network."""
+        space = self._network._input_tensor_space
+        if not isinstance(observation, dict) or set(observation) != set(space.spaces):
+            raise ValueError('observation should have the keys {}, got {}.'.format(
+                sorted(space.spaces), sorted(observation) if isinstance(observation, dict) else observation))
+        for key, value in observation.items():
+            if not isinstance(value, np.ndarray) or value.shape != space[key].shape:
+                raise ValueError('observation {} should be an array of shape {}, got {}.'.format(
+                    key, space[key].shape, getattr(value, 'shape', value)))
+        return {key: value.astype(space[key].dtype, copy=False) for key, value in observation.items()}
+
+    @torch.no_grad()
+    def _infer_batch(self, requests: List[_Request]) -> List[Dict[str, np.ndarray]]:
+        """Runs one batched forward and updates network_state of each client."""
+        observations = {
+            key: torch.from_numpy(np.stack([r.observation[key] for r in requests])).to(self._device)
+            for key in requests[0].observation.keys()
+        }
+        slots = torch.tensor([r.client.slot for r in requests], device=self._device)
+        network_state = self._states.gather(slots)
+
+        output_actions, network_state = self._network(observations, network_state)
+
+        self._states.scatter(slots, network_state)
+        output_actions = {k: v.cpu().numpy() for k, v in output_actions.items()}
+        return [{k: v[i] for k, v in output_actions.items()} for i in range(len(requests))]
+
+    async def _collect_batch(self) -> List[_Request]:
+        """Waits for one request and collects more until the batch is full or max_wait has passed."""
+        loop = asyncio.get_running_loop()
+        requests = [await self._queue.get()]
+        deadline = loop.time() + self._max_wait
+        while len(requests) < self._max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            requests.append(request)
+        return requests
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = await self._collect_batch()
+            self.batch_sizes.append(len(requests))
+            try:
+                actions = await loop.run_in_executor(self._executor, self._infer_batch, requests)
+            except Exception as e:  # pylint: disable=broad-except
+                for request in requests:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            for request, action in zip(requests, actions):
+                if not request.future.done():
+                    request.future.set_result(action)
+
+    # A client waits for the response before it sends the next message,
+    # so one client never has two steps in the same batch.
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        client = _ClientState(await loop.run_in_executor(self._executor, self._states.acquire))
+        try:
+            while True:
+                try:
+                    message = await _read_message(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break  # The client disconnected or sent a message that is too large.
+                except ValueError as e:
+                    response = {'error': repr(e)}
+                else:
+                    response = await self._handle_message(client, message)
+
+                writer.write(_encode_message(response))
+                await writer.drain()
+        finally:
+            writer.close()
+            try:
+                await loop.run_in_executor(self._executor, self._states.release, client.slot)
+            except RuntimeError:
+                pass  # The executor is shut down because the server stopped.
+
+    async def _handle_message(self, client: _ClientState, message: dict) -> dict:
+        loop = asyncio.get_running_loop()
+        if message.get('type') == 'act':
+            # Invalid requests fail here rather than the batch that they would be part of.
+            try:
+                observation = self._validate_observation(message.get('observation'))
+            except ValueError as e:
+                return {'error': repr(e)}
+            future = loop.create_future()
+            await self._queue.put(_Request(client, observation, future))
+            try:
+                return {'action': await future}
+            except Exception as e:  # pylint: disable=broad-except
+                return {'error': repr(e)}
+        if message.get('type') == 'reset':
+            await loop.run_in_executor(self._executor, self._states.reset, client.slot)
+            return {'ok': True}
+        return {'error': 'unknown message type: {}'.format(message.get('type'))}
+
+    async def serve(self, path: Optional[str] = None, host: str = '127.0.0.1', port: int = 0,
+                    started: Optional[asyncio.Event] = None):
+        """Serves until cancelled. Listens on the Unix socket at path if it is given, otherwise on host:port."""
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='policy_server')
+        try:
+            if path is not None:
+                server = await asyncio.start_unix_server(self._handle_client, path=path)
+            else:
+                server = await asyncio.start_server(self._handle_client, host=host, port=port)
+            self.sockets = server.sockets
+            batch_loop = asyncio.ensure_future(self._batch_loop())
+            if started is not None:
+                started.set()
+            try:
+                async with server:
+                    await server.serve_forever()
+            finally:
+                batch_loop.cancel()
+        finally:
+            # A running forward finishes in the background.
+            self._executor.shutdown(wait=False)
+
+    def run(self, path: Optional[str] = None, host: str = '127.0.0.1', port: int = 0):
+        asyncio.run(self.serve(path=path, host=host, port=port))
+
+
+class PolicyClient:
+    """Blocking client of PolicyServer. One client corresponds to one episode stream."""
+
+    def __init__(self, path: Optional[str] = None, host: str = '127.0.0.1', port: Optional[int] = None):
+        if path is not None:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(path)
+        else:
+            self._socket = socket.create_connection((host, port))
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _recv_exactly(self, length: int) -> bytes:
+        buffer = bytearray()
+        while len(buffer) < length:
+            chunk = self._socket.recv(length - len(buffer))
+            if not chunk:
+                raise ConnectionError('policy server closed the connection.')
+            buffer.extend(chunk)
+        return bytes(buffer)
+
+    def _call(self, message: dict) -> dict:
+        self._socket.sendall(_encode_message(message))
+        (length,) = _HEADER.unpack(self._recv_exactly(_HEADER.size))
+        response = _decode_message(self._recv_exactly(length))
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    def act(self, observation: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        """Sends an observation without batch dimension and returns the action."""
+        return self._call({'type': 'act', 'observation': observation})['action']
+
+    def reset(self):
+        """Starts a new episode."""
+        self._call({'type': 'reset'})
+
+    def close(self):
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,150 @@
+"""Tests for policy_server."""
+
+import asyncio
+import pickle
+import socket
+import threading
+import unittest
+
+import numpy as np
+import torch
+
+import transformer_network
+from inference.policy_server import _HEADER
+from inference.policy_server import _decode_message
+from inference.policy_server import _encode_message
+from inference.policy_server import PolicyClient
+from inference.policy_server import PolicyServer
+from transformer_network_test_set_up import HEIGHT
+from transformer_network_test_set_up import TIME_SEQUENCE_LENGTH
+from transformer_network_test_set_up import TransformerNetworkTestUtils
+from transformer_network_test_set_up import WIDTH
+
+
+class PolicyServerTest(TransformerNetworkTestUtils):
+    def _start_server(self, server: PolicyServer):
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        async def serve():
+            event = asyncio.Event()
+            task = asyncio.ensure_future(server.serve(port=0, started=event))
+            await event.wait()
+            started.set()
+            await task
+
+        thread = threading.Thread(target=loop.run_until_complete, args=(serve(),), daemon=True)
+        thread.start()
+        started.wait(timeout=60)
+        return server.sockets[0].getsockname()[1]
+
+    def testBatchedClients(self):
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH)
+        # A long max_wait makes sure that the requests of both clients end up in one batch.
+        server = PolicyServer(network, max_batch_size=2, max_wait=10.0)
+        port = self._start_server(server)
+
+        num_clients = 2
+        num_steps = TIME_SEQUENCE_LENGTH + 1
+        actions = [[] for _ in range(num_clients)]
+
+        def run_client(i):
+            with PolicyClient(port=port) as client:
+                for _ in range(num_steps):
+                    observation = {
+                        'image': np.full((3, HEIGHT, WIDTH), 0.5, dtype=np.float32),
+                        'natural_language_embedding': np.full((512,), float(i), dtype=np.float32),
+                    }
+                    actions[i].append(client.act(observation))
+                client.reset()
+
+        threads = [threading.Thread(target=run_client, args=(i,)) for i in range(num_clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(server.batch_sizes, [num_clients] * num_steps)
+        for client_actions in actions:
+            self.assertLen(client_actions, num_steps)
+            self.assertCountEqual(client_actions[0].keys(), self._action_space.keys())
+            self.assertEqual(client_actions[0]['world_vector'].shape, (3,))
+
+    def testInvalidRequestOnlyFailsItsClient(self):
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH)
+        server = PolicyServer(network, max_batch_size=2, max_wait=0.5)
+        port = self._start_server(server)
+        results = [None, None]
+
+        def run_client(i, image_shape):
+            with PolicyClient(port=port) as client:
+                observation = {
+                    'image': np.full(image_shape, 0.5, dtype=np.float32),
+                    'natural_language_embedding': np.zeros((512,), dtype=np.float32),
+                }
+                try:
+                    results[i] = client.act(observation)
+                except RuntimeError as e:
+                    results[i] = e
+
+        threads = [threading.Thread(target=run_client, args=(0, (3, HEIGHT, WIDTH))),
+                   threading.Thread(target=run_client, args=(1, (3, HEIGHT + 1, WIDTH)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results[0]['world_vector'].shape, (3,))
+        self.assertIsInstance(results[1], RuntimeError)
+        self.assertIn('image', str(results[1]))
+        self.assertEqual(server.batch_sizes, [1])
+
+    def testRejectsPickle(self):
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH)
+        port = self._start_server(PolicyServer(network))
+        payload = pickle.dumps({'type': 'reset'})
+        with socket.create_connection(('127.0.0.1', port)) as sock:
+            sock.sendall(_HEADER.pack(len(payload)) + payload)
+            (length,) = _HEADER.unpack(sock.recv(_HEADER.size, socket.MSG_WAITALL))
+            response = _decode_message(sock.recv(length, socket.MSG_WAITALL))
+        self.assertIn('error', response)
+
+
+class MessageTest(unittest.TestCase):
+    def testRoundTrip(self):
+        message = {'type': 'act', 'observation': {
+            'image': np.random.rand(3, 4, 5).astype(np.float32),
+            'step': np.int64(3),
+            'empty': np.zeros((0, 2), dtype=np.uint8),
+        }}
+        encoded = _encode_message(message)
+        (length,) = _HEADER.unpack_from(encoded)
+        decoded = _decode_message(encoded[_HEADER.size:])
+        self.assertEqual(length, len(encoded) - _HEADER.size)
+        self.assertEqual(decoded['type'], 'act')
+        for key, value in message['observation'].items():
+            np.testing.assert_array_equal(decoded['observation'][key], value)
+            self.assertEqual(decoded['observation'][key].dtype, value.dtype)
+
+    def testRejectsInvalidMessages(self):
+        payload = _encode_message({'observation': np.zeros((2, 3), dtype=np.float32)})[_HEADER.size:]
+        with self.assertRaisesRegex(ValueError, 'truncated'):
+            _decode_message(payload[:-1])
+        with self.assertRaisesRegex(ValueError, 'trailing'):
+            _decode_message(payload + b'0')
+        header = b'{"a": {"__ndarray__": {"dtype": "|O", "shape": [1]}}}'
+        with self.assertRaisesRegex(ValueError, 'numeric'):
+            _decode_message(_HEADER.pack(len(header)) + header + bytes(8))
+
+
+if __name__ == '__main__':
+    unittest.main()
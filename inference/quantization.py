@@ -0,0 +1,208 @@
+"""Post-training int8 quantization of TransformerNetwork for CPU inference.
+
+- Linear layers of the transformer, of FilmConditioning and the output head are quantized dynamically.
+  Weights are int8 and activations are quantized on the fly, so they need no calibration.
+- Conv2dNormActivation blocks of EfficientNet are quantized statically. BatchNorm is folded into the convolution,
+  which runs in int8 with activation ranges observed during calibration. The rest of the backbone (SiLU,
+  Squeeze-and-Excitation, FiLM and the skip connections) stays in float, so each block quantizes its input and
+  dequantizes its output.
+
+The quantized network runs with the quantized engine that it was converted for. See quantized_engine.
+
+Usage:
+    quantized_network = quantize_network(network, calibration_observations(network, num_batches=16))
+    print(action_token_agreement(network, quantized_network, calibration_observations(network, num_batches=16)))
+"""
+
+import contextlib
+import copy
+from typing import Dict, Iterable, Iterator, Optional
+
+import torch
+import torch.nn as nn
+from torch.ao import quantization
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torchvision.ops.misc import Conv2dNormActivation
+
+from film_efficientnet import preprocessors
+from film_efficientnet.film_conditioning_layer import FilmConditioning
+from film_efficientnet.film_efficientnet_encoder import EfficientNet
+from inference.utils import zero_network_state
+from transformer_network import TransformerNetwork
+
+
+class QuantizedConvNormActivation(nn.Module):
+    """Conv2dNormActivation whose convolution and BatchNorm run as one int8 convolution."""
+
+    def __init__(self, block: Conv2dNormActivation):
+        super().__init__()
+        conv, norm = block[0], block[1]
+        self.quant = quantization.QuantStub()
+        # BatchNorm is already folded if EfficientNet.fuse_for_inference was called.
+        self.conv = fuse_conv_bn_eval(conv, norm) if isinstance(norm, nn.BatchNorm2d) else conv
+        self.dequant = quantization.DeQuantStub()
+        # SiLU has no quantized kernel. It runs in float after dequantization.
+        self.activation = block[2] if len(block) > 2 else None
+
+    def forward(self, x):
+        x = self.dequant(self.conv(self.quant(x)))
+        if self.activation is not None:
+            x = self.activation(x)
+        return x
+
+
+def _replace_conv_blocks(module: nn.Module, qconfig) -> int:
+    """Replaces every Conv2dNormActivation under module with QuantizedConvNormActivation."""
+    num_replaced = 0
+    for name, child in module.named_children():
+        if isinstance(child, Conv2dNormActivation):
+            quantized_block = QuantizedConvNormActivation(child)
+            quantized_block.qconfig = qconfig
+            setattr(module, name, quantized_block)
+            num_replaced += 1
+        else:
+            num_replaced += _replace_conv_blocks(child, qconfig)
+    return num_replaced
+
+
+def _dynamic_linear_names(network: TransformerNetwork):
+    """Names of the Linear layers of the transformer, FilmConditioning and the output head."""
+    names = set()
+    for name, module in network.named_modules():
+        if isinstance(module, FilmConditioning) or name == '_transformer':
+            names.update('{}.{}'.format(name, child_name) for child_name, child in module.named_modules()
+                         if isinstance(child, nn.Linear))
+    return names
+
+
+def _encode_observations(network: TransformerNetwork, observations: Dict[str, torch.Tensor]):
+    """Runs the backbone on every frame of training-shaped observations (b, t, ...)."""
+    image = observations['image']
+    image = image.reshape((-1,) + tuple(image.shape[2:]))  # (b * t, c, h, w)
+    image = preprocessors.convert_dtype_and_crop_images(image, training=False)
+    context = observations.get('natural_language_embedding')
+    if context is not None:
+        context = context.reshape(-1, 1, context.shape[-1]).to(torch.float32)
+    # The image tokenizer is called directly, so that the motion gate doesn't skip frames.
+    network._image_tokenizer(image.unsqueeze(1), context=context)
+
+
+@contextlib.contextmanager
+def quantized_engine(backend: Optional[str]):
+    """Sets torch.backends.quantized.engine to backend in the context and restores the previous engine after it.
+
+    None keeps the current engine. Run a network of quantize_network in quantized_engine(network.quantized_engine).
+    """
+    previous_backend = torch.backends.quantized.engine
+    if backend is not None:
+        torch.backends.quantized.engine = backend
+    try:
+        yield
+    finally:
+        torch.backends.quantized.engine = previous_backend
+
+
+@torch.no_grad()
+def quantize_network(network: TransformerNetwork,
+                     calibration_data: Iterable[Dict[str, torch.Tensor]],
+                     backend: Optional[str] = None) -> TransformerNetwork:
+    """Returns an int8 copy of network for CPU inference. network itself is left as it is.
+
+    Args:
+        network: TransformerNetwork to quantize.
+        calibration_data: Observations with batch and time dimensions (b, t, ...) like the training data, which are
+            used to observe activation ranges of the convolutions. See calibration_observations.
+        backend: Quantized engine, e.g. 'fbgemm' on x86 or 'qnnpack' on ARM. Defaults to the current engine.
+            The engine is only set during quantization and is recorded in quantized_engine of the returned network.
+    """
+    if backend is None:
+        backend = torch.backends.quantized.engine
+
+    network = copy.deepcopy(network).to('cpu')
+    network.eval()
+    # FiLM layers can't be folded into the int8 convolutions.
+    network._image_tokenizer._specialize = False
+
+    with quantized_engine(backend):
+        # Static quantization of the convolutions.
+        qconfig = quantization.get_default_qconfig(backend)
+        for module in list(network.modules()):
+            if isinstance(module, EfficientNet):
+                _replace_conv_blocks(module, qconfig)
+        quantization.prepare(network, inplace=True)
+        for observations in calibration_data:
+            _encode_observations(network, observations)
+        quantization.convert(network, inplace=True)
+
+        # Dynamic quantization of the linear layers.
+        qconfig_spec = {name: quantization.default_dynamic_qconfig for name in _dynamic_linear_names(network)}
+        quantization.quantize_dynamic(network, qconfig_spec=qconfig_spec, dtype=torch.qint8, inplace=True)
+    network.quantized_engine = backend
+    return network
+
+
+def calibration_observations(network: TransformerNetwork, num_batches: int = 16,
+                             batch_size: int = 1) -> Iterator[Dict[str, torch.Tensor]]:
+    """Yields observations from the training data pipeline on CPU.
+
+    Trajectories have the time_sequence_length of network, and images are resized to its crop_size like in training.
+    """
+    # The data pipeline depends on tensorflow, which is only needed here.
+    from torch.utils.data import DataLoader
+    from data.multiple_dataset import CombinedDataset
+
+    dataset = CombinedDataset(time_sequence_length=network._time_sequence_length,
+                              image_size=network._image_tokenizer.image_size)
+    data_loader = DataLoader(dataset, batch_size=batch_size, num_workers=0)
+    for i, item in enumerate(data_loader):
+        if i >= num_batches:
+            break
+        yield {k: v.cpu() for k, v in item['observation'].items()}
+
+
+@torch.no_grad()
+def action_token_agreement(network: TransformerNetwork,
+                           quantized_network: TransformerNetwork,
+                           data: Iterable[Dict[str, torch.Tensor]]) -> Dict[str, object]:
+    """Compares action tokens of the quantized network with those of the fp32 network.
+
+    Each item of data is a batch of trajectories (b, t, ...), which are fed step by step as episodes.
+
+    Returns:
+        'token_agreement': Fraction of action tokens that are equal.
+        'action_agreement': Fraction of steps whose action tokens are all equal.
+        'per_token_agreement': Fraction of equal tokens for each action dimension.
+        'num_steps': Number of compared steps.
+    The fp32 network runs on its own device and is put back in its previous mode afterwards.
+    """
+    device = next(network.parameters()).device
+    training = network.training
+    network.eval()
+    quantized_network.eval()
+
+    matches = []
+    try:
+        with quantized_engine(getattr(quantized_network, 'quantized_engine', None)):
+            for observations in data:
+                b, t = observations['image'].shape[:2]
+                network_state = zero_network_state(network, batch_size=b, device=device)
+                quantized_network_state = zero_network_state(quantized_network, batch_size=b)
+                for i in range(t):
+                    step_observations = {k: v[:, i] for k, v in observations.items()}
+                    _, network_state = network({k: v.to(device) for k, v in step_observations.items()},
+                                               network_state)
+                    _, quantized_network_state = quantized_network(step_observations, quantized_network_state)
+                    tokens = torch.argmax(network.get_aux_info()['action_predictions_logits'], dim=-1).cpu()
+                    quantized_tokens = torch.argmax(quantized_network.get_aux_info()['action_predictions_logits'],
+                                                    dim=-1)
+                    matches.append(tokens == quantized_tokens)  # (b, tokens_per_action)
+    finally:
+        network.train(training)
+
+    matches = torch.concat(matches).to(torch.float32)  # (num_steps, tokens_per_action)
+    return {
+        'token_agreement': matches.mean().item(),
+        'action_agreement': matches.min(dim=-1).values.mean().item(),
+        'per_token_agreement': matches.mean(dim=0).tolist(),
+        'num_steps': matches.shape[0],
+    }
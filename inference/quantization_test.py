@@ -0,0 +1,46 @@
+"""Tests for quantization."""
+
+import unittest
+
+import torch
+
+import transformer_network
+from inference.quantization import QuantizedConvNormActivation
+from inference.quantization import action_token_agreement
+from inference.quantization import quantize_network
+from transformer_network_test_set_up import TransformerNetworkTestUtils
+
+
+class QuantizationTest(TransformerNetworkTestUtils):
+    def testQuantizeNetwork(self):
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=self.time_sequence_length)
+
+        # Training-shaped observations stand in for the data pipeline.
+        data = [{
+            'image': torch.rand(1, self.time_sequence_length, 3, *self._state_space['image'].shape[1:]),
+            'natural_language_embedding': torch.rand(1, self.time_sequence_length, self.token_embedding_size),
+        } for _ in range(2)]
+        engine = torch.backends.quantized.engine
+        quantized_network = quantize_network(network, data)
+        self.assertEqual(torch.backends.quantized.engine, engine)
+        self.assertEqual(quantized_network.quantized_engine, engine)
+
+        self.assertTrue(any(isinstance(m, QuantizedConvNormActivation) for m in quantized_network.modules()))
+        self.assertFalse(any(isinstance(m, QuantizedConvNormActivation) for m in network.modules()))
+        self.assertFalse(any(type(m) is torch.nn.Linear for m in quantized_network._transformer.modules()))
+
+        # The fp32 network is left in training mode.
+        network.train()
+        report = action_token_agreement(network, quantized_network, data)
+        self.assertTrue(network.training)
+        self.assertEqual(report['num_steps'], 2 * self.time_sequence_length)
+        self.assertLen(report['per_token_agreement'], network._tokens_per_action)
+        self.assertBetween(report['token_agreement'], 0.0, 1.0)
+        self.assertBetween(report['action_agreement'], 0.0, report['token_agreement'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,297 @@
+"""Pipelined control runtime around TransformerNetwork.
+
+Consecutive control steps overlap in four worker threads:
+    1. image preprocessing (preprocessors.convert_dtype_and_crop_images)
+    2. backbone tokenization (TransformerNetwork.encode_images)
+    3. transformer decoding (TransformerNetwork.infer_from_image_tokens)
+    4. detokenization (RT1ActionTokenizer.detokenize)
+While step n is decoded, the image of step n + 1 is already tokenized. Most of the work is done by torch ops that
+release the GIL, so threads are enough to overlap the stages.
+
+Frames submitted faster than the policy can consume them are dropped. The mailboxes in front of preprocessing and
+tokenization only keep the newest item, so the policy always acts on the freshest frame.
+
+Usage:
+    runtime = PipelinedRuntime(network)
+    runtime.start()
+    while True:
+        runtime.submit(observation)  # from the camera callback
+        frame_id, action = runtime.get_action()  # from the control loop
+    runtime.stop()
+
+ActionChunkExecutor runs a network with action_chunk_size K > 1 once every K control steps and executes the predicted
+chunk one action per control step in between.
+    executor = ActionChunkExecutor(network)
+    while True:
+        action = executor.step(observation)
+"""
+
+import collections
+import queue
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import numpy as np
+import torch
+
+from film_efficientnet import preprocessors
+from inference.utils import zero_network_state
+from transformer_network import TransformerNetwork
+
+_STOP = object()
+
+
+class _Mailbox:
+    """A single slot that always holds the newest item. put never blocks and overwrites an unread item."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._item = None
+        self._has_item = False
+        self._closed = False
+        self.num_dropped = 0
+
+    def put(self, item):
+        with self._condition:
+            if self._has_item:
+                self.num_dropped += 1
+            self._item = item
+            self._has_item = True
+            self._condition.notify()
+
+    # Returns _STOP once closed and empty.
+    def get(self, timeout: Optional[float] = None):
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._has_item or self._closed, timeout):
+                raise queue.Empty
+            if not self._has_item:
+                return _STOP
+            item = self._item
+            self._item = None
+            self._has_item = False
+            return item
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class _Queue:
+    """A bounded FIFO queue that can be closed like _Mailbox.
+
+    Once closed, put drops its item instead of blocking, and get returns the items left and then _STOP, so that
+    neither side of a stage can block forever after another stage fails.
+    """
+
+    def __init__(self, maxsize: int):
+        self._condition = threading.Condition()
+        self._items = collections.deque()
+        self._maxsize = maxsize
+        self._closed = False
+
+    def put(self, item):
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._items) < self._maxsize or self._closed)
+            if self._closed:
+                return
+            self._items.append(item)
+            self._condition.notify_all()
+
+    # Returns _STOP once closed and empty.
+    def get(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._items or self._closed)
+            if not self._items:
+                return _STOP
+            item = self._items.popleft()
+            self._condition.notify_all()
+            return item
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class PipelinedRuntime:
+    def __init__(self,
+                 network: TransformerNetwork,
+                 device: str = 'cpu',
+                 # Called with (frame_id, action) on the detokenization thread for every action.
+                 on_action: Optional[Callable[[int, Dict[str, np.ndarray]], Any]] = None):
+        self._network = network.to(device)
+        self._network.eval()
+        self._device = torch.device(device)
+        self._on_action = on_action
+
+        self._frames = _Mailbox()  # camera -> preprocessing
+        self._images = _Mailbox()  # preprocessing -> tokenization
+        # The stages after tokenization never drop items because every tokenized frame is a step of the episode.
+        self._image_tokens = _Queue(maxsize=1)  # tokenization -> decoding
+        self._action_tokens = _Queue(maxsize=1)  # decoding -> detokenization
+        self._actions = _Mailbox()  # detokenization -> control loop
+
+        self._next_frame_id = 0
+        self._reset_requested = threading.Event()
+        self._threads = []
+        self._error: Optional[BaseException] = None
+        self.num_steps = 0
+
+    @property
+    def num_dropped_frames(self) -> int:
+        """Number of frames that were overwritten by newer frames before they were used."""
+        return self._frames.num_dropped + self._images.num_dropped
+
+    def start(self):
+        self._reset_requested.set()
+        stages = [self._preprocess_loop, self._tokenize_loop, self._decode_loop, self._detokenize_loop]
+        self._threads = [threading.Thread(target=self._run_stage, args=(stage,), name=stage.__name__, daemon=True)
+                         for stage in stages]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._frames.close()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def reset(self):
+        """Starts a new episode from the next tokenized frame."""
+        self._reset_requested.set()
+
+    def submit(self, observation: Dict[str, Any]) -> int:
+        """Submits an observation without batch dimension and returns its frame id.
+
+        observation has 'image' of shape (c, h, w) in uint8 or in float [0, 1] and optionally
+        'natural_language_embedding' of shape (embedding_dim,).
+        """
+        frame_id = self._next_frame_id
+        self._next_frame_id += 1
+        self._frames.put((frame_id, observation))
+        return frame_id
+
+    def get_action(self, timeout: Optional[float] = None) -> Tuple[int, Dict[str, np.ndarray]]:
+        """Returns the newest action and the id of the frame it was computed from."""
+        item = self._actions.get(timeout)
+        if item is _STOP:
+            raise RuntimeError('runtime stopped.') from self._error
+        return item
+
+    def _run_stage(self, stage: Callable[[], None]):
+        try:
+            with torch.no_grad():
+                stage()
+        except BaseException as e:  # pylint: disable=broad-except
+            self._error = e
+            # Unblock the other stages.
+            for q in (self._frames, self._images, self._image_tokens, self._action_tokens, self._actions):
+                q.close()
+
+    def _preprocess_loop(self):
+        while True:
+            item = self._frames.get()
+            if item is _STOP:
+                self._images.close()
+                return
+            frame_id, observation = item
+            image = torch.as_tensor(observation['image']).to(self._device).unsqueeze(0)  # (1, c, h, w)
+            image = preprocessors.convert_dtype_and_crop_images(
+                image, training=False, memory_format=self._network._image_tokenizer.memory_format)
+            context = observation.get('natural_language_embedding')
+            if context is not None:
+                context = torch.as_tensor(context, dtype=torch.float32).to(self._device).unsqueeze(0)
+            self._images.put((frame_id, image, context))
+
+    # Episodes are reset here rather than in decoding, so that the state of the motion gate and network_state are
+    # reset at the same frame. The reset is passed on with the image tokens.
+    def _tokenize_loop(self):
+        gate_state = None
+        while True:
+            item = self._images.get()
+            if item is _STOP:
+                self._image_tokens.close()
+                return
+            frame_id, image, context = item
+            reset = self._reset_requested.is_set()
+            if reset:
+                self._reset_requested.clear()
+                if self._network._motion_gate_threshold is not None:
+                    network_state = zero_network_state(self._network, batch_size=1, device=self._device)
+                    gate_state = {k: network_state[k] for k in ('seq_idx', 'gate_thumbnail', 'gate_image_tokens')}
+            image_tokens = self._network.encode_images(image, context, gate_state=gate_state)
+            self._image_tokens.put((frame_id, image_tokens, reset))
+
+    def _decode_loop(self):
+        network_state = None
+        while True:
+            item = self._image_tokens.get()
+            if item is _STOP:
+                self._action_tokens.close()
+                return
+            frame_id, image_tokens, reset = item
+            if reset:
+                network_state = zero_network_state(self._network, batch_size=1, device=self._device)
+            action_tokens, network_state = self._network.infer_from_image_tokens(image_tokens, network_state)
+            self._action_tokens.put((frame_id, action_tokens))
+
+    def _detokenize_loop(self):
+        while True:
+            item = self._action_tokens.get()
+            if item is _STOP:
+                self._actions.close()
+                return
+            frame_id, action_tokens = item
+            output_actions = self._network.action_tokenizer.detokenize(action_tokens)
+            action = {k: v[0].cpu().numpy() for k, v in output_actions.items()}
+            self.num_steps += 1
+            if self._on_action is not None:
+                self._on_action(frame_id, action)
+            self._actions.put((frame_id, action))
+
+
+class ActionChunkExecutor:
+    """Executes action chunks of a TransformerNetwork one action per control step.
+
+    The network is called at the first control step of each chunk, and the observations of the other control steps
+    are not used. This matches training, where a time step of the network covers action_chunk_size control steps.
+    """
+
+    def __init__(self, network: TransformerNetwork, device: str = 'cpu'):
+        self._network = network.to(device)
+        self._network.eval()
+        self._device = torch.device(device)
+        self._network_state = None
+        self._pending_actions = collections.deque()
+        self.num_steps = 0
+        self.num_inferences = 0
+
+    def reset(self):
+        """Starts a new episode. Actions left in the current chunk are discarded."""
+        self._network_state = None
+        self._pending_actions.clear()
+
+    @torch.no_grad()
+    def step(self, observation: Dict[str, Any]) -> Dict[str, np.ndarray]:
+        """Returns the action of this control step.
+
+        observation is the same as PipelinedRuntime.submit.
+        """
+        if not self._pending_actions:
+            if self._network_state is None:
+                self._network_state = zero_network_state(self._network, batch_size=1, device=self._device)
+            observations = {k: torch.as_tensor(v).to(self._device).unsqueeze(0) for k, v in observation.items()}
+            if 'natural_language_embedding' in observations:
+                observations['natural_language_embedding'] = observations['natural_language_embedding'].to(
+                    torch.float32)
+            output_actions, self._network_state = self._network(observations, self._network_state)
+            self.num_inferences += 1
+            # (1, action_chunk_size, ...) -> action_chunk_size actions
+            chunk = {k: v[0].cpu().numpy() for k, v in output_actions.items()}
+            if self._network.action_chunk_size == 1:
+                chunk = {k: v[None] for k, v in chunk.items()}
+            for i in range(self._network.action_chunk_size):
+                self._pending_actions.append({k: v[i] for k, v in chunk.items()})
+        self.num_steps += 1
+        return self._pending_actions.popleft()
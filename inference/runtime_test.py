@@ -0,0 +1,147 @@
+"""Tests for runtime."""
+
+import threading
+import time
+import unittest
+
+import numpy as np
+
+import transformer_network
+from inference.runtime import ActionChunkExecutor
+from inference.runtime import PipelinedRuntime
+from transformer_network_test_set_up import HEIGHT
+from transformer_network_test_set_up import TIME_SEQUENCE_LENGTH
+from transformer_network_test_set_up import TransformerNetworkTestUtils
+from transformer_network_test_set_up import WIDTH
+
+
+class PipelinedRuntimeTest(TransformerNetworkTestUtils):
+    def _observation(self):
+        return {
+            'image': np.random.randint(0, 256, size=(3, HEIGHT, WIDTH), dtype=np.uint8),
+            'natural_language_embedding': np.ones((512,), dtype=np.float32),
+        }
+
+    def testActions(self):
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH)
+        runtime = PipelinedRuntime(network)
+        runtime.start()
+        try:
+            for _ in range(TIME_SEQUENCE_LENGTH + 1):
+                frame_id = runtime.submit(self._observation())
+                action_frame_id, action = runtime.get_action(timeout=60)
+                self.assertEqual(action_frame_id, frame_id)
+                self.assertCountEqual(action.keys(), self._action_space.keys())
+                self.assertEqual(action['world_vector'].shape, (3,))
+        finally:
+            runtime.stop()
+        self.assertEqual(runtime.num_steps, TIME_SEQUENCE_LENGTH + 1)
+
+    def testFreshestFrame(self):
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH)
+        runtime = PipelinedRuntime(network)
+        runtime.start()
+        try:
+            # Frames come much faster than the policy consumes them.
+            num_frames = 20
+            for _ in range(num_frames):
+                frame_id = runtime.submit(self._observation())
+            # The newest frame is never dropped.
+            while True:
+                action_frame_id, _ = runtime.get_action(timeout=60)
+                if action_frame_id == frame_id:
+                    break
+        finally:
+            runtime.stop()
+        self.assertGreater(runtime.num_dropped_frames, 0)
+        self.assertEqual(runtime.num_steps + runtime.num_dropped_frames, num_frames)
+
+    def testMotionGate(self):
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH,
+            motion_gate_threshold=0.01)
+        runtime = PipelinedRuntime(network)
+        runtime.start()
+        observation = self._observation()
+        num_steps = TIME_SEQUENCE_LENGTH + 1
+        try:
+            for _ in range(num_steps):
+                frame_id = runtime.submit(observation)
+                action_frame_id, _ = runtime.get_action(timeout=60)
+                self.assertEqual(action_frame_id, frame_id)
+            # A new episode encodes its first frame again.
+            runtime.reset()
+            runtime.submit(observation)
+            runtime.get_action(timeout=60)
+        finally:
+            runtime.stop()
+        # The frame is static, so only the first frame of each episode is encoded.
+        self.assertEqual({'reused': num_steps - 1, 'encoded': 2}, network.motion_gate_stats)
+
+    def testStopAfterStageFailsWithFullQueues(self):
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH)
+        release = threading.Event()
+
+        def on_action(frame_id, action):
+            release.wait()
+            raise RuntimeError('detokenization failed')
+
+        runtime = PipelinedRuntime(network, on_action=on_action)
+        runtime.start()
+        # Detokenization blocks in on_action until the queues between the stages are full.
+        deadline = time.monotonic() + 60
+        while len(runtime._image_tokens._items) < 1 or len(runtime._action_tokens._items) < 1:
+            self.assertLess(time.monotonic(), deadline)
+            runtime.submit(self._observation())
+            time.sleep(0.05)
+        release.set()
+
+        with self.assertRaisesRegex(RuntimeError, 'runtime stopped'):
+            runtime.get_action(timeout=60)
+        stop_thread = threading.Thread(target=runtime.stop, daemon=True)
+        stop_thread.start()
+        stop_thread.join(timeout=60)
+        self.assertFalse(stop_thread.is_alive())
+        self.assertIsInstance(runtime._error, RuntimeError)
+
+
+class ActionChunkExecutorTest(TransformerNetworkTestUtils):
+    def testChunkExecution(self):
+        action_chunk_size = 3
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH,
+            action_chunk_size=action_chunk_size)
+        executor = ActionChunkExecutor(network)
+        observation = {
+            'image': np.random.randint(0, 256, size=(3, HEIGHT, WIDTH), dtype=np.uint8),
+            'natural_language_embedding': np.ones((512,), dtype=np.float32),
+        }
+        num_steps = 2 * action_chunk_size + 1
+        for _ in range(num_steps):
+            action = executor.step(observation)
+            self.assertCountEqual(action.keys(), self._action_space.keys())
+            self.assertEqual(action['world_vector'].shape, (3,))
+            self.assertEqual(action['terminate_episode'].shape, ())
+        self.assertEqual(executor.num_steps, num_steps)
+        self.assertEqual(executor.num_inferences, 3)
+
+        executor.reset()
+        executor.step(observation)
+        self.assertEqual(executor.num_inferences, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
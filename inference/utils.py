@@ -0,0 +1,12 @@
+from typing import Dict
+
+import torch
+
+from tokenizers.utils import batched_space_sampler
+from tokenizers.utils import np_to_tensor
+
+
+def zero_network_state(network, batch_size: int = 1, device='cpu') -> Dict[str, torch.Tensor]:
+    """Returns network_state of TransformerNetwork at the beginning of an episode."""
+    network_state = np_to_tensor(batched_space_sampler(network._state_space, batch_size=batch_size))
+    return {k: torch.zeros_like(v).to(device) for k, v in network_state.items()}
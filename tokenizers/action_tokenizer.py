@@ -64,22 +64,36 @@ action = {
     'gripper_closedness_action': [0.9]
 }
 Note that values are int and numpy 1-d arrays.
+
+With action_chunk_size K > 1, an action chunk of the next K actions is tokenized at once.
+Each value of the chunk has an extra dimension of size K before the action dimension, e.g.
+action = {
+    'terminate': [0, 0, 1],
+    'world_vector': [[0.9, 0.8, -0.3], [0.8, 0.8, -0.2], [0.7, 0.9, -0.1]],
+    ...
+}
+for K = 3, and the tokens of the K actions are concatenated in time order.
 """
 
 
 class RT1ActionTokenizer:
     def __init__(self,
                  action_space: spaces.Dict,
-                 vocab_size: int):
+                 vocab_size: int,
+                 action_chunk_size: int = 1):
         """Instantiates an RT1ActionTokenizer.
 
         Args:
         action_space: A dictionary of OpenAI gym spaces of the expected actions.
         vocab_size: Number of buckets to discretize action to.
+        action_chunk_size: Number of consecutive actions that are tokenized together.
         """
+        if action_chunk_size < 1:
+            raise ValueError(f'action_chunk_size should be positive, got {action_chunk_size}')
 
         self._action_space = action_space
         self._vocab_size = vocab_size
+        self._action_chunk_size = action_chunk_size
         self._action_order = list(action_space.keys())  # Order of tokenizing
 
         self._tokens_per_action = 0
@@ -98,11 +112,23 @@ class RT1ActionTokenizer:
                 self._tokens_per_action += action_shape[0]
             else:
                 raise ValueError('We assume action_space is defined by either gym.spaces.Discrete or gym.spaces.Box')
+        self._tokens_per_single_action = self._tokens_per_action
+        self._tokens_per_action *= action_chunk_size
 
+    # Number of tokens of a whole action chunk.
     @property
     def tokens_per_action(self) -> int:
         return self._tokens_per_action
 
+    # Number of tokens of one action in a chunk.
+    @property
+    def tokens_per_single_action(self) -> int:
+        return self._tokens_per_single_action
+
+    @property
+    def action_chunk_size(self) -> int:
+        return self._action_chunk_size
+
     def tokenize(self, action: Dict[str, torch.Tensor]) -> torch.Tensor:
         """Tokenizes an action."""
         action_tokens = []
@@ -129,6 +155,9 @@ class RT1ActionTokenizer:
             action_tokens.append(token)  # if this action has action_size, this action will be action_size tokens.
         # Concatenate all actions. The size will be (tokens_per_action) or (batch,  tokens_per_action)
         action_tokens = torch.concat(action_tokens, dim=-1)
+        if self._action_chunk_size > 1:
+            # (..., action_chunk_size, tokens_per_single_action) -> (..., tokens_per_action)
+            action_tokens = action_tokens.flatten(-2)
         return action_tokens
 
     # The size of action_tokens is (tokens_per_action) or  (batch, tokens_per_action)
@@ -136,6 +165,10 @@ class RT1ActionTokenizer:
         """Detokenize an action."""
         action = {}
         token_index = 0
+        if self._action_chunk_size > 1:
+            # (..., tokens_per_action) -> (..., action_chunk_size, tokens_per_single_action)
+            # Every action below gets the extra dimension of action_chunk_size.
+            action_tokens = action_tokens.unflatten(-1, (self._action_chunk_size, self._tokens_per_single_action))
         # action_tokens is in self._action_order order
         # So we will detokenize in self._action_order order
         for k in self._action_order:
@@ -176,6 +176,37 @@ class ActionTokenizerTest(unittest.TestCase):
             for a, policy_a in zip(batched_action[k], policy_action[k]):
                 np.testing.assert_almost_equal(a.numpy(), policy_a.numpy(), decimal=2)
 
+    # Tokenize a chunk of 3 actions with batch and time dimensions.
+    def testTokenizeAndDetokenizeActionChunk(self):
+        action_space = spaces.Dict(
+            OrderedDict([('terminate', spaces.Discrete(2)),
+                         ('world_vector', spaces.Box(low=-1.0, high=1.0, shape=(3,), dtype=np.float32))])
+        )
+        action_chunk_size = 3
+        tokenizer = RT1ActionTokenizer(action_space, vocab_size=1024, action_chunk_size=action_chunk_size)
+        self.assertEqual(4, tokenizer.tokens_per_single_action)
+        self.assertEqual(12, tokenizer.tokens_per_action)
+
+        batch_size = 2
+        time_dimension = 4
+        action = {
+            'terminate': torch.randint(0, 2, (batch_size, time_dimension, action_chunk_size)),
+            'world_vector': torch.rand(batch_size, time_dimension, action_chunk_size, 3) * 2 - 1,
+        }
+        action_tokens = tokenizer.tokenize(action)
+        self.assertSequenceEqual([batch_size, time_dimension, 12], list(action_tokens.shape))
+
+        # Tokens of each action in the chunk are the same as tokenizing the action alone.
+        single_tokenizer = RT1ActionTokenizer(action_space, vocab_size=1024)
+        for i in range(action_chunk_size):
+            single_action_tokens = single_tokenizer.tokenize({k: v[:, :, i] for k, v in action.items()})
+            torch.testing.assert_close(action_tokens[..., i * 4:(i + 1) * 4], single_action_tokens)
+
+        policy_action = tokenizer.detokenize(action_tokens)
+        torch.testing.assert_close(policy_action['terminate'], action['terminate'].to(policy_action['terminate'].dtype))
+        self.assertSequenceEqual(list(action['world_vector'].shape), list(policy_action['world_vector'].shape))
+        np.testing.assert_allclose(action['world_vector'].numpy(), policy_action['world_vector'].numpy(), atol=1e-2)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -20,10 +20,12 @@
 """A FiLM Efficientnet contextual image tokenizer used in Robotics Transformer 1.
 """
 
-from typing import Optional
+import math
+from typing import Optional, Tuple
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from film_efficientnet.pretrained_efficientnet_encoder import EfficientNetEncoder
 from tokenizers.token_learner import TokenLearnerModule
@@ -33,24 +35,96 @@ class RT1ImageTokenizer(nn.Module):
     def __init__(self,
                  embedding_output_dim: int = 512,
                  use_token_learner: bool = False,
-                 num_tokens: int = 8):
+                 num_tokens: int = 8,
+                 film_cache_size: int = 0,
+                 # Maximum number of instructions whose specialized encoders are kept. If it is positive, inference
+                 # with one instruction for the whole batch runs the encoder specialized for the instruction, whose
+                 # FiLM layers are folded into its weights. See EfficientNetEncoder.specialize. 0 disables it.
+                 specialization_cache_size: int = 0,
+                 # If True, images and feature maps are kept in NHWC order (torch.channels_last).
+                 channels_last: bool = False,
+                 # (height, width) that images are resized to before EfficientNet. None keeps the size of the inputs.
+                 image_size: Optional[Tuple[int, int]] = None,
+                 # Initial weights of EfficientNet. 'imagenet' or None.
+                 efficientnet_weights: Optional[str] = 'imagenet'):
         super().__init__()
-        self._tokenizer = EfficientNetEncoder(token_embedding_size=embedding_output_dim, early_film=True, pooling=False)
+        self._tokenizer = EfficientNetEncoder(token_embedding_size=embedding_output_dim, weights=efficientnet_weights,
+                                              early_film=True, pooling=False, film_cache_size=film_cache_size,
+                                              specialization_cache_size=specialization_cache_size)
 
+        self._specialize = specialization_cache_size > 0
         self._use_token_learner = use_token_learner
         if self._use_token_learner:
             self._num_tokens = num_tokens
             self._token_learner = TokenLearnerModule(inputs_channels=512, num_tokens=self._num_tokens)
 
+        self._image_size = None if image_size is None else tuple(image_size)
+        # Records image_size in checkpoints so that they are not loaded into a model of another resolution.
+        # (0, 0) means that images are not resized.
+        self.register_buffer('_resolution', torch.tensor(self._image_size or (0, 0), dtype=torch.int64))
+
+        self._memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        if channels_last:
+            # Convolution weights are converted as well. Otherwise, convolutions convert inputs back to NCHW.
+            self.to(memory_format=torch.channels_last)
+
+    @property
+    def memory_format(self) -> torch.memory_format:
+        return self._memory_format
+
+    @property
+    def image_size(self) -> Optional[Tuple[int, int]]:
+        return self._image_size
+
     @property
     def tokens_per_context_image(self) -> int:
         if self._use_token_learner:
             num_tokens = self._num_tokens
+        elif self._image_size is not None:
+            # EfficientNet downsamples images by 32.
+            num_tokens = math.ceil(self._image_size[0] / 32) * math.ceil(self._image_size[1] / 32)
         else:
             # TODO: In tensorflow implementation, num_tokens = 81
             num_tokens = 100
         return num_tokens
 
+    # images: (b, 3, h, w)
+    def resize_images(self, images: torch.Tensor) -> torch.Tensor:
+        """Resizes images to image_size. Images of the right size are returned as they are."""
+        if self._image_size is None or tuple(images.shape[-2:]) == self._image_size:
+            return images
+        return F.interpolate(images, size=self._image_size, mode='bilinear', align_corners=False, antialias=True)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        key = prefix + '_resolution'
+        resolution = self._image_size or (0, 0)
+        if key in state_dict:
+            checkpoint_resolution = tuple(state_dict[key].tolist())
+            # (0, 0) is a checkpoint of a model that doesn't resize images, which only matches such a model.
+            if checkpoint_resolution != resolution:
+                error_msgs.append('The checkpoint was trained on {}, but this model {}.'.format(
+                    'images that weren\'t resized' if not any(checkpoint_resolution) else
+                    'images of size {}'.format(checkpoint_resolution),
+                    'doesn\'t resize images' if self._image_size is None else
+                    'resizes images to {}'.format(self._image_size)))
+        # Checkpoints saved before the resolution was recorded have no _resolution. The resolution of this model is
+        # kept in any case, so _resolution is left out of the loaded keys rather than overwritten in state_dict.
+        super()._load_from_state_dict({k: v for k, v in state_dict.items() if k != key}, prefix, local_metadata,
+                                      strict, missing_keys, unexpected_keys, error_msgs)
+        if key in missing_keys:
+            missing_keys.remove(key)
+        # With load_state_dict(assign=True), the buffer of a model made on the meta device isn't assigned.
+        if self._resolution.is_meta:
+            self._resolution = torch.tensor(resolution, dtype=torch.int64)
+
+    # Usually, every image of an episode has the same instruction. The specialized encoder is only used then, because
+    # it serves a single instruction.
+    def _encode(self, image: torch.Tensor, context: Optional[torch.Tensor]) -> torch.Tensor:
+        if self._specialize and not self.training and context is not None and bool(torch.all(context == context[:1])):
+            return self._tokenizer.specialize(context[0])(image, None)
+        return self._tokenizer(image, context=context)
+
     # Note that context is the same value along with time axis.
     # This means (b, 0, embedding_dim) == (b, 1, embedding_dim) == (b, 2, embedding_dim) ...
     def forward(self, image: torch.Tensor, context: Optional[torch.Tensor] = None) -> torch.Tensor:
@@ -68,20 +142,20 @@ class RT1ImageTokenizer(nn.Module):
         b, t, c, h, w = image.shape
 
         # Fold the time axis into the batch axis.
-        image = image.view(b * t, c, h, w)
+        image = self.resize_images(image.reshape(b * t, c, h, w)).contiguous(memory_format=self._memory_format)
         if context is not None:
             context = context.view(b * t, -1)
 
-        tokens = self._tokenizer(image, context=context)  # [b * t, 512 , 10, 10]
+        tokens = self._encode(image, context)  # [b * t, 512 , 10, 10]
 
         if self._use_token_learner:
             tokens = self._token_learner(tokens)  # [b * t, num_token, 512]
             # Unflatten the time axis, which was previously flattened into the batch.
-            tokens = tokens.view(b, t, tokens.shape[1], -1)
+            tokens = tokens.reshape(b, t, tokens.shape[1], -1)
             return tokens  # [b, t, num_token, 512]
         else:
             # Unflatten the time axis, which was previously flattened into the batch.
-            tokens = tokens.view(b, t, 512, -1)  # [b, t, 512 , 10 * 10]
+            tokens = tokens.reshape(b, t, 512, -1)  # [b, t, 512 , 10 * 10]
             # If you don't use token learner, the number of token is 100.
             tokens = tokens.transpose(2, 3)  # [b, t, 10 * 10, 512]
             return tokens
@@ -46,6 +46,80 @@ class ImageTokenizerTest(parameterized.TestCase, unittest.TestCase):
         else:
             self.assertEqual(list(image_tokens.shape), [batch, seq, 100, 512])
 
+    @parameterized.named_parameters(
+        ('without_token_learner', False),
+        ('token_learner', True))
+    def testChannelsLast(self, use_token_learner):
+        tokenizer = image_tokenizer.RT1ImageTokenizer(use_token_learner=use_token_learner)
+        channels_last_tokenizer = image_tokenizer.RT1ImageTokenizer(use_token_learner=use_token_learner,
+                                                                    channels_last=True)
+        channels_last_tokenizer.load_state_dict(tokenizer.state_dict())
+        tokenizer.eval()
+        channels_last_tokenizer.eval()
+
+        image = torch.rand(1, 2, 3, 128, 160)
+        context_vector = torch.rand(1, 2, 512)
+        with torch.no_grad():
+            image_tokens = tokenizer(image, context_vector)
+            channels_last_image_tokens = channels_last_tokenizer(image, context_vector)
+        torch.testing.assert_close(channels_last_image_tokens, image_tokens, rtol=1e-4, atol=1e-4)
+
+    @parameterized.named_parameters(
+        ('without_token_learner', False, 20),
+        ('token_learner', True, 8))
+    def testImageSize(self, use_token_learner, num_tokens):
+        tokenizer = image_tokenizer.RT1ImageTokenizer(use_token_learner=use_token_learner, image_size=(128, 160))
+        self.assertEqual(tokenizer.tokens_per_context_image, num_tokens)
+        image = torch.rand(1, 2, 3, 256, 320)
+        context_vector = torch.rand(1, 2, 512)
+        image_tokens = tokenizer(image, context_vector)
+        self.assertEqual(list(image_tokens.shape), [1, 2, num_tokens, 512])
+
+    def testSpecialization(self):
+        tokenizer = image_tokenizer.RT1ImageTokenizer(use_token_learner=True, efficientnet_weights=None)
+        for film in tokenizer._tokenizer._film_layers():
+            torch.nn.init.normal_(film._projection_add.weight, std=0.01)
+            torch.nn.init.normal_(film._projection_mult.weight, std=0.01)
+        specialized_tokenizer = image_tokenizer.RT1ImageTokenizer(use_token_learner=True, efficientnet_weights=None,
+                                                                  specialization_cache_size=1)
+        specialized_tokenizer.load_state_dict(tokenizer.state_dict())
+        tokenizer.eval()
+        specialized_tokenizer.eval()
+
+        image = torch.rand(2, 2, 3, 64, 64)
+        context_vector = torch.rand(512).expand(2, 2, 512)
+        with torch.no_grad():
+            expected = tokenizer(image, context_vector)
+            image_tokens = specialized_tokenizer(image, context_vector)
+            specialized_tokenizer(image, context_vector)
+            # Images of different instructions run the encoder with FiLM.
+            specialized_tokenizer(image, torch.rand(2, 2, 512))
+        torch.testing.assert_close(image_tokens, expected, rtol=1e-4, atol=1e-4)
+        self.assertEqual(specialized_tokenizer._tokenizer._specializations.misses, 1)
+        self.assertEqual(specialized_tokenizer._tokenizer._specializations.hits, 1)
+
+    def testImageSizeOfCheckpoint(self):
+        tokenizer = image_tokenizer.RT1ImageTokenizer(image_size=(128, 160))
+        state_dict = tokenizer.state_dict()
+
+        # Checkpoints without the resolution are loaded and keep the resolution of the model.
+        old_state_dict = {k: v for k, v in state_dict.items() if k != '_resolution'}
+        loaded_tokenizer = image_tokenizer.RT1ImageTokenizer(image_size=(128, 160))
+        loaded_tokenizer.load_state_dict(old_state_dict)
+        self.assertNotIn('_resolution', old_state_dict)
+        self.assertEqual(loaded_tokenizer.state_dict()['_resolution'].tolist(), [128, 160])
+        image_tokenizer.RT1ImageTokenizer().load_state_dict(image_tokenizer.RT1ImageTokenizer().state_dict())
+
+        with self.assertRaises(RuntimeError):
+            image_tokenizer.RT1ImageTokenizer(image_size=(64, 80)).load_state_dict(state_dict)
+        # A checkpoint of a model that doesn't resize images was trained on images of another size.
+        with self.assertRaises(RuntimeError):
+            image_tokenizer.RT1ImageTokenizer(image_size=(128, 160)).load_state_dict(
+                image_tokenizer.RT1ImageTokenizer().state_dict())
+        # A model that doesn't resize images would get inputs of another size than the checkpoint.
+        with self.assertRaises(RuntimeError):
+            image_tokenizer.RT1ImageTokenizer().load_state_dict(state_dict)
+
 
 if __name__ == '__main__':
     unittest.main()
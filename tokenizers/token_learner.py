@@ -62,6 +62,7 @@ class TokenLearnerModule(nn.Module):
 
     # inputs: [bs, c, h, w] or [bs * seq, c, h, w] 
     # seq is time-series length such as frame
+    # inputs can be in channels_last memory format. Then, all permutes and reshapes below are views without copies.
     def forward(self, inputs: torch.Tensor):
         # layer norm
         x = self.layerNorm(inputs.permute(0, 2, 3, 1))
@@ -73,12 +74,12 @@ class TokenLearnerModule(nn.Module):
         x = self.conv2(x)
         x = self.dropout2(x)  # (bs, num_tokens, h, w)
 
-        x = x.view(x.shape[0], x.shape[1], -1)  # (bs, num_tokens, h*w)
+        x = x.reshape(x.shape[0], x.shape[1], -1)  # (bs, num_tokens, h*w)
         weights_maps = F.softmax(x, dim=-1)
 
         # create tokens
         bs, c, h, w = inputs.shape
-        inputs = inputs.permute(0, 2, 3, 1).view(bs, h * w, c)
+        inputs = inputs.permute(0, 2, 3, 1).reshape(bs, h * w, c)
 
         tokens = torch.bmm(weights_maps, inputs)
         # weighs_maps: [bs, n_token, h*w]
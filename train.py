@@ -5,17 +5,16 @@ import random
 import time
 from collections import OrderedDict
 
-import matplotlib.pyplot as plt
 import numpy as np
 import torch
 import torch.nn.functional as F
 from gym import spaces
-from torch.utils.data import DataLoader, DistributedSampler
-from torch.utils.tensorboard import SummaryWriter
+from torch.utils.data import ConcatDataset, DataLoader
 from tqdm import tqdm
 
 import util.misc as utils
-from data.multiple_dataset import CombinedDataset
+from data.prefetcher import BatchPrefetcher
+from inference.artifact import save_artifact
 from tokenizers.utils import batched_space_sampler, np_to_tensor
 from transformer_network import TransformerNetwork
 from transformer_network_test_set_up import state_space_list
@@ -42,13 +41,15 @@ def set_seed(seed=3407):
 
 class Trainer:
     def __init__(self, args):
+        # The data pipeline imports tensorflow, tfds, reverb and rlds, and tensorboard is slow to import as well.
+        # They are imported here so that importing this module stays cheap.
+        from torch.utils.tensorboard import SummaryWriter
+
         set_seed()
         self.args = args
-        self.train_dataset = CombinedDataset(time_sequence_length=self.args["time_sequence_length"])
         self.args = utils.init_distributed_mode(self.args)
+        self.train_dataset, self.sampler_train, self.worker_init_fn = self._train_dataset()
         self.checkpoint_dir, self.tensorboard_dir = self.make_log_dir(self.args["log_dir"])
-        if self.args["distributed"]:
-            self.sampler_train = DistributedSampler(self.train_dataset, shuffle=True)
 
         self.args["checkpoint_dir"] = self.checkpoint_dir
         self.writer_train = SummaryWriter(self.tensorboard_dir, flush_secs=5)
@@ -80,37 +81,85 @@ class Trainer:
         self.device = torch.device(self.args["device"])
         self.train_step = 0
 
+    # Trajectory stores written by data.trajectory_store are read from local disk, shuffled by a WindowSampler.
+    # Otherwise each DataLoader worker of each rank reads its own shard of the TFDS episodes.
+    # Returns the dataset, its sampler and worker_init_fn of DataLoader.
+    def _train_dataset(self):
+        time_sequence_length = self.args["time_sequence_length"]
+        action_chunk_size = self.args.get("action_chunk_size", 1)
+        trajectory_store_dirs = self.args.get("trajectory_store_dirs")
+        if trajectory_store_dirs:
+            from data.trajectory_store import TrajectoryDataset, WindowSampler
+
+            stores = [TrajectoryDataset(d, time_sequence_length, action_chunk_size) for d in trajectory_store_dirs]
+            dataset = ConcatDataset(stores)
+            group_sizes, weights = None, None
+            if self.args.get("dataset_weights"):
+                group_sizes = [len(store) for store in stores]
+                weights = self._store_weights(trajectory_store_dirs, stores, self.args["dataset_weights"])
+            sampler = WindowSampler(len(dataset), seed=self.args.get("seed", 0), rank=self.args["rank"],
+                                    world_size=self.args["world_size"], group_sizes=group_sizes, weights=weights)
+            return dataset, sampler, None
+        from data.multiple_dataset import CombinedIterableDataset, worker_init_fn
+
+        dataset = CombinedIterableDataset(time_sequence_length=time_sequence_length,
+                                          action_chunk_size=action_chunk_size,
+                                          image_size=self._image_size(self.args["network_configs"]),
+                                          dataset_weights=self.args.get("dataset_weights"),
+                                          rank=self.args["rank"],
+                                          world_size=self.args["world_size"],
+                                          log_interval=self.args.get("data_log_interval"))
+        return dataset, None, worker_init_fn
+
+    # Weights of trajectory stores from dataset_weights, by dataset_name of their meta.json. Like CombinedIterableDataset,
+    # datasets that are not in dataset_weights aren't used. The weight of a dataset written to several stores is split
+    # between them by their numbers of trajectories.
+    @staticmethod
+    def _store_weights(trajectory_store_dirs, stores, dataset_weights):
+        names = [store.store.meta.get("dataset_name") for store in stores]
+        if None in names:
+            raise ValueError("dataset_weights is set, but trajectory store {} has no dataset_name.".format(
+                trajectory_store_dirs[names.index(None)]))
+        sizes = {}
+        for name, store in zip(names, stores):
+            sizes[name] = sizes.get(name, 0) + len(store)
+        return [dataset_weights.get(name, 0.0) * len(store) / sizes[name] if sizes[name] else 0.0
+                for name, store in zip(names, stores)]
+
+    # Images are resized to crop_size of the network by the data pipeline. None keeps the default size of the data.
+    @staticmethod
+    def _image_size(network_configs):
+        crop_size = network_configs.get("crop_size")
+        if isinstance(crop_size, int):
+            crop_size = (crop_size, crop_size)
+        return crop_size
+
     def train(self):
         print("training")
 
         # Set random seed for reproducibility
         set_seed()
 
-        # Create dataloader based on distributed or single-machine settings
-        if self.args["distributed"]:
-            # Batch sampler for distributed training
-            batch_sampler_train = torch.utils.data.BatchSampler(
-                self.sampler_train, self.args["batch_size"], drop_last=True
-            )
-            train_dataloader = DataLoader(
-                self.train_dataset,
-                batch_sampler=batch_sampler_train,
-                num_workers=self.args["batch_size"],
-            )
-        else:
-            # DataLoader for single-machine training
-            train_dataloader = DataLoader(
-                self.train_dataset,
-                batch_size=self.args["batch_size"],
-                num_workers=0,
-                shuffle=True,
-                drop_last=True,
-            )
+        # The sampler or the dataset itself shards and shuffles the data, for both distributed and single-machine
+        # training. Persistent workers keep their data pipelines across epochs.
+        num_workers = self.args.get("num_workers", 2)
+        train_dataloader = DataLoader(
+            self.train_dataset,
+            batch_size=self.args["batch_size"],
+            sampler=self.sampler_train,
+            num_workers=num_workers,
+            persistent_workers=num_workers > 0,
+            worker_init_fn=self.worker_init_fn,
+            drop_last=True,
+        )
+        # Batches are copied to the device on a side stream while the previous step runs.
+        train_batches = BatchPrefetcher(train_dataloader, self.device)
 
         # Initialize the TransformerNetwork based on specified configurations
         network_configs = self.args["network_configs"]
         # Modify network configuration based on specific settings
         network_configs["time_sequence_length"] = self.args["time_sequence_length"]
+        network_configs["action_chunk_size"] = self.args.get("action_chunk_size", 1)
         # network_configs["num_encoders"] = len(self.args["cam_view"])
         network_configs["token_embedding_size"] = network_configs["token_embedding_size_per_image"]
         del network_configs["token_embedding_size_per_image"]
@@ -163,16 +212,16 @@ class Trainer:
 
         epoch_start = checkpoint["epoch"] if self.args["resume"] else 0
         for e in range(epoch_start, self.args["epochs"]):
+            if self.sampler_train is not None:
+                self.sampler_train.set_epoch(e)
             network.train()
-            with tqdm(train_dataloader, dynamic_ncols=True, desc="train") as tqdmDataLoader:
+            with tqdm(train_batches, dynamic_ncols=True, desc="train") as tqdmDataLoader:
                 for _, item in enumerate(tqdmDataLoader):
                     # Perform training steps
                     obs = item['observation']
                     action = item['action']
                     optimizer.zero_grad()
-                    network_without_ddp.set_actions(
-                        self.dict_to_device(action, self.device)
-                    )
+                    network_without_ddp.set_actions(action)
                     network_state = batched_space_sampler(
                         network_without_ddp._state_space,
                         batch_size=self.args["batch_size"],
@@ -181,7 +230,7 @@ class Trainer:
                     # if self.args["using_proprioception"]:
                     #     obs = self.calc_fk(obs)
                     output_actions, network_state = network(
-                        self.dict_to_device(obs, self.device),
+                        obs,
                         self.dict_to_device(network_state, self.device),
                     )
 
@@ -244,6 +293,9 @@ class Trainer:
                     "epoch": e,
                 }
                 utils.save_on_master(checkpoint, checkpoint_filename)
+                # Weights-only artifact for deployment. See inference/artifact.py.
+                if utils.is_main_process():
+                    save_artifact(network_without_ddp, os.path.join(self.checkpoint_dir, str(e) + "-policy.pt"))
                 print('Save checkpoint')
                 if self.args["distributed"]:
                     # Barrier synchronization for distributed training
@@ -419,6 +471,8 @@ class Trainer:
 
     @torch.no_grad()
     def visualize(self, all_gt, all_output, fn):
+        import matplotlib.pyplot as plt
+
         all_output = all_output[:, -1, :]
         all_gt = all_gt[:, -1, :]
         title = [
@@ -49,7 +49,10 @@ class TF_MultiHeadAttention(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.out = nn.Linear(self.h * self.value_dim, d_model)
 
-    def forward(self, q, k, v, mask=None):
+    # kv_cache: optional (key_cache, value_cache) with size of (bs, h, max_sl, key_dim) and (bs, h, max_sl, value_dim).
+    # If it is given, keys and values of this call are written into the caches at cache_positions (bs, sl), and the
+    # queries attend to the whole caches. Positions that have not been written yet must be masked out by mask.
+    def forward(self, q, k, v, mask=None, kv_cache=None, cache_positions=None):
 
         bs = q.size(0)
 
@@ -65,6 +68,15 @@ class TF_MultiHeadAttention(nn.Module):
         q = q.transpose(1, 2)
         v = v.transpose(1, 2)  # calculate attention using function we will define next
 
+        if kv_cache is not None:
+            key_cache, value_cache = kv_cache
+            index = cache_positions[:, None, :, None]  # (bs, 1, sl, 1)
+            # write in place so that the caches keep keys and values for the following calls.
+            key_cache.scatter_(2, index.expand(-1, self.h, -1, self.key_dim), k)
+            value_cache.scatter_(2, index.expand(-1, self.h, -1, self.value_dim), v)
+            k = key_cache  # (bs, h, max_sl, key_dim)
+            v = value_cache  # (bs, h, max_sl, value_dim)
+
         if self.return_attention_scores:
             # attention_output: (bs, h, sl, value_dim), score: (bs, h, sl, sl)
             attention_output, score = attention(q, k, v, self.key_dim, mask, self.dropout,
@@ -91,8 +103,10 @@ def attention(q, k, v, key_dim, mask=None, dropout=None, return_attention_scores
     # score: (bs, h, sl, sl)
 
     if mask is not None:
-        # mask: (sl, sl)
-        mask = mask.unsqueeze(0).unsqueeze(1)
+        # mask: (sl, sl) shared by all batches or (bs, sl, sl) for each batch.
+        if mask.dim() == 2:
+            mask = mask.unsqueeze(0)
+        mask = mask.unsqueeze(1)
         scores = scores.masked_fill(mask == 0, -1e9)
 
     scores = F.softmax(scores, dim=-1)
@@ -134,9 +148,11 @@ class _TransformerLayer(nn.Module):
         self.norm_2 = nn.LayerNorm(feed_forward_size)
         self.dropout_1 = nn.Dropout(dropout_rate)
 
-    def forward(self, x: torch.Tensor, mask: torch.Tensor) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    def forward(self, x: torch.Tensor, mask: torch.Tensor,
+                kv_cache: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+                cache_positions: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
         x1 = self.norm_1(x)
-        attn_results = self.attn(x1, x1, x1, mask=mask)
+        attn_results = self.attn(x1, x1, x1, mask=mask, kv_cache=kv_cache, cache_positions=cache_positions)
         if self._return_attention_scores:
             x1, score = attn_results
         else:
@@ -186,7 +202,13 @@ class Transformer(nn.Module):
         self._output_tokens = nn.Linear(feed_forward_size, vocab_size)
 
     # inputs: (bs, seq, emb_dim). emb_dim = vocab_size
-    def forward(self, inputs: torch.Tensor, attention_mask: torch.Tensor) \
+    # position_ids: (bs, seq). If None, inputs are assumed to start at position 0.
+    # kv_caches: optional list of (key_cache, value_cache) for each layer. See TF_MultiHeadAttention.
+    # cache_positions: (bs, seq). Where keys and values of inputs are written in the caches. If None, position_ids.
+    def forward(self, inputs: torch.Tensor, attention_mask: torch.Tensor,
+                position_ids: Optional[torch.Tensor] = None,
+                kv_caches: Optional[List[Tuple[torch.Tensor, torch.Tensor]]] = None,
+                cache_positions: Optional[torch.Tensor] = None) \
             -> Union[torch.Tensor, Tuple[torch.Tensor, List[torch.Tensor]]]:
         batch_size = inputs.shape[0]
         seq_len = inputs.shape[1]
@@ -195,8 +217,11 @@ class Transformer(nn.Module):
         tokens_embeddings = self._token_emb(inputs)  # (bs, seq_len, feed_forward_size)
 
         # 2. Transformer Positional Embedding：
-        position_ids = torch.arange(seq_len, dtype=torch.long, device=inputs.device)
-        position_ids = torch.tile(position_ids.unsqueeze(0), dims=(batch_size, 1))  # (bs, seq_len)
+        if position_ids is None:
+            position_ids = torch.arange(seq_len, dtype=torch.long, device=inputs.device)
+            position_ids = torch.tile(position_ids.unsqueeze(0), dims=(batch_size, 1))  # (bs, seq_len)
+        if kv_caches is not None and cache_positions is None:
+            cache_positions = position_ids
         position_embeddings = self._position_emb(position_ids)  # (bs, seq_len, feed_forward_size)
 
         # Add the two embedded tensors together
@@ -204,8 +229,9 @@ class Transformer(nn.Module):
 
         scores = []
 
-        for layer in self._layers:
-            x, score = layer(x, mask=attention_mask)
+        for i, layer in enumerate(self._layers):
+            kv_cache = kv_caches[i] if kv_caches is not None else None
+            x, score = layer(x, mask=attention_mask, kv_cache=kv_cache, cache_positions=cache_positions)
             if score is not None:
                 scores.append(score)
         x = self._output_tokens(x)  # (bs, seq_len, vocab_size)
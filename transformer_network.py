@@ -55,12 +55,69 @@ class TransformerNetwork(nn.Module):
             # This corresponds to d_model which is embedding dimension of each token in transformer part.
             dropout_rate: float = 0.1,
             time_sequence_length: int = 1,
-            crop_size: int = 236,
+            # Size that images are resized to before the image tokenizer. An int means square images of
+            # (crop_size, crop_size) and a pair means (height, width). None keeps the size of the input images.
+            # Checkpoints record it and can't be loaded into a network of another size.
+            crop_size: Optional[Union[int, Tuple[int, int]]] = None,
             # action_order: Optional[List[str]] = None,
             use_token_learner: Optional[bool] = True,
-            return_attention_scores: bool = False):
+            return_attention_scores: bool = False,
+            # If True, inference keeps keys and values of every transformer layer in network_state
+            # and only computes the tokens of the new time step until the window is full. This only speeds up the
+            # first time_sequence_length - 1 steps of an episode. Once the window shifts, every step runs one pass
+            # over the whole window and also writes the caches, so it is slower than parallel_decoding. For long
+            # episodes, use ring_buffer_state or parallel_decoding instead. See _transformer_call_with_kv_cache.
+            use_kv_cache: bool = False,
+            # If True, inference produces all action tokens of a time step from one transformer pass
+            # instead of calling transformer tokens_per_action times.
+            parallel_decoding: bool = False,
+            # If True, network_state is a ring buffer with a write pointer. New tokens are written in place
+            # and the window is never shifted.
+            ring_buffer_state: bool = False,
+            # Maximum number of instructions whose FiLM parameters are cached at inference. 0 disables the cache.
+            film_cache_size: int = 0,
+            # Maximum number of instructions whose EfficientNet, specialized by EfficientNetEncoder.specialize, is
+            # kept. If it is positive, inference steps whose images all have the same instruction run the
+            # specialized EfficientNet, whose FiLM layers are folded. Each one is a copy of EfficientNet. 0 disables it.
+            specialization_cache_size: int = 0,
+            # If True, the image path runs in NHWC order (torch.channels_last) from preprocessing to TokenLearner.
+            channels_last: bool = False,
+            # Number of future actions predicted at each time step. With action_chunk_size K > 1, one time step
+            # covers K control steps: actions set by set_actions are (b, t, K, ...) and inference outputs the next
+            # K actions (b, K, ...) at once.
+            action_chunk_size: int = 1,
+            # If set, inference reuses the image tokens of the last encoded frame when the mean absolute difference
+            # between downsampled images of the new frame and that frame is below this threshold. Images are in [0, 1].
+            # The instruction is assumed to be fixed within an episode.
+            motion_gate_threshold: Optional[float] = None,
+            # Initial weights of EfficientNet. 'imagenet' loads ImageNet weights. None skips loading them, e.g. when
+            # all weights are restored from a checkpoint anyway.
+            efficientnet_weights: Optional[str] = 'imagenet'):
         super().__init__()
 
+        # Arguments that rebuild this network together with the spaces. See get_config.
+        self._config = {
+            'vocab_size': vocab_size,
+            'token_embedding_size': token_embedding_size,
+            'num_layers': num_layers,
+            'layer_size': layer_size,
+            'num_heads': num_heads,
+            'feed_forward_size': feed_forward_size,
+            'dropout_rate': dropout_rate,
+            'time_sequence_length': time_sequence_length,
+            'crop_size': crop_size,
+            'use_token_learner': use_token_learner,
+            'return_attention_scores': return_attention_scores,
+            'use_kv_cache': use_kv_cache,
+            'parallel_decoding': parallel_decoding,
+            'ring_buffer_state': ring_buffer_state,
+            'film_cache_size': film_cache_size,
+            'specialization_cache_size': specialization_cache_size,
+            'channels_last': channels_last,
+            'action_chunk_size': action_chunk_size,
+            'motion_gate_threshold': motion_gate_threshold,
+        }
+
         self._loss = None
         self._aux_info = None
         self._input_tensor_space = input_tensor_space
@@ -71,9 +128,39 @@ class TransformerNetwork(nn.Module):
         self._vocab_size = vocab_size
         self._token_embedding_size = token_embedding_size
         self._time_sequence_length = time_sequence_length
-        self._crop_size = crop_size
+        if isinstance(crop_size, int):
+            crop_size = (crop_size, crop_size)
+        self._crop_size = None if crop_size is None else tuple(crop_size)
+        self._num_layers = num_layers
+        self._use_kv_cache = use_kv_cache
+        self._parallel_decoding = parallel_decoding
+        self._ring_buffer_state = ring_buffer_state
+        self._action_chunk_size = action_chunk_size
+        self._motion_gate_threshold = motion_gate_threshold
+        self._motion_gate_thumbnail_size = (16, 16)
+        self._num_reused_images = 0
+        self._num_encoded_images = 0
+
+        # create tokenizers
+        rt1_image_tokenizer = image_tokenizer.RT1ImageTokenizer(
+            embedding_output_dim=self._token_embedding_size,
+            use_token_learner=use_token_learner,
+            num_tokens=8,
+            film_cache_size=film_cache_size,
+            specialization_cache_size=specialization_cache_size,
+            channels_last=channels_last,
+            image_size=self._crop_size,
+            efficientnet_weights=efficientnet_weights)
+        rt1_action_tokenizer = action_tokenizer.RT1ActionTokenizer(
+            output_tensor_space,  # action space
+            vocab_size=self._vocab_size,
+            action_chunk_size=action_chunk_size)
 
         # create transformer
+        # The position embedding covers the whole window, which grows with the action chunk. It is never smaller
+        # than the default so that checkpoints of shorter windows still load.
+        max_seq_len = max(256, time_sequence_length * (
+            rt1_image_tokenizer.tokens_per_context_image + rt1_action_tokenizer.tokens_per_action))
         self._transformer = transformer.Transformer(
             num_layers=num_layers,
             layer_size=layer_size,
@@ -82,18 +169,14 @@ class TransformerNetwork(nn.Module):
             dropout_rate=dropout_rate,
             vocab_size=self._vocab_size,
             input_token_emb_dim=self._token_embedding_size,
-            return_attention_scores=return_attention_scores)
-
-        # create tokenizers
-        self._image_tokenizer = image_tokenizer.RT1ImageTokenizer(
-            embedding_output_dim=self._token_embedding_size,
-            use_token_learner=use_token_learner,
-            num_tokens=8)
-        self._action_tokenizer = action_tokenizer.RT1ActionTokenizer(
-            output_tensor_space,  # action space
-            vocab_size=self._vocab_size)
+            return_attention_scores=return_attention_scores,
+            max_seq_len=max_seq_len)
+        # Submodules are registered after the transformer as before, which keeps the order of the parameters.
+        self._image_tokenizer = rt1_image_tokenizer
+        self._action_tokenizer = rt1_action_tokenizer
 
         # Get the number of tokens
+        # With action chunks, tokens of all actions in the chunk are the action tokens of one time step.
         self._tokens_per_action = self._action_tokenizer.tokens_per_action
         self._tokens_per_context_image = self._image_tokenizer.tokens_per_context_image
 
@@ -111,33 +194,70 @@ class TransformerNetwork(nn.Module):
 
         # this is used only when random sampling 
         # when sampling, the output is used as network_state
-        self._state_space = spaces.Dict(
-            {
-                'context_image_tokens':
-                    spaces.Box(low=-np.inf, high=np.inf,
-                               shape=(time_sequence_length, self._tokens_per_context_image, token_embedding_size),
-                               dtype=np.float32),
-                'action_tokens':
-                    spaces.MultiDiscrete(np.full((time_sequence_length, self._tokens_per_action), vocab_size)),
-                # Stores where in the window we are.
-                # This value is within range [0, time_sequence_length + 1].
-                # When seq_idx == time_sequence_length, context_image_tokens and
-                # action_tokens need to be shifted to the left.
-                'seq_idx':
-                    spaces.Discrete(time_sequence_length + 1)
-                # Our data:
-                # context_image_tokens + action_tokens + context_image_tokens + action_tokens + context_image_tokens ...
-                # 1 time step means [context_image_tokens + action_tokens]
-                # seq_idx means which time steps we are.
-                # But it is adjusted to time_sequence_length when it exceeds time_sequence_length.
-            }
-        )
+        state_space = {
+            'context_image_tokens':
+                spaces.Box(low=-np.inf, high=np.inf,
+                           shape=(time_sequence_length, self._tokens_per_context_image, token_embedding_size),
+                           dtype=np.float32),
+            'action_tokens':
+                spaces.MultiDiscrete(np.full((time_sequence_length, self._tokens_per_action), vocab_size)),
+            # Stores where in the window we are.
+            # This value is within range [0, time_sequence_length + 1].
+            # When seq_idx == time_sequence_length, context_image_tokens and
+            # action_tokens need to be shifted to the left.
+            'seq_idx':
+                spaces.Discrete(time_sequence_length + 1)
+            # Our data:
+            # context_image_tokens + action_tokens + context_image_tokens + action_tokens + context_image_tokens ...
+            # 1 time step means [context_image_tokens + action_tokens]
+            # seq_idx means which time steps we are.
+            # But it is adjusted to time_sequence_length when it exceeds time_sequence_length.
+        }
+        if ring_buffer_state:
+            # Stores where in the ring buffer the next time step is written.
+            # context_image_tokens and action_tokens are never shifted. Instead, the slot at write_idx holds the
+            # current time step and the other slots follow it in the order they were written.
+            state_space['write_idx'] = spaces.Discrete(time_sequence_length)
+        if use_kv_cache:
+            # Keys and values of all tokens in the window for each transformer layer.
+            # In RT-1 we don't set value_dim. Therefore, values have the same size as keys.
+            kv_cache_shape = (num_layers, num_heads, self._all_num_tokens, layer_size)
+            state_space['key_cache'] = spaces.Box(low=-np.inf, high=np.inf, shape=kv_cache_shape, dtype=np.float32)
+            state_space['value_cache'] = spaces.Box(low=-np.inf, high=np.inf, shape=kv_cache_shape, dtype=np.float32)
+        if motion_gate_threshold is not None:
+            # Downsampled image and image tokens of the last encoded frame.
+            state_space['gate_thumbnail'] = spaces.Box(low=0.0, high=1.0,
+                                                       shape=(3,) + self._motion_gate_thumbnail_size,
+                                                       dtype=np.float32)
+            state_space['gate_image_tokens'] = spaces.Box(
+                low=-np.inf, high=np.inf, shape=(self._tokens_per_context_image, token_embedding_size),
+                dtype=np.float32)
+        self._state_space = spaces.Dict(state_space)
 
     @property
     def attention_scores(self) -> List[torch.Tensor]:
         """Return attention score. This is for debugging/visualization purpose."""
         return self._attention_scores
 
+    def get_config(self) -> Dict[str, Any]:
+        """Return the arguments of this network except the spaces, train_step_counter and efficientnet_weights."""
+        return dict(self._config)
+
+    @property
+    def motion_gate_stats(self) -> Dict[str, int]:
+        """Return the number of images whose tokens were reused and encoded by the motion gate."""
+        return {'reused': self._num_reused_images, 'encoded': self._num_encoded_images}
+
+    @property
+    def action_chunk_size(self) -> int:
+        """Return the number of actions predicted at each time step."""
+        return self._action_chunk_size
+
+    @property
+    def action_tokenizer(self):
+        """Return the action tokenizer that detokenizes the outputs of infer_from_image_tokens."""
+        return self._action_tokenizer
+
     def _get_action_index_for_token(self, k):
         """Returns action associated with the token at given position `k`.
 
@@ -183,7 +303,9 @@ class TransformerNetwork(nn.Module):
         # The look ahead mask ensures causality.
         # This is a lower triangular matrix. All elements other than 0 are 1. 
         # 0 means mask.
-        self._default_attention_mask = torch.tril(torch.ones((self._all_num_tokens, self._all_num_tokens), dtype=torch.uint8))
+        # The mask is always made on CPU, even when the network is built on the meta device.
+        default_attention_mask = torch.tril(torch.ones((self._all_num_tokens, self._all_num_tokens), dtype=torch.uint8,
+                                                       device='cpu'))
 
         action_mask = np.ndarray(
             shape=(self._all_num_tokens, self._all_num_tokens), dtype=int)
@@ -201,8 +323,20 @@ class TransformerNetwork(nn.Module):
                     if action_j == action_i and j <= i:
                         mask = 1
                 action_mask[i, j] = mask
-        self._default_attention_mask -= action_mask
-        self._default_attention_mask = self._default_attention_mask.to('cuda')
+        default_attention_mask -= action_mask
+        # Register the mask as a non-persistent buffer so that it follows the network to any device
+        # without being saved in checkpoints.
+        self.register_buffer('_default_attention_mask', default_attention_mask, persistent=False)
+
+        if self._ring_buffer_state:
+            # The ring buffer stores the window rotated by one of time_sequence_length shifts. The attention mask of
+            # each shift is made here once instead of being gathered from _default_attention_mask at every step.
+            # (t, t*num_tokens, t*num_tokens)
+            ring_buffer_attention_masks = torch.stack([
+                default_attention_mask[positions[:, None], positions[None, :]]
+                for positions in self._ring_buffer_shift_token_positions(
+                    torch.arange(self._time_sequence_length, device='cpu'))])
+            self.register_buffer('_ring_buffer_attention_masks', ring_buffer_attention_masks, persistent=False)
 
     def forward(self,
                 observations: Dict[str, torch.Tensor], network_state: Dict[str, torch.Tensor],
@@ -238,67 +372,8 @@ class TransformerNetwork(nn.Module):
         self._aux_info = {'action_labels': action_tokens}
 
         if outer_rank == 1:  # This is an inference call
-            # run transformer in loop to produce action tokens one-by-one
-            seq_idx = network_state['seq_idx'][0]
-            action_t = torch.minimum(seq_idx,
-                                     torch.tensor(self._time_sequence_length - 1))
-            # Transformer shifts all to the left by one step by default (it's usually
-            # predicting the next token as default training task...).
-            transformer_shift = -1
-            # We only want to get the action predicted at time_step.
-            # This index means the output of the last observation token that is at action_t time step.
-            start_index = (
-                    transformer_shift + self._tokens_per_context_image + action_t * self._single_time_step_num_tokens)
-            current_action_tokens = []
-            action_predictions_logits = []
-            # Repeat inference tokens_per_action times.
-            for k in range(self._tokens_per_action):
-                action_index = start_index + k
-                # token: (1, 1)
-                # token_logits: (1, 1 vocab_size)
-                token, token_logits = self._transformer_call_and_slice(
-                    context_image_tokens,
-                    action_tokens,
-                    attention_mask=attention_mask,
-                    batch_size=b,
-                    slice_start=action_index  # slicing single action dimension
-                )
-                action_predictions_logits.append(token_logits)
-                current_action_tokens.append(token)
-
-                # Add the predicted token to action_tokens
-                # [b, t, self._tokens_per_action] -> [b, t * self._tokens_per_action]
-                action_tokens = action_tokens.view(b, -1)
-                action_start_index = (action_t * self._tokens_per_action) + k
-                # replace action_tokens[:, action_start_index] with the predicted token. Note that this is not insert.
-                action_tokens = torch.concat([
-                    action_tokens[:, :action_start_index], token,
-                    action_tokens[:, action_start_index + 1:]
-                ], dim=1)
-                # [b, t * self._tokens_per_action] -> [b, t, self._tokens_per_action]
-                action_tokens = action_tokens.view(b, t, self._tokens_per_action)
-
-            self._aux_info.update({
-                # action_predictions_logits is
-                # [1, self._tokens_per_action, self._vocab_size]
-                'action_predictions_logits': torch.concat(action_predictions_logits, 1)
-            })
-
-            predicted_tokens_for_output = torch.concat(current_action_tokens, 1)  # [1, self._tokens_per_action]
-            one_state_action_tokens = predicted_tokens_for_output.unsqueeze(1)  # [1, 1, self._tokens_per_action]
-
-            # Add predicted action tokens  to network_state['action_tokens']
-            state_action_tokens = network_state['action_tokens']  # (1, time_sequence_length, self._tokens_per_action)
-            # replace state_action_tokens[:, action_t, ...] with the predicted tokens. Note that this is not insert.
-            network_state['action_tokens'] = torch.concat([
-                state_action_tokens[:, :action_t, ...], one_state_action_tokens,
-                state_action_tokens[:, action_t + 1:, ...]
-            ], dim=1)
-
-            # Increment the time_step for the next inference call.
-            # network_state['seq_idx'] never exceed time_sequence_length.
-            network_state['seq_idx'] = torch.minimum(seq_idx + 1,
-                                                     torch.tensor(self._time_sequence_length))
+            predicted_tokens_for_output, network_state = self._infer_action_tokens(
+                context_image_tokens, action_tokens, attention_mask, network_state)
 
             self._loss = torch.tensor(0.0)
 
@@ -350,6 +425,176 @@ class TransformerNetwork(nn.Module):
         # network_stape is the past state that is used for next inference.
         return output_actions, network_state
 
+    # Predicts action tokens of the current time step at inference and updates network_state.
+    # context_image_tokens and action_tokens already contain the current time step.
+    # Returns predicted tokens (b, self._tokens_per_action) and network_state.
+    def _infer_action_tokens(self,
+                             context_image_tokens: torch.Tensor,  # (b, t, num token, emb_dim)
+                             action_tokens: torch.Tensor,  # (b, t, self._tokens_per_action)
+                             attention_mask: torch.Tensor,
+                             network_state: Dict[str, torch.Tensor]) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
+        b, t = self._get_batch_size_and_seq_len(network_state)
+        # run transformer in loop to produce action tokens one-by-one
+        # Each episode in the batch has its own seq_idx. seq_idx: (b,)
+        seq_idx = network_state['seq_idx']
+        action_t = torch.clamp(seq_idx, max=self._time_sequence_length - 1)  # (b,)
+        # Transformer shifts all to the left by one step by default (it's usually
+        # predicting the next token as default training task...).
+        transformer_shift = -1
+        if self._ring_buffer_state:
+            # The current time step is at write_idx of the ring buffer.
+            # Position embeddings and attention mask are mapped onto the logical order of the window.
+            step_slot = network_state['write_idx']  # (b,)
+            shift = self._ring_buffer_shift(network_state)  # (b,)
+            position_ids = self._ring_buffer_shift_token_positions(shift)  # (b, t*num_tokens)
+            attention_mask = self._ring_buffer_attention_masks[shift]  # (b, t*num_tokens, t*num_tokens)
+        else:
+            step_slot = action_t
+            position_ids = None
+        # We only want to get the action predicted at time_step.
+        # This index means the output of the last observation token that is at action_t time step.
+        start_index = (
+                transformer_shift + self._tokens_per_context_image + step_slot * self._single_time_step_num_tokens)
+        # start_index: (b,)
+        if self._use_kv_cache:
+            # All action tokens of the current time step come out of one incremental pass.
+            # output_tokens: (b, self._single_time_step_num_tokens, vocab_size)
+            output_tokens = self._transformer_call_with_kv_cache(
+                context_image_tokens,
+                action_tokens,
+                network_state=network_state,
+                seq_idx=seq_idx,
+                step_slot=step_slot,
+                batch_size=b,
+                attention_mask=attention_mask,
+                token_positions=position_ids)
+            action_index = transformer_shift + self._tokens_per_context_image
+            # [b, self._tokens_per_action, self._vocab_size]
+            action_predictions_logits = output_tokens[:, action_index:action_index + self._tokens_per_action]
+            predicted_tokens_for_output = torch.argmax(action_predictions_logits, dim=-1)
+        elif self._parallel_decoding:
+            # _assemble_input_token_sequence zeroes all action tokens, so predicted tokens are never fed back
+            # into transformer and every call in the loop below sees the same input.
+            # Therefore, the action tokens of this time step are the contiguous outputs of a single pass.
+            # predicted_tokens_for_output: [b, self._tokens_per_action]
+            # action_predictions_logits: [b, self._tokens_per_action, self._vocab_size]
+            predicted_tokens_for_output, action_predictions_logits = self._transformer_call_and_slice(
+                context_image_tokens,
+                action_tokens,
+                attention_mask=attention_mask,
+                batch_size=b,
+                position_ids=position_ids,
+                slice_start=start_index,
+                slice_length=self._tokens_per_action  # slicing all action dimensions
+            )
+        else:
+            current_action_tokens = []
+            action_predictions_logits = []
+            # Repeat inference tokens_per_action times.
+            for k in range(self._tokens_per_action):
+                action_index = start_index + k
+                # token: (b, 1)
+                # token_logits: (b, 1 vocab_size)
+                token, token_logits = self._transformer_call_and_slice(
+                    context_image_tokens,
+                    action_tokens,
+                    attention_mask=attention_mask,
+                    batch_size=b,
+                    position_ids=position_ids,
+                    slice_start=action_index  # slicing single action dimension
+                )
+                action_predictions_logits.append(token_logits)
+                current_action_tokens.append(token)
+
+                # Add the predicted token to action_tokens
+                # [b, t, self._tokens_per_action] -> [b, t * self._tokens_per_action]
+                action_tokens = action_tokens.reshape(b, -1)
+                action_start_index = (step_slot * self._tokens_per_action) + k  # (b,)
+                # replace action_tokens[i, action_start_index[i]] with the predicted token. Note that this is not
+                # insert.
+                action_tokens = action_tokens.scatter(1, action_start_index.unsqueeze(1),
+                                                      token.to(action_tokens.dtype))
+                # [b, t * self._tokens_per_action] -> [b, t, self._tokens_per_action]
+                action_tokens = action_tokens.view(b, t, self._tokens_per_action)
+
+            action_predictions_logits = torch.concat(action_predictions_logits, 1)
+            predicted_tokens_for_output = torch.concat(current_action_tokens, 1)  # [b, self._tokens_per_action]
+
+        self._aux_info.update({
+            # action_predictions_logits is
+            # [b, self._tokens_per_action, self._vocab_size]
+            'action_predictions_logits': action_predictions_logits
+        })
+
+        one_state_action_tokens = predicted_tokens_for_output.unsqueeze(1)  # [b, 1, self._tokens_per_action]
+
+        # Add predicted action tokens  to network_state['action_tokens']
+        state_action_tokens = network_state['action_tokens']  # (b, time_sequence_length, self._tokens_per_action)
+        if self._ring_buffer_state:
+            # Write the predicted tokens in place and advance the write pointer.
+            batch_index = torch.arange(b, device=step_slot.device)
+            state_action_tokens[batch_index, step_slot] = predicted_tokens_for_output.to(state_action_tokens.dtype)
+            network_state['write_idx'] = torch.remainder(step_slot + 1, self._time_sequence_length)
+        else:
+            # replace state_action_tokens[i, action_t[i], ...] with the predicted tokens. Note that this is not
+            # insert.
+            index = action_t[:, None, None].expand(-1, 1, self._tokens_per_action)
+            network_state['action_tokens'] = state_action_tokens.scatter(
+                1, index, one_state_action_tokens.to(state_action_tokens.dtype))
+
+        # Increment the time_step for the next inference call.
+        # network_state['seq_idx'] never exceed time_sequence_length.
+        network_state['seq_idx'] = torch.clamp(seq_idx + 1, max=self._time_sequence_length)
+
+        return predicted_tokens_for_output, network_state
+
+    # The following two methods split an inference call into the image tokenization of the current time step and
+    # the rest, so that they can run as separate pipeline stages. Calling them in order is equivalent to forward with
+    # preprocessed images, except that detokenization is left to the caller.
+    def encode_images(self, image: torch.Tensor, context: Optional[torch.Tensor] = None,
+                      gate_state: Optional[Dict[str, torch.Tensor]] = None) -> torch.Tensor:
+        """Tokenizes images of the current time step.
+
+        Args:
+            image: Preprocessed images of shape (b, c, h, w).
+            context: An optional natural language embedding of shape (b, embedding_dim).
+            gate_state: State of the motion gate with 'seq_idx', 'gate_thumbnail' and 'gate_image_tokens' of
+                network_state, zero at the beginning of an episode. Required if motion_gate_threshold is set, so
+                that static frames reuse image tokens as in forward. It is updated in place.
+        Returns:
+            Image tokens of shape (b, num_tokens, embedding_dim).
+        """
+        image = image.unsqueeze(1)  # [b, c, h, w] -> [b, 1, c, h, w]
+        if context is not None:
+            context = context.unsqueeze(1)  # [b, emb-size] -> [b, 1, emb-size]
+        if self._motion_gate_threshold is None:
+            return self._image_tokenizer(image, context=context)[:, 0]
+        if gate_state is None:
+            raise ValueError('gate_state is required to encode images with motion_gate_threshold.')
+        image_tokens, new_gate_state = self._gated_image_tokens(image, context, gate_state)
+        gate_state.update(new_gate_state)
+        gate_state['seq_idx'] = torch.clamp(gate_state['seq_idx'] + 1, max=self._time_sequence_length)
+        return image_tokens[:, 0]
+
+    def infer_from_image_tokens(self, image_tokens: torch.Tensor, network_state: Dict[str, torch.Tensor]) \
+            -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
+        """Predicts action tokens of the current time step from its image tokens.
+
+        Args:
+            image_tokens: Output of encode_images. (b, num_tokens, embedding_dim)
+            network_state: Network state data of the inference call.
+        Returns:
+            A tuple `(action tokens of shape (b, tokens_per_action), network state)`.
+            Use action_tokenizer.detokenize to convert the tokens into actions.
+        """
+        context_image_tokens, network_state = self._write_image_tokens_to_state(image_tokens.unsqueeze(1),
+                                                                                network_state)
+        action_tokens = self._state_action_tokens(network_state)
+        self._aux_info = {'action_labels': action_tokens}
+        predicted_tokens, network_state = self._infer_action_tokens(
+            context_image_tokens, action_tokens, self._default_attention_mask, network_state)
+        return predicted_tokens, network_state
+
     def _get_outer_rank(self, observations: Dict[str, torch.Tensor]) -> int:
         # used to determine training vs inference call
         # outer_rank will be 2 -> [b, t] during training and
@@ -379,15 +624,114 @@ class TransformerNetwork(nn.Module):
             action_tokens: torch.Tensor,  # (b, t, self._tokens_per_action)
             batch_size: int,
             attention_mask: torch.Tensor,
+            position_ids: Optional[torch.Tensor] = None,  # (b, t*num_tokens). None means the order of the tokens.
     ) -> Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
 
         input_token_sequence = self._assemble_input_token_sequence(context_image_tokens, action_tokens,
                                                                    batch_size)  # [b, t*num_tokens, emb_dim]
         # run transformer
         output_tokens, self._attention_scores = self._transformer(input_token_sequence,
-                                                                  attention_mask)  # (bs, t*num_tokens, vocab_size)
+                                                                  attention_mask,
+                                                                  position_ids=position_ids)
+        # (bs, t*num_tokens, vocab_size)
         return output_tokens
 
+    # Call transformer only on the tokens of the current time step. Keys and values of the past time steps are
+    # reused from network_state['key_cache'] and network_state['value_cache'].
+    # Because of the causal attention mask, keys and values of a token never depend on the following tokens.
+    # Therefore, those of the past time steps are still valid when a new time step comes.
+    # However, position embeddings are absolute positions in the window. When seq_idx == time_sequence_length, the
+    # window was shifted to the left and every cached key and value is stale. In that case, we rebuild the caches
+    # with a single pass over the whole window.
+    # Therefore, the cache only saves compute over the first time_sequence_length - 1 steps of an episode. After
+    # that, every step costs one pass over the window plus the writes of the caches, which makes it slower than
+    # parallel_decoding in steady state. Use ring_buffer_state or parallel_decoding for long episodes. Rolling the cache with positions
+    # relative to the window start wouldn't be exact either: above the first layer, keys and values of every token
+    # depend on the time step that leaves the window, so the result would differ from training.
+    # The caches take 2 * num_layers * num_heads * time_sequence_length * (tokens per time step) * layer_size floats
+    # per episode, e.g. 25 MB with the defaults and time_sequence_length=6. This pays off for short episodes and for
+    # the first steps of long windows, where most of the window isn't filled yet.
+    # With ring_buffer_state, the caches are indexed by the position in the ring buffer (step_slot) while position
+    # embeddings and attention mask use the logical order of the window (token_positions).
+    def _transformer_call_with_kv_cache(
+            self,
+            context_image_tokens: torch.Tensor,  # (b, t, num token, emb_dim)
+            action_tokens: torch.Tensor,  # (b, t, self._tokens_per_action)
+            network_state: Dict[str, torch.Tensor],
+            seq_idx: torch.Tensor,  # (b,)
+            step_slot: torch.Tensor,  # (b,). Where the current time step is stored in context_image_tokens.
+            batch_size: int,
+            # Attention mask of the tokens in the order they are stored. (t*num_tokens, t*num_tokens), or
+            # (b, t*num_tokens, t*num_tokens) with ring_buffer_state.
+            attention_mask: torch.Tensor,
+            token_positions: Optional[torch.Tensor] = None,  # (b, t*num_tokens). None means the identity.
+    ) -> torch.Tensor:
+        time_step = torch.clamp(seq_idx, max=self._time_sequence_length - 1)  # (b,)
+        offsets = torch.arange(self._single_time_step_num_tokens, device=time_step.device)
+        # Positions of the tokens of the current time step for each episode. (b, num_tokens)
+        step_positions = time_step.unsqueeze(1) * self._single_time_step_num_tokens + offsets
+        step_cache_positions = step_slot.unsqueeze(1) * self._single_time_step_num_tokens + offsets
+
+        kv_caches = [(network_state['key_cache'][:, i], network_state['value_cache'][:, i])
+                     for i in range(self._num_layers)]
+
+        if torch.any(seq_idx == self._time_sequence_length):
+            # At least one window was shifted. Rebuild the caches of all episodes with the whole window.
+            # This is also exact for the other episodes because outputs only depend on the past tokens.
+            input_token_sequence = self._assemble_input_token_sequence(context_image_tokens, action_tokens,
+                                                                       batch_size)  # [b, t*num_tokens, emb_dim]
+            if token_positions is None:
+                cache_positions = None
+            else:
+                cache_positions = torch.arange(self._all_num_tokens, device=time_step.device)
+                cache_positions = torch.tile(cache_positions.unsqueeze(0), dims=(batch_size, 1))
+            output_tokens, self._attention_scores = self._transformer(input_token_sequence,
+                                                                      attention_mask,
+                                                                      position_ids=token_positions,
+                                                                      kv_caches=kv_caches,
+                                                                      cache_positions=cache_positions)
+            # Gather the output of the current time step of each episode.
+            index = step_cache_positions.unsqueeze(-1).expand(-1, -1, output_tokens.shape[-1])
+            return torch.gather(output_tokens, 1, index)  # (b, num_tokens, vocab_size)
+
+        # Gather the tokens of the current time step of each episode.
+        step_image_tokens = torch.gather(
+            context_image_tokens, 1,
+            step_slot[:, None, None, None].expand(-1, 1, context_image_tokens.shape[2], context_image_tokens.shape[3]))
+        step_action_tokens = torch.gather(
+            action_tokens, 1, step_slot[:, None, None].expand(-1, 1, action_tokens.shape[2]))
+        input_token_sequence = self._assemble_input_token_sequence(step_image_tokens, step_action_tokens,
+                                                                   batch_size)  # [b, num_tokens, emb_dim]
+
+        # Queries are the new tokens and keys are all tokens in the window.
+        # The rows of the new tokens are where they are stored. attention_mask: (b, num_tokens, t*num_tokens)
+        if attention_mask.dim() == 2:
+            attention_mask = attention_mask[step_cache_positions]
+        else:
+            attention_mask = attention_mask[torch.arange(batch_size, device=step_slot.device).unsqueeze(1),
+                                            step_cache_positions]
+        output_tokens, self._attention_scores = self._transformer(input_token_sequence,
+                                                                  attention_mask,
+                                                                  position_ids=step_positions,
+                                                                  kv_caches=kv_caches,
+                                                                  cache_positions=step_cache_positions)
+        return output_tokens  # (b, num_tokens, vocab_size)
+
+    # Returns how far the slots of the ring buffer are rotated from the logical order of the window. (b,)
+    # The slot at write_idx is time_step in the window, and the slot before it is time_step - 1 and so on.
+    def _ring_buffer_shift(self, network_state: Dict[str, torch.Tensor]) -> torch.Tensor:
+        time_step = torch.clamp(network_state['seq_idx'], max=self._time_sequence_length - 1)
+        return torch.remainder(time_step - network_state['write_idx'], self._time_sequence_length)
+
+    # Maps every token stored in the ring buffer to its position in the logical order of the window.
+    # shift: (b,) of _ring_buffer_shift. Returns (b, t*num_tokens).
+    def _ring_buffer_shift_token_positions(self, shift: torch.Tensor) -> torch.Tensor:
+        slots = torch.arange(self._time_sequence_length, device=shift.device)
+        logical_steps = torch.remainder(slots.unsqueeze(0) + shift.unsqueeze(1), self._time_sequence_length)  # (b, t)
+        token_positions = (logical_steps.unsqueeze(-1) * self._single_time_step_num_tokens +
+                           torch.arange(self._single_time_step_num_tokens, device=shift.device))
+        return token_positions.view(shift.shape[0], -1)
+
     # input_token_sequence = [context_image_tokens + action_tokens]
     def _assemble_input_token_sequence(self, context_image_tokens, action_tokens, batch_size):
         # embed action tokens
@@ -407,15 +751,19 @@ class TransformerNetwork(nn.Module):
         return input_token_sequence
 
     # Call transformer, slice output, return predicted token.
+    # slice_start is either an int shared by all batches or a tensor of size (b,) that has a start for each batch.
     def _transformer_call_and_slice(self,
                                     *args,
-                                    slice_start: int = 0,
+                                    slice_start: Union[int, torch.Tensor] = 0,
                                     slice_length: int = 1,
                                     **kwargs) -> Tuple[torch.Tensor, torch.Tensor]:
         output_tokens = self._transformer_call(*args, **kwargs)
 
-        slice_end = slice_start + slice_length
-        token_logits = output_tokens[:, slice_start:slice_end, :]  # (b, slice_length, vocab_size)
+        b = output_tokens.shape[0]
+        slice_start = torch.as_tensor(slice_start, device=output_tokens.device).reshape(-1, 1)
+        index = slice_start + torch.arange(slice_length, device=output_tokens.device)  # (b or 1, slice_length)
+        index = index.expand(b, -1).unsqueeze(-1).expand(-1, -1, output_tokens.shape[-1])
+        token_logits = torch.gather(output_tokens, 1, index)  # (b, slice_length, vocab_size)
         token = torch.argmax(token_logits, dim=-1)
 
         return token, token_logits
@@ -439,11 +787,7 @@ class TransformerNetwork(nn.Module):
         image = observations['image']  # [b, t, c, h, w] or [b, c, h, w]
         outer_rank = self._get_outer_rank(observations)
 
-        seq_idx = None
         if outer_rank == 1:  # This is an inference call
-            seq_idx = network_state['seq_idx'][0]  # 0 ~ time_sequence_length
-            time_step = torch.minimum(seq_idx,
-                                      torch.tensor(self._time_sequence_length - 1))
             image = image.unsqueeze(1)  # [b, c, h, w] -> [b, 1, c, h, w]
 
         image_shape = image.shape
@@ -457,12 +801,57 @@ class TransformerNetwork(nn.Module):
         context = self._extract_context_from_observation(observations, input_t)  # [b, t, emb-size] or None
 
         # preprocess image
-        image = image.view((b * input_t, c, h, w))  # image is already tensor and its range is [0,1]
-        image = preprocessors.convert_dtype_and_crop_images(image)
+        image = image.reshape((b * input_t, c, h, w))  # image is already tensor and its range is [0,1]
+        image = preprocessors.convert_dtype_and_crop_images(image, training=self.training,
+                                                            memory_format=self._image_tokenizer.memory_format)
         image = image.view((b, input_t, c, h, w))
 
         # get image tokens
-        context_image_tokens = self._image_tokenizer(image, context=context)  # (batch, t, num_tokens, embedding_dim)
+        if outer_rank == 1 and self._motion_gate_threshold is not None:
+            context_image_tokens, network_state = self._gated_image_tokens(image, context, network_state)
+        else:
+            # (batch, t, num_tokens, embedding_dim)
+            context_image_tokens = self._image_tokenizer(image, context=context)
+
+        if outer_rank == 1:  # This is an inference call
+            context_image_tokens, network_state = self._write_image_tokens_to_state(context_image_tokens,
+                                                                                    network_state)
+
+        return context_image_tokens, network_state
+
+    # image: (b, 1, c, h, w) and context: (b, 1, emb-size) or None of the current time step at inference.
+    # Only the frames that moved since the last encoded frame are encoded. The others reuse its image tokens.
+    # Returns context_image_tokens (b, 1, num_tokens, embedding_dim) and network_state.
+    def _gated_image_tokens(self, image, context, network_state):
+        thumbnail = F.adaptive_avg_pool2d(image[:, 0], self._motion_gate_thumbnail_size)  # (b, c, 16, 16)
+        last_thumbnail = network_state['gate_thumbnail']
+        difference = torch.mean(torch.abs(thumbnail - last_thumbnail.to(thumbnail.dtype)), dim=(1, 2, 3))  # (b,)
+        # The first frame of an episode is always encoded.
+        reuse = (network_state['seq_idx'] > 0) & (difference < self._motion_gate_threshold)  # (b,)
+        encode = ~reuse
+
+        image_tokens = network_state['gate_image_tokens']  # (b, num_tokens, embedding_dim)
+        num_encoded = int(encode.sum())
+        if num_encoded > 0:
+            encoded_context = None if context is None else context[encode]
+            encoded_image_tokens = self._image_tokenizer(image[encode], context=encoded_context)[:, 0]
+            image_tokens = image_tokens.to(encoded_image_tokens.dtype).index_put((encode,), encoded_image_tokens)
+            # Later frames are compared with the last encoded frame, so that slow motion adds up.
+            last_thumbnail = torch.where(encode[:, None, None, None], thumbnail, last_thumbnail)
+        self._num_encoded_images += num_encoded
+        self._num_reused_images += image.shape[0] - num_encoded
+
+        network_state = dict(network_state)
+        network_state['gate_thumbnail'] = last_thumbnail
+        network_state['gate_image_tokens'] = image_tokens
+        return image_tokens.unsqueeze(1), network_state
+
+    # context_image_tokens: (b, 1, num_tokens, embedding_dim) of the current time step.
+    # Returns context_image_tokens of the window (b, time_sequence_length, num_tokens, embedding_dim) and network_state.
+    def _write_image_tokens_to_state(self, context_image_tokens, network_state):
+        b = context_image_tokens.shape[0]
+        seq_idx = network_state['seq_idx']  # (b,). 0 ~ time_sequence_length
+        time_step = torch.clamp(seq_idx, max=self._time_sequence_length - 1)
 
         # update network state at inference we retain some context_image_tokens to accelerate computation. At
         # inference, context_image_tokens : (batch, 1, num_tokens, embedding_dim) At inference, network_state stores
@@ -471,28 +860,35 @@ class TransformerNetwork(nn.Module):
         # means network_state does not store the tokens for all past steps, but only for time_sequence_length time
         # steps. if current time step >= time_sequence_length, we store context_image_tokens after we discard the
         # oldest context_image_tokens. Here, we implement that by shifting state_image_token to the left.
-        if outer_rank == 1:  # This is an inference call
-            state_image_tokens = network_state[
-                'context_image_tokens']  # (1, time_sequence_length, tokens_per_context_image, token_embedding_size)
-            # network_state as input for this call is the output from the last call.
-            # Therefore, we need to shift all images to the left by 1 in the time axis
-            # to align with the time dim in this call.
-            state_image_tokens = torch.roll(state_image_tokens, -1, 1) \
-                if seq_idx == self._time_sequence_length else state_image_tokens
-            # if seq_idx == time_sequence_length, state_image_tokens will be shifted to the left a long time axis
-            # seq_idx will be incremented in forward function. But it is adjusted
-            # so that it never exceed time_sequence_length.
-            # Therefore, shifting will always occur when time step exceeds time_sequence_length.
-
-            # maximum of time_step is self._time_sequence_length - 1
-            context_image_tokens = torch.concat([
-                state_image_tokens[:, :time_step, ...], context_image_tokens,
-                # Note that in inference, size of context_image_tokens is (batch, 1, num_tokens, embedding_dim)
-                state_image_tokens[:, time_step + 1:, ...]
-                # if time_step == time_sequence_lengths -1, this will be empty tensor.
-                # So this tensor will be ignored when concat
-            ], dim=1)
-            network_state['context_image_tokens'] = context_image_tokens
+        state_image_tokens = network_state[
+            'context_image_tokens']  # (b, time_sequence_length, tokens_per_context_image, token_embedding_size)
+        if self._ring_buffer_state:
+            # Write the new tokens in place at write_idx. Nothing is shifted.
+            batch_index = torch.arange(b, device=state_image_tokens.device)
+            state_image_tokens[batch_index, network_state['write_idx']] = \
+                context_image_tokens[:, 0].to(state_image_tokens.dtype)
+            return state_image_tokens, network_state
+
+        # network_state as input for this call is the output from the last call.
+        # Therefore, we need to shift all images to the left by 1 in the time axis
+        # to align with the time dim in this call.
+        shift = seq_idx == self._time_sequence_length  # (b,)
+        if torch.any(shift):
+            state_image_tokens = torch.where(shift[:, None, None, None],
+                                             torch.roll(state_image_tokens, -1, 1), state_image_tokens)
+        # if seq_idx == time_sequence_length, state_image_tokens will be shifted to the left a long time axis
+        # seq_idx will be incremented in forward function. But it is adjusted
+        # so that it never exceed time_sequence_length.
+        # Therefore, shifting will always occur when time step exceeds time_sequence_length.
+
+        # maximum of time_step is self._time_sequence_length - 1
+        # replace state_image_tokens[i, time_step[i]] with context_image_tokens[i, 0].
+        # Note that in inference, size of context_image_tokens is (batch, 1, num_tokens, embedding_dim)
+        index = time_step[:, None, None, None].expand(-1, 1, context_image_tokens.shape[2],
+                                                      context_image_tokens.shape[3])
+        context_image_tokens = state_image_tokens.scatter(1, index,
+                                                          context_image_tokens.to(state_image_tokens.dtype))
+        network_state['context_image_tokens'] = context_image_tokens
 
         return context_image_tokens, network_state
 
@@ -500,11 +896,7 @@ class TransformerNetwork(nn.Module):
         outer_rank = self._get_outer_rank(observations)
 
         if outer_rank == 1:  # This is an inference call
-            action_tokens = network_state['action_tokens']
-            seq_idx = network_state['seq_idx'][0]
-            # network_state as input for this call is the output from the last call.
-            # Therefore, we need to shift all actions by 1 to the left.
-            action_tokens = torch.roll(action_tokens, -1, 1) if seq_idx == self._time_sequence_length else action_tokens
+            action_tokens = self._state_action_tokens(network_state)
         else:
             assert outer_rank == 2
             # self._actions was set through set_actions function.
@@ -516,6 +908,20 @@ class TransformerNetwork(nn.Module):
                 action_tokens = self._action_tokenizer.tokenize(self._actions)
         return action_tokens
 
+    # Returns action tokens of the window stored in network_state at inference. (b, t, self._tokens_per_action)
+    def _state_action_tokens(self, network_state):
+        action_tokens = network_state['action_tokens']
+        if self._ring_buffer_state:
+            # The ring buffer is never shifted.
+            return action_tokens
+        seq_idx = network_state['seq_idx']  # (b,)
+        # network_state as input for this call is the output from the last call.
+        # Therefore, we need to shift actions by 1 to the left in the episodes whose window is full.
+        shift = seq_idx == self._time_sequence_length
+        if torch.any(shift):
+            action_tokens = torch.where(shift[:, None, None], torch.roll(action_tokens, -1, 1), action_tokens)
+        return action_tokens
+
     # output context from observation. size: [b, t, emb-size]
     def _extract_context_from_observation(self, observations, seq_len):
         """Extract context from observation."""
@@ -537,6 +943,8 @@ class TransformerNetwork(nn.Module):
             actions are terminate = 1 world_vector = [0.9, 0.8, -0.3]
             rotation_delta = [-0.1, 0.2, .6] gripper_closedness = 0.9
         ※ terminate is either 0 or 1.
+        With action_chunk_size K > 1, each value has the next K actions from the time step, e.g.
+            world_vector of shape (b, t, K, 3).
         """
         self._actions = actions
 
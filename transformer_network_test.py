@@ -20,6 +20,10 @@
 
 """Tests for networks."""
 
+import os
+import subprocess
+import sys
+
 import torch
 import torch.nn.functional as F
 from absl.testing import parameterized
@@ -28,7 +32,9 @@ import numpy as np
 from typing import Dict
 
 import transformer_network
+from film_efficientnet import preprocessors
 from transformer_network_test_set_up import BATCH_SIZE
+from transformer_network_test_set_up import HEIGHT
 from transformer_network_test_set_up import NAME_TO_INF_OBSERVATIONS
 from transformer_network_test_set_up import NAME_TO_STATE_SPACES
 from transformer_network_test_set_up import observations_list
@@ -36,6 +42,7 @@ from transformer_network_test_set_up import space_names_list
 from transformer_network_test_set_up import state_space_list
 from transformer_network_test_set_up import TIME_SEQUENCE_LENGTH
 from transformer_network_test_set_up import TransformerNetworkTestUtils
+from transformer_network_test_set_up import WIDTH
 from tokenizers.utils import batched_space_sampler
 from tokenizers.utils import np_to_tensor
 
@@ -81,7 +88,6 @@ class TransformerNetworkTest(TransformerNetworkTestUtils):
 
         network.set_actions(
             self._inference_action)  # self._inference_action has no time dimension unlike self._train_action.
-        # inference currently only support batch size of 1
         network_state = batched_space_sampler(network._state_space, batch_size=1)
         network_state = np_to_tensor(network_state)  # change np.ndarray type of sample values into tensor type
 
@@ -158,6 +164,268 @@ class TransformerNetworkTest(TransformerNetworkTestUtils):
             np.testing.assert_array_equal(output_tokens[:t + 1].detach().numpy(),
                                           output_tokens_at_t[:t + 1].detach().numpy())
 
+    def _assert_same_inference(self, network, other_network, num_steps=TIME_SEQUENCE_LENGTH + 2,
+                               compare_state=True):
+        """Runs both networks step by step on the same observations and compares their action logits."""
+        other_network.load_state_dict(network.state_dict())
+        network.eval()
+        other_network.eval()
+
+        network_state = self._zero_network_state(network, batch_size=1)
+        other_network_state = self._zero_network_state(other_network, batch_size=1)
+
+        with torch.no_grad():
+            for _ in range(num_steps):
+                observation = {
+                    'image': torch.rand(1, 3, HEIGHT, WIDTH),
+                    'natural_language_embedding': torch.full([1, self.token_embedding_size], 1.0),
+                }
+                _, network_state = network(observation, network_state=network_state)
+                _, other_network_state = other_network(observation, network_state=other_network_state)
+
+                torch.testing.assert_close(
+                    other_network.get_aux_info()['action_predictions_logits'],
+                    network.get_aux_info()['action_predictions_logits'],
+                    rtol=1e-4, atol=1e-4)
+                if compare_state:
+                    np.testing.assert_array_equal(other_network_state['action_tokens'].numpy(),
+                                                  network_state['action_tokens'].numpy())
+
+    @parameterized.named_parameters([{
+        'testcase_name': '_' + name,
+        'state_space': spec,
+    } for name, spec in zip(space_names_list(), state_space_list())])
+    def testTransformerKVCacheInference(self, state_space):
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH,
+            dropout_rate=0.0)
+        cached_network = transformer_network.TransformerNetwork(
+            input_tensor_space=state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH,
+            dropout_rate=0.0,
+            use_kv_cache=True)
+        # Run past time_sequence_length so that the window is shifted and the caches are rebuilt.
+        self._assert_same_inference(network, cached_network)
+
+    @parameterized.named_parameters([{
+        'testcase_name': '_' + name,
+        'state_space': spec,
+    } for name, spec in zip(space_names_list(), state_space_list())])
+    def testTransformerParallelDecoding(self, state_space):
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH,
+            dropout_rate=0.0)
+        parallel_network = transformer_network.TransformerNetwork(
+            input_tensor_space=state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH,
+            dropout_rate=0.0,
+            parallel_decoding=True)
+        self._assert_same_inference(network, parallel_network)
+
+    @parameterized.named_parameters(
+        ('loop', {}),
+        ('parallel_decoding', {'parallel_decoding': True}),
+        ('kv_cache', {'use_kv_cache': True}))
+    def testTransformerBatchedInference(self, network_kwargs):
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH,
+            dropout_rate=0.0,
+            **network_kwargs)
+        network.eval()
+
+        def _observation():
+            return {
+                'image': torch.rand(1, 3, HEIGHT, WIDTH),
+                'natural_language_embedding': torch.rand(1, self.token_embedding_size),
+            }
+
+        def _concat(dicts):
+            return {k: torch.concat([d[k] for d in dicts], dim=0) for k in dicts[0]}
+
+        with torch.no_grad():
+            # The first episode is two steps ahead of the second one.
+            first_state = self._zero_network_state(network, batch_size=1)
+            for _ in range(2):
+                _, first_state = network(_observation(), network_state=first_state)
+            second_state = self._zero_network_state(network, batch_size=1)
+            batched_state = _concat([first_state, second_state])
+
+            # Run past time_sequence_length so that only the first episode is shifted at first.
+            for _ in range(TIME_SEQUENCE_LENGTH + 1):
+                first_observation = _observation()
+                second_observation = _observation()
+
+                _, first_state = network(first_observation, network_state=first_state)
+                first_logits = network.get_aux_info()['action_predictions_logits']
+                _, second_state = network(second_observation, network_state=second_state)
+                second_logits = network.get_aux_info()['action_predictions_logits']
+                _, batched_state = network(_concat([first_observation, second_observation]),
+                                           network_state=batched_state)
+                batched_logits = network.get_aux_info()['action_predictions_logits']
+
+                torch.testing.assert_close(batched_logits, torch.concat([first_logits, second_logits], dim=0),
+                                           rtol=1e-4, atol=1e-4)
+                np.testing.assert_array_equal(batched_state['seq_idx'].numpy(),
+                                              np.concatenate([first_state['seq_idx'].numpy(),
+                                                              second_state['seq_idx'].numpy()]))
+
+    def testTransformerStagedInference(self):
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH)
+        network.eval()
+
+        network_state = self._zero_network_state(network, batch_size=1)
+        staged_network_state = self._zero_network_state(network, batch_size=1)
+
+        with torch.no_grad():
+            for _ in range(TIME_SEQUENCE_LENGTH + 2):
+                observation = {
+                    'image': torch.rand(1, 3, HEIGHT, WIDTH),
+                    'natural_language_embedding': torch.full([1, self.token_embedding_size], 1.0),
+                }
+                output_actions, network_state = network(observation, network_state=network_state)
+                logits = network.get_aux_info()['action_predictions_logits']
+
+                image = preprocessors.convert_dtype_and_crop_images(observation['image'], training=False)
+                image_tokens = network.encode_images(image, observation['natural_language_embedding'])
+                action_tokens, staged_network_state = network.infer_from_image_tokens(image_tokens,
+                                                                                      staged_network_state)
+                staged_actions = network.action_tokenizer.detokenize(action_tokens)
+
+                torch.testing.assert_close(network.get_aux_info()['action_predictions_logits'], logits,
+                                           rtol=1e-4, atol=1e-4)
+                for k in output_actions.keys():
+                    torch.testing.assert_close(staged_actions[k], output_actions[k])
+
+    @parameterized.named_parameters(
+        ('ring_buffer', {'ring_buffer_state': True}),
+        ('ring_buffer_kv_cache', {'ring_buffer_state': True, 'use_kv_cache': True}))
+    def testTransformerRingBufferState(self, network_kwargs):
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH,
+            dropout_rate=0.0)
+        ring_buffer_network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH,
+            dropout_rate=0.0,
+            **network_kwargs)
+        # The ring buffer stores time steps in a different order, so only the outputs are compared.
+        # Run until the write pointer wraps around more than once.
+        self._assert_same_inference(network, ring_buffer_network, num_steps=2 * TIME_SEQUENCE_LENGTH + 1,
+                                    compare_state=False)
+
+    def testRingBufferAttentionMasks(self):
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH,
+            ring_buffer_state=True)
+        shift = torch.arange(TIME_SEQUENCE_LENGTH)
+        positions = network._ring_buffer_shift_token_positions(shift)
+        expected = network._default_attention_mask[positions[:, :, None], positions[:, None, :]]
+        torch.testing.assert_close(network._ring_buffer_attention_masks[shift], expected)
+        self.assertNotIn('_ring_buffer_attention_masks', network.state_dict())
+
+    def testImportWithoutHeavyDependencies(self):
+        # Inference workers import the network and the tokenizers but should not load the training dependencies.
+        heavy_modules = ['tensorflow', 'tensorflow_datasets', 'reverb', 'rlds', 'matplotlib', 'skimage']
+        code = ('import sys, transformer_network, tokenizers.action_tokenizer, tokenizers.image_tokenizer, train, '
+                'data.multiple_dataset; '
+                'print(sorted(m for m in {} if m in sys.modules))'.format(heavy_modules))
+        output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                check=True, capture_output=True, text=True).stdout
+        self.assertEqual('[]', output.strip())
+
+    def testTransformerMotionGate(self):
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH)
+        gated_network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH,
+            motion_gate_threshold=0.01)
+        gated_network.load_state_dict(network.state_dict())
+        network.eval()
+        gated_network.eval()
+
+        # The first sample is static and the second one moves at every step.
+        static_image = torch.rand(1, 3, HEIGHT, WIDTH)
+        network_state = self._zero_network_state(network, batch_size=2)
+        gated_network_state = self._zero_network_state(gated_network, batch_size=2)
+        num_steps = TIME_SEQUENCE_LENGTH + 2
+        with torch.no_grad():
+            for _ in range(num_steps):
+                observation = {
+                    'image': torch.concat([static_image, torch.rand(1, 3, HEIGHT, WIDTH)]),
+                    'natural_language_embedding': torch.full([2, self.token_embedding_size], 1.0),
+                }
+                _, network_state = network(observation, network_state=network_state)
+                _, gated_network_state = gated_network(observation, network_state=gated_network_state)
+                torch.testing.assert_close(gated_network.get_aux_info()['action_predictions_logits'],
+                                           network.get_aux_info()['action_predictions_logits'],
+                                           rtol=1e-4, atol=1e-4)
+        self.assertEqual({'reused': num_steps - 1, 'encoded': num_steps + 1}, gated_network.motion_gate_stats)
+
+    def testTransformerCropSize(self):
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH,
+            use_token_learner=False,
+            crop_size=(128, 160))
+        # Images of (256, 320) are resized to (128, 160), which EfficientNet turns into 4 x 5 tokens.
+        self.assertEqual(20, network._tokens_per_context_image)
+        network.set_actions(self._train_action)
+        network_state = self._zero_network_state(network, batch_size=BATCH_SIZE)
+        network(self._train_observation, network_state=network_state)
+        self.assertEqual([BATCH_SIZE, TIME_SEQUENCE_LENGTH], list(network.get_actor_loss().shape))
+
+    @parameterized.named_parameters(
+        ('autoregressive', 4, {}),
+        ('parallel_decoding', 4, {'parallel_decoding': True}),
+        # 3 * (8 + 12 * 8) tokens are more than the default max_seq_len of 256.
+        ('longer_than_default_max_seq_len', 12, {'parallel_decoding': True}))
+    def testTransformerActionChunk(self, action_chunk_size, network_kwargs):
+        network = transformer_network.TransformerNetwork(
+            input_tensor_space=self._state_space,
+            output_tensor_space=self._action_space,
+            time_sequence_length=TIME_SEQUENCE_LENGTH,
+            action_chunk_size=action_chunk_size,
+            **network_kwargs)
+        self.assertEqual(action_chunk_size * 8, network._tokens_per_action)
+
+        # Training predicts the next action_chunk_size actions at every time step.
+        network.set_actions({k: torch.stack([v] * action_chunk_size, dim=2) for k, v in self._train_action.items()})
+        network_state = self._zero_network_state(network, batch_size=BATCH_SIZE)
+        output_actions, _ = network(self._train_observation, network_state=network_state)
+        self.assertEqual([BATCH_SIZE, TIME_SEQUENCE_LENGTH], list(network.get_actor_loss().shape))
+        self.assertEqual([BATCH_SIZE, action_chunk_size, 3], list(output_actions['world_vector'].shape))
+
+        # Inference outputs the chunk at once.
+        network.eval()
+        network_state = self._zero_network_state(network, batch_size=1)
+        with torch.no_grad():
+            output_actions, network_state = network(self._inference_observation, network_state=network_state)
+        self.assertEqual([1, action_chunk_size], list(output_actions['terminate_episode'].shape))
+        self.assertEqual([1, action_chunk_size, 3], list(output_actions['world_vector'].shape))
+        self.assertEqual([1, action_chunk_size, 1], list(output_actions['gripper_closedness_action'].shape))
+        self.assertEqual(1, network_state['seq_idx'].item())
+
 
 if __name__ == '__main__':
     unittest.main()
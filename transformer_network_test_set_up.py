@@ -27,6 +27,9 @@ import torch
 import unittest
 from collections import OrderedDict
 
+from tokenizers.utils import batched_space_sampler
+from tokenizers.utils import np_to_tensor
+
 BATCH_SIZE = 2
 TIME_SEQUENCE_LENGTH = 3
 HEIGHT = 256
@@ -61,7 +64,7 @@ def observations_list(training: bool = True) -> List[Dict[str, torch.Tensor]]:
         image_shape = [BATCH_SIZE, TIME_SEQUENCE_LENGTH, 3, HEIGHT, WIDTH]
         emb_shape = [BATCH_SIZE, TIME_SEQUENCE_LENGTH, 512]
     else:
-        # inference currently only support batch size of 1
+        # Inference observations have no time dimension.
         image_shape = [1, 3, HEIGHT, WIDTH]
         emb_shape = [1, 512]
     return [
@@ -162,6 +165,12 @@ class TransformerNetworkTestUtils(parameterized.TestCase, unittest.TestCase):
                 torch.full([self.train_batch_size, self.time_sequence_length, 1], 0.5),
         }
 
+    @staticmethod
+    def _zero_network_state(network, batch_size: int) -> Dict[str, torch.Tensor]:
+        """Returns network_state at the beginning of an episode."""
+        network_state = np_to_tensor(batched_space_sampler(network._state_space, batch_size=batch_size))
+        return {k: torch.zeros_like(v) for k, v in network_state.items()}
+
     def setUp(self):
         self._define_spaces()
         super().setUp()
@@ -52,6 +52,39 @@ class TransformerTest(parameterized.TestCase, unittest.TestCase):
         else:
             self.assertEmpty(attention_scores)
 
+    def test_transformer_kv_cache(self):
+        num_layers = 2
+        num_heads = 4
+        layer_size = 16
+        network = Transformer(
+            num_layers=num_layers,
+            layer_size=layer_size,
+            num_heads=num_heads,
+            feed_forward_size=32,
+            dropout_rate=0.0,
+            vocab_size=self._vocab_size,
+            input_token_emb_dim=self._vocab_size,
+            max_seq_len=15)
+        network.eval()
+
+        batch_size, sequence_len, _ = self._tokens.shape
+        attention_mask = torch.tril(torch.ones((sequence_len, sequence_len), dtype=torch.uint8))
+        output_tokens, _ = network(self._tokens, attention_mask=attention_mask)
+
+        # Feed the same tokens in two chunks. The second chunk attends to the keys and values of the first one.
+        kv_caches = [(torch.zeros(batch_size, num_heads, sequence_len, layer_size),
+                      torch.zeros(batch_size, num_heads, sequence_len, layer_size)) for _ in range(num_layers)]
+        split = 5
+        cached_output_tokens = []
+        for start, end in [(0, split), (split, sequence_len)]:
+            position_ids = torch.tile(torch.arange(start, end).unsqueeze(0), dims=(batch_size, 1))
+            output, _ = network(self._tokens[:, start:end], attention_mask=attention_mask[start:end],
+                                position_ids=position_ids, kv_caches=kv_caches)
+            cached_output_tokens.append(output)
+        cached_output_tokens = torch.concat(cached_output_tokens, dim=1)
+
+        torch.testing.assert_close(cached_output_tokens, output_tokens, rtol=1e-5, atol=1e-5)
+
 
 if __name__ == '__main__':
     unittest.main()